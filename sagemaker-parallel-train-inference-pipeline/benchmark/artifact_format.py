@@ -0,0 +1,110 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'code', 'sagemaker', 'common'))
+import model_artifact  # noqa: E402
+
+CASES = [
+    ('zip', None),
+    ('tar', None),
+    ('tar.zst', 1),
+    ('tar.zst', 3),
+    ('tar.lz4', None),
+    ('files', None),
+]
+
+
+def make_model_dir(path, num_of_models, model_size_mb, random_state=0):
+    # AutoGluon の学習済みモデルに近い、圧縮が効きにくい float の配列を並べたダミー
+    rng = np.random.RandomState(random_state)
+    for i in range(num_of_models):
+        model_dir = os.path.join(path, 'models', f'model_{i}')
+        os.makedirs(model_dir)
+        weights = rng.normal(size=model_size_mb * 1024 * 1024 // 8)
+        with open(os.path.join(model_dir, 'model.pkl'), 'wb') as f:
+            f.write(weights.round(3).tobytes())
+    with open(os.path.join(path, 'predictor.pkl'), 'wb') as f:
+        f.write(b'0' * 1024)
+
+
+def unpack_local(output_path, manifest, model_path):
+    # S3 を使わない場合も、推論時と同じ方法で展開する
+    format_name = manifest['format']
+    if format_name == 'zip':
+        shutil.unpack_archive(os.path.join(output_path, 'model.zip'), model_path)
+    elif format_name == 'files':
+        shutil.copytree(os.path.join(output_path, 'model'), model_path)
+    else:
+        with open(os.path.join(output_path, manifest['files'][0]), 'rb') as f:
+            model_artifact.extract_tar(f, format_name, model_path)
+
+
+def upload(s3_client, bucket, prefix, output_path, manifest):
+    for file in manifest['files'] + [model_artifact.MANIFEST_NAME]:
+        s3_client.upload_file(os.path.join(output_path, file), bucket,
+                              f'{prefix}/{file}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='compare model artifact formats by pack/unpack time and size')
+    parser.add_argument('--model-path', type=str, default=None,
+                        help='trained AutoGluon directory (synthetic data if omitted)')
+    parser.add_argument('--num-of-models', type=int, default=8, metavar='N',
+                        help='number of models in synthetic data')
+    parser.add_argument('--model-size', type=int, default=32, metavar='MB',
+                        help='size of each model in synthetic data')
+    parser.add_argument('--threads', type=int, default=os.cpu_count() or 1,
+                        metavar='N', help='threads for compression and download')
+    parser.add_argument('--s3-uri', type=str, default=None,
+                        help='s3://bucket/prefix to measure unpack time from S3')
+    args = parser.parse_args()
+
+    s3_client = None
+    if args.s3_uri:
+        import boto3
+        s3_client = boto3.client('s3')
+        bucket = args.s3_uri.split('/')[2]
+        prefix = args.s3_uri[6+len(bucket):].strip('/')
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        model_path = args.model_path
+        if model_path is None:
+            model_path = os.path.join(tmpdir, 'source')
+            make_model_dir(model_path, args.num_of_models, args.model_size)
+        print(f'model: {model_artifact.get_dir_size(model_path) / 1024 / 1024:.1f} MB, '
+              f'threads: {args.threads}')
+        print(f"{'format':<14}{'size(MB)':>10}{'ratio':>8}"
+              f"{'pack(s)':>10}{'unpack(s)':>11}")
+
+        for format_name, level in CASES:
+            name = f'{format_name}-{level}' if level is not None else format_name
+            output_path = os.path.join(tmpdir, name)
+            os.makedirs(output_path)
+            manifest = model_artifact.pack(model_path, output_path, format_name,
+                                           level, args.threads)
+
+            unpack_path = os.path.join(tmpdir, 'unpack')
+            if s3_client:
+                upload(s3_client, bucket, f'{prefix}/{name}', output_path, manifest)
+                os.makedirs(unpack_path)
+                unpack_seconds = model_artifact.fetch(
+                    s3_client, bucket, f'{prefix}/{name}', unpack_path,
+                    args.threads)['unpack_seconds']
+            else:
+                start = time.perf_counter()
+                unpack_local(output_path, manifest, unpack_path)
+                unpack_seconds = time.perf_counter() - start
+            shutil.rmtree(unpack_path)
+            shutil.rmtree(output_path)
+
+            print(f"{name:<14}{manifest['bytes'] / 1024 / 1024:>10.1f}"
+                  f"{manifest['bytes'] / manifest['raw_bytes']:>8.2f}"
+                  f"{manifest['pack_seconds']:>10.2f}{unpack_seconds:>11.2f}")
@@ -0,0 +1,118 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'code', 'sagemaker', 'common'))
+from dataset_io import get_dataset_path, read_dataset, write_dataset  # noqa: E402
+
+LABEL = 'medianHouseValue'
+CASES = [
+    ('csv', None),
+    ('parquet', 'snappy'),
+    ('parquet', 'zstd'),
+    ('arrow', 'lz4'),
+    ('arrow', 'zstd'),
+]
+
+
+def make_housing_df(num_of_rows, random_state=0):
+    # California Housing と同じ列構成のダミーデータ
+    rng = np.random.RandomState(random_state)
+    return pd.DataFrame({
+        'longitude': rng.uniform(-124.3, -114.3, num_of_rows).round(2),
+        'latitude': rng.uniform(32.5, 42.0, num_of_rows).round(2),
+        'housingMedianAge': rng.randint(1, 53, num_of_rows).astype(float),
+        'totalRooms': rng.randint(2, 40000, num_of_rows).astype(float),
+        'totalBedrooms': rng.randint(1, 6500, num_of_rows).astype(float),
+        'population': rng.randint(3, 36000, num_of_rows).astype(float),
+        'households': rng.randint(1, 6100, num_of_rows).astype(float),
+        'medianIncome': rng.uniform(0.5, 15.0, num_of_rows).round(4),
+        'medianHouseValue': rng.uniform(15000, 500001, num_of_rows).round(0),
+    })
+
+
+def measure(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def measure_s3(s3_client, bucket, key, path, repeat):
+    upload_time, _ = measure(lambda: s3_client.upload_file(path, bucket, key), repeat)
+    download_path = path + '.download'
+    download_time, _ = measure(
+        lambda: s3_client.download_file(bucket, key, download_path), repeat)
+    s3_client.delete_object(Bucket=bucket, Key=key)
+    os.remove(download_path)
+    return upload_time, download_time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='compare dataset formats by parse time and bytes moved through S3')
+    parser.add_argument('--input', type=str, default=None,
+                        help='CSV file to benchmark (synthetic data if omitted)')
+    parser.add_argument('--num-of-rows', type=int, default=1000000, metavar='N',
+                        help='number of rows of synthetic data')
+    parser.add_argument('--repeat', type=int, default=3, metavar='N',
+                        help='number of repetitions (best time is reported)')
+    parser.add_argument('--s3-uri', type=str, default=None,
+                        help='s3://bucket/prefix to measure upload/download time')
+    args = parser.parse_args()
+
+    if args.input:
+        df = pd.read_csv(args.input)
+    else:
+        df = make_housing_df(args.num_of_rows)
+    print(f'rows: {len(df)}, columns: {len(df.columns)}')
+
+    s3_client = None
+    if args.s3_uri:
+        import boto3
+        s3_client = boto3.client('s3')
+        bucket = args.s3_uri.split('/')[2]
+        prefix = args.s3_uri[6+len(bucket):].strip('/')
+
+    header = (f"{'format':<18}{'size(MB)':>10}{'write(s)':>10}"
+              f"{'read(s)':>10}{'read-label(s)':>15}")
+    if s3_client:
+        header += f"{'upload(s)':>11}{'download(s)':>13}"
+    print(header)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for format_name, compression in CASES:
+            name = f'{format_name}-{compression}' if compression else format_name
+            path = get_dataset_path(tmpdir, name, format_name)
+            write_time, _ = measure(
+                lambda: write_dataset(df, path, compression), args.repeat)
+            read_time, _ = measure(lambda: read_dataset(path), args.repeat)
+            # pred.py と同じく正解ラベルを除いて読み込む場合
+            projected_time, _ = measure(
+                lambda: read_dataset(path, exclude=[LABEL]), args.repeat)
+            size = os.path.getsize(path) / 1024 / 1024
+            line = (f'{name:<18}{size:>10.2f}{write_time:>10.3f}'
+                    f'{read_time:>10.3f}{projected_time:>15.3f}')
+            if s3_client:
+                key = f'{prefix}/{os.path.basename(path)}'
+                upload_time, download_time = measure_s3(
+                    s3_client, bucket, key, path, args.repeat)
+                line += f'{upload_time:>11.3f}{download_time:>13.3f}'
+            print(line)
+            results.append((name, size, read_time))
+
+    csv_size, csv_read_time = results[0][1], results[0][2]
+    print('')
+    print('relative to csv:')
+    for name, size, read_time in results[1:]:
+        print(f'{name:<18} bytes x{size / csv_size:.2f}, '
+              f'parse x{read_time / csv_read_time:.2f}')
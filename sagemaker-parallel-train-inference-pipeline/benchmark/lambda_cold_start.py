@@ -0,0 +1,173 @@
+import argparse
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta, timezone
+import importlib.util
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          '..', 'code', 'lambda')
+FUNCTIONS = ['start-pipeline', 'notification']
+REGION = 'us-east-1'
+STATE_MACHINE_ARN = f'arn:aws:states:{REGION}:123456789012:stateMachine:ml-pipeline'
+ENVS = {
+    'AWS_DEFAULT_REGION': REGION,
+    'AWS_ACCESS_KEY_ID': 'testing',
+    'AWS_SECRET_ACCESS_KEY': 'testing',
+    'AWS_EC2_METADATA_DISABLED': 'true',
+    'STEPFUNCTION_ARN': STATE_MACHINE_ARN,
+    'BUCKET_NAME': 'bucket',
+    'PREFIX': 'prefix',
+    'METRIC_THRESHOLD': '30000',
+    'SNS_TOPIC_ARN': f'arn:aws:sns:{REGION}:123456789012:topic',
+}
+
+
+class Context:
+    def __init__(self, function_name):
+        self.function_name = function_name
+        self.memory_limit_in_mb = 128
+
+
+def get_event(function_name):
+    if function_name == 'start-pipeline':
+        return {'Records': [{'s3': {'bucket': {'name': 'bucket'},
+                                    'object': {'key': 'prefix/input/data.zip'}}}]}
+    execution_arn = f'arn:aws:states:{REGION}:123456789012:execution:ml-pipeline:x'
+    return {'status': 'Succeeded',
+            'param': {'ProcessingJobName': 'ml-train',
+                      'Tags': {'AWS_STEP_FUNCTIONS_EXECUTION_ARN': execution_arn}}}
+
+
+def get_response(operation_name, request):
+    # 各 API の最小限のレスポンス（HTTP リクエストは送らない）
+    from botocore.response import StreamingBody
+    now = datetime.now(timezone.utc)
+    if operation_name == 'ListObjectsV2':
+        return {'Contents': [{'Key': 'prefix/input/data.zip', 'Size': 50 * 1024 * 1024}],
+                'IsTruncated': False}
+    if operation_name == 'GetObject' and 'Range' not in request['headers']:
+        # 前処理の差分処理の状態（latest.json）はない（初回の実行）
+        return {'Error': {'Code': 'NoSuchKey', 'Message': 'The specified key does not exist.'}}
+    if operation_name == 'GetObject':
+        body = b'1.0,2.0,3.0,4.0,5.0,6.0,7.0,8.0\n' * 2000
+        return {'Body': StreamingBody(io.BytesIO(body), len(body))}
+    if operation_name == 'ListExecutions':
+        return {'executions': [{'executionArn': f'{STATE_MACHINE_ARN}:{i}',
+                                'stateMachineArn': STATE_MACHINE_ARN, 'name': str(i),
+                                'status': 'SUCCEEDED', 'startDate': now} for i in range(3)]}
+    if operation_name == 'GetExecutionHistory':
+        plan = {'rows': 1000000, 'train_instance_count': 2}
+        return {'events': [
+            {'timestamp': now - timedelta(hours=2), 'type': 'ExecutionStarted', 'id': 1,
+             'executionStartedEventDetails': {'input': json.dumps({'Plan': plan})}},
+            {'timestamp': now - timedelta(hours=1), 'type': 'TaskStateEntered', 'id': 2,
+             'stateEnteredEventDetails': {'name': 'Model Training'}},
+            {'timestamp': now, 'type': 'TaskStateExited', 'id': 3,
+             'stateExitedEventDetails': {'name': 'Model Training'}}]}
+    if operation_name == 'StartExecution':
+        return {'executionArn': f'{STATE_MACHINE_ARN}:new', 'startDate': now}
+    if operation_name == 'Publish':
+        return {'MessageId': '00000000-0000-0000-0000-000000000000'}
+    raise ValueError(f'no stub response for {operation_name}')
+
+
+def stub_clients(boto3):
+    # クライアントの作成は本物（作成にかかる時間も測る）で、API の呼び出しだけを before-call で返す
+    from botocore.awsrequest import AWSResponse
+    create_client = boto3.client
+
+    def respond(model, params, **kwargs):
+        response = get_response(model.name, params)
+        return AWSResponse(None, 404 if 'Error' in response else 200, {}, None), response
+
+    def client(*args, **kwargs):
+        c = create_client(*args, **kwargs)
+        c.meta.events.register('before-call', respond)
+        return c
+    boto3.client = client
+
+
+def run_child(function_name, invocations):
+    # 新しいプロセスでハンドラーを読み込み（コールドスタート）、続けて呼び出す（ウォームスタート）
+    os.environ.update(ENVS)
+    # zip と同じく、共通モジュールを index.py と同じ場所から読み込めるようにする
+    sys.path.append(os.path.join(LAMBDA_DIR, 'common'))
+    start = time.perf_counter()
+    spec = importlib.util.spec_from_file_location(
+        function_name.replace('-', '_'), os.path.join(LAMBDA_DIR, function_name, 'index.py'))
+    module = importlib.util.module_from_spec(spec)
+    with redirect_stdout(io.StringIO()):
+        spec.loader.exec_module(module)
+    import_ms = (time.perf_counter() - start) * 1000
+    # 読み込みの時点でクライアントが作られていないこと（遅延作成になっていること）を確認する
+    timing = sys.modules['lambda_timing']
+    assert not timing.clients, f'clients created at import: {list(timing.clients)}'
+    stub_clients(timing.boto3)
+
+    records = []
+    for _ in range(invocations):
+        out = io.StringIO()
+        with redirect_stdout(out):
+            module.lambda_handler(get_event(function_name), Context(function_name))
+        for line in out.getvalue().splitlines():
+            if line.startswith('{') and '"type": "timing"' in line:
+                records.append(json.loads(line))
+    print(json.dumps({'import_ms': import_ms, 'records': records}))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def print_row(name, values):
+    print(f'{name:<36}{percentile(values, 50):>10.1f}{percentile(values, 99):>10.1f}'
+          f'{max(values) if values else 0.0:>10.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='measure cold and warm start latency of the Lambda handlers with stubbed AWS clients')
+    parser.add_argument('--function', type=str, default=None, choices=FUNCTIONS,
+                        help='handler to measure (all if omitted)')
+    parser.add_argument('--cold-starts', type=int, default=20, metavar='N',
+                        help='number of processes (each one is a cold start)')
+    parser.add_argument('--invocations', type=int, default=20, metavar='N',
+                        help='invocations per process (the first one is cold, the rest are warm)')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.function, args.invocations)
+        sys.exit(0)
+
+    print(f'{"":<36}{"p50 ms":>10}{"p99 ms":>10}{"max ms":>10}')
+    for function_name in [args.function] if args.function else FUNCTIONS:
+        import_ms, init_ms, cold, warm, client_ms = [], [], [], [], []
+        for _ in range(args.cold_starts):
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--child',
+                 '--function', function_name, '--invocations', str(args.invocations)],
+                check=True, stdout=subprocess.PIPE).stdout
+            result = json.loads(output.decode('utf-8').splitlines()[-1])
+            import_ms.append(result['import_ms'])
+            for record in result['records']:
+                if record['cold_start']:
+                    init_ms.append(record['init_ms'])
+                    cold.append(record['handler_ms'])
+                    client_ms.append(record['client_ms'])
+                else:
+                    warm.append(record['handler_ms'])
+        print(function_name)
+        print_row('  import (measured outside)', import_ms)
+        print_row('  init (init_ms)', init_ms)
+        print_row('  handler, cold', cold)
+        print_row('  client creation, cold', client_ms)
+        print_row('  handler, warm', warm)
@@ -0,0 +1,79 @@
+import argparse
+import os
+import sys
+import time
+
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'code', 'sagemaker', 'common'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'code', 'sagemaker', 'pred'))
+from dataset_io import read_dataset  # noqa: E402
+import parallel_predict  # noqa: E402
+from resources import get_cpu_count  # noqa: E402
+from schema import LABEL  # noqa: E402
+
+
+def measure(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='measure rows/sec of pred.py parallel inference by number of workers')
+    parser.add_argument('--model-path', type=str, required=True,
+                        help='trained AutoGluon directory (unpacked model artifact)')
+    parser.add_argument('--input', type=str, required=True,
+                        help='prediction data (csv, parquet or arrow)')
+    parser.add_argument('--num-of-rows', type=int, default=0, metavar='N',
+                        help='rows used for the benchmark (0: all rows)')
+    parser.add_argument('--workers', type=str, default=None,
+                        help='comma separated numbers of workers (default: 1, 2, 4, ... CPUs)')
+    parser.add_argument('--repeat', type=int, default=3, metavar='N',
+                        help='number of repetitions (best time is reported)')
+    args = parser.parse_args()
+
+    df = read_dataset(args.input, exclude=[LABEL])
+    if args.num_of_rows:
+        df = df.head(args.num_of_rows)
+
+    num_cpus = get_cpu_count()
+    if args.workers:
+        workers = [int(w) for w in args.workers.split(',')]
+    else:
+        workers = []
+        n = 1
+        while n < num_cpus:
+            workers.append(n)
+            n *= 2
+        workers.append(num_cpus)
+    print(f'rows: {len(df)}, cpus: {num_cpus}')
+    print(f"{'workers':>8}{'load(s)':>10}{'predict(s)':>12}{'rows/sec':>12}{'speedup':>9}")
+
+    expected = None
+    baseline = None
+    for num_of_workers in workers:
+        start = time.perf_counter()
+        executor = parallel_predict.create_executor(args.model_path, num_of_workers)
+        parallel_predict.warm_up(executor, num_of_workers)
+        load_time = time.perf_counter() - start
+        with executor:
+            predict_time, result = measure(
+                lambda: parallel_predict.predict(executor, df, num_of_workers),
+                args.repeat)
+
+        # 並列数によらず、元の行の順序で同じ結果になることを確認する
+        if expected is None:
+            expected = result
+        pd.testing.assert_series_equal(result, expected)
+
+        rows_per_sec = len(df) / predict_time
+        baseline = baseline or rows_per_sec
+        print(f'{num_of_workers:>8}{load_time:>10.2f}{predict_time:>12.3f}'
+              f'{rows_per_sec:>12.0f}{rows_per_sec / baseline:>9.2f}')
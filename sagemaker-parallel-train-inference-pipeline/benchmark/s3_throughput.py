@@ -0,0 +1,87 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'code', 'sagemaker', 'common'))
+import storage  # noqa: E402
+
+
+def measure(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def read_all(stream):
+    with stream:
+        while stream.read(1024 * 1024):
+            pass
+
+
+def print_result(name, seconds, num_of_bytes):
+    print(f'{name:<36}{seconds:>10.3f}{num_of_bytes / 1024 / 1024 / seconds:>12.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='compare serial and concurrent S3 reads of the storage module')
+    parser.add_argument('--s3-uri', type=str, required=True,
+                        help='s3://bucket/prefix where test objects are written (and deleted)')
+    parser.add_argument('--num-of-objects', type=int, default=64, metavar='N',
+                        help='number of small objects')
+    parser.add_argument('--object-size', type=int, default=256, metavar='KB',
+                        help='size of each small object')
+    parser.add_argument('--large-size', type=int, default=256, metavar='MB',
+                        help='size of the large object')
+    parser.add_argument('--threads', type=int, default=16, metavar='N',
+                        help='concurrent requests')
+    parser.add_argument('--repeat', type=int, default=3, metavar='N',
+                        help='number of repetitions (best time is reported)')
+    args = parser.parse_args()
+
+    s3_client = storage.get_client()
+    bucket, prefix = storage.split_s3_uri(args.s3_uri)
+    small_keys = [f'{prefix}/small/{i:05d}' for i in range(args.num_of_objects)]
+    large_key = f'{prefix}/large'
+    small_bytes = args.object_size * 1024
+    large_bytes = args.large_size * 1024 * 1024
+
+    for key in small_keys:
+        s3_client.put_object(Bucket=bucket, Key=key, Body=os.urandom(small_bytes))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'large')
+        with open(path, 'wb') as f:
+            for _ in range(args.large_size):
+                f.write(os.urandom(1024 * 1024))
+        s3_client.upload_file(path, bucket, large_key,
+                              Config=storage.get_transfer_config(args.threads))
+
+        print(f"{'case':<36}{'time(s)':>10}{'MB/s':>12}")
+        total = small_bytes * args.num_of_objects
+        print_result(f'{args.num_of_objects} objects, serial', measure(
+            lambda: [storage.get_bytes(s3_client, bucket, key) for key in small_keys],
+            args.repeat), total)
+        print_result(f'{args.num_of_objects} objects, {args.threads} threads', measure(
+            lambda: storage.fetch_objects(s3_client, bucket, small_keys, args.threads),
+            args.repeat), total)
+
+        print_result('large object, single stream', measure(
+            lambda: read_all(s3_client.get_object(Bucket=bucket, Key=large_key)['Body']),
+            args.repeat), large_bytes)
+        print_result(f'large object, ranged stream x{args.threads}', measure(
+            lambda: read_all(storage.open_stream(s3_client, bucket, large_key,
+                                                 args.threads, large_bytes)),
+            args.repeat), large_bytes)
+        print_result(f'large object, download_file x{args.threads}', measure(
+            lambda: storage.download_file(s3_client, bucket, large_key,
+                                          path + '.download', args.threads),
+            args.repeat), large_bytes)
+
+    for key in small_keys + [large_key]:
+        s3_client.delete_object(Bucket=bucket, Key=key)
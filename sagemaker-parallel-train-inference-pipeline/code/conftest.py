@@ -0,0 +1,20 @@
+import boto3
+from moto import mock_aws
+import pytest
+
+
+@pytest.fixture
+def bucket():
+    return 'bucket'
+
+
+@pytest.fixture
+def s3_client(monkeypatch, bucket):
+    # moto の S3 にバケットを作成する（Lambda 関数のテストでも同じものを使う）
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    with mock_aws():
+        s3_client = boto3.client('s3', region_name='us-east-1')
+        s3_client.create_bucket(Bucket=bucket)
+        yield s3_client
@@ -0,0 +1,65 @@
+import time
+INIT_START = time.perf_counter()
+
+from contextlib import contextmanager
+import boto3
+import json
+import os
+
+# 各 Lambda 関数の index.py と同じ場所に配置し、index.py の最初に読み込む
+# （index.py の読み込みの最後に end_init を呼び、ここからの時間をコールドスタート時の初期化の時間とする）
+
+# モジュールの読み込み（コールドスタート時の初期化）にかけてよい時間
+INIT_BUDGET_MS = float(os.environ.get('INIT_BUDGET_MS', '300'))
+
+# クライアントは最初に使うときに作り、ウォームスタートでは使い回す
+clients = {}
+client_seconds = 0.0
+cold_start = True
+init_ms = 0.0
+
+
+def end_init():
+    global init_ms
+    init_ms = (time.perf_counter() - INIT_START) * 1000
+
+
+def get_client(name):
+    global client_seconds
+    if name not in clients:
+        start = time.perf_counter()
+        clients[name] = boto3.client(name)
+        client_seconds += time.perf_counter() - start
+    return clients[name]
+
+
+def emit_timing(context, handler_start):
+    # 呼び出しごとに 1 行の JSON（type = timing）を出力し、CloudWatch Logs Insights で集計する
+    global cold_start
+    record = {
+        'type': 'timing',
+        'function': getattr(context, 'function_name', None),
+        'cold_start': cold_start,
+        'init_ms': init_ms if cold_start else 0.0,
+        'init_budget_ms': INIT_BUDGET_MS,
+        'client_ms': client_seconds * 1000,
+        'handler_ms': (time.perf_counter() - handler_start) * 1000,
+        'memory_limit_mb': getattr(context, 'memory_limit_in_mb', None),
+    }
+    if cold_start and init_ms > INIT_BUDGET_MS:
+        print(f'WARN: init took {init_ms:.0f} ms (budget {INIT_BUDGET_MS:.0f} ms)')
+    print(json.dumps(record))
+    cold_start = False
+    return record
+
+
+@contextmanager
+def timing(context):
+    # ハンドラーの処理時間と、その中でクライアントの作成にかかった時間を記録する
+    global client_seconds
+    handler_start = time.perf_counter()
+    client_seconds = 0.0
+    try:
+        yield
+    finally:
+        emit_timing(context, handler_start)
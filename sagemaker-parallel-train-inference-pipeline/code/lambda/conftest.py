@@ -0,0 +1,15 @@
+import os
+import sys
+
+import pytest
+
+# 各 Lambda 関数の zip には common のモジュールを index.py と同じ場所に入れるので、テストでも同じように読み込む
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'common'))
+
+
+@pytest.fixture(autouse=True)
+def reset_lambda_timing(monkeypatch):
+    # Lambda 関数のコンテナと同じく、テストごとにクライアントを作り直す（前のテストの moto のクライアントを使わない）
+    import lambda_timing
+    monkeypatch.setattr(lambda_timing, 'clients', {})
+    monkeypatch.setattr(lambda_timing, 'cold_start', True)
@@ -1,15 +1,11 @@
-import yaml
-import boto3
+# コールドスタート時の初期化の時間を測るため、最初に読み込む
+from lambda_timing import end_init, get_client, timing
 import json
-from datetime import datetime
-from dateutil import tz
 import os
 
-sns_client = boto3.client('sns')
-
 
 def publish_message(sns_topic_arn, message, subject):
-    response = sns_client.publish(
+    response = get_client('sns').publish(
         TopicArn=sns_topic_arn,
         Message=message,
         Subject=subject
@@ -19,9 +15,11 @@ def publish_message(sns_topic_arn, message, subject):
 
 
 def lambda_handler(event, context):
-    JST = tz.gettz('Asia/Tokyo')
-    timestamp = datetime.now(JST).strftime('%Y%m%d-%H%M%S')
+    with timing(context):
+        return notify(event, context)
+
 
+def notify(event, context):
     print('event', event)
     print('context', context)
 
@@ -42,8 +40,12 @@ def lambda_handler(event, context):
 '''
 
     publish_message(SNS_TOPIC_ARN, message, status)
-    
+
     return {
         'statusCode': 200,
         'body': json.dumps('Hello from Lambda!')
     }
+
+
+end_init()
+
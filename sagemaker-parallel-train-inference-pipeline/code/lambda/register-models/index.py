@@ -0,0 +1,81 @@
+# コールドスタート時の初期化の時間を測るため、最初に読み込む
+from lambda_timing import end_init, get_client, timing
+import json
+
+# 学習ジョブの各インスタンスが書き出した registry-<host>.json を、学習ステップの後に registry.json にまとめる
+# （推論は registry.json を読むだけで、学習の出力先には書き込まない）
+# 学習したモデルのキャッシュのエントリも、モデルのアップロードが終わったこのタイミングで登録する
+REGISTRY_NAME = 'registry.json'
+PART_PREFIX = 'registry-'
+
+
+def get_object_json(bucket, key):
+    body = get_client('s3').get_object(Bucket=bucket, Key=key)['Body'].read()
+    return json.loads(body.decode('utf-8'))
+
+
+def load_parts(bucket, prefix):
+    parts = []
+    paginator = get_client('s3').get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=f'{prefix}/{PART_PREFIX}'):
+        for obj in page.get('Contents', []):
+            parts.append(get_object_json(bucket, obj['Key']))
+    return parts
+
+
+def split_s3_uri(uri):
+    bucket, key = uri[5:].split('/', 1)
+    return bucket, key.rstrip('/')
+
+
+def object_exists(bucket, key):
+    try:
+        get_client('s3').head_object(Bucket=bucket, Key=key)
+    except get_client('s3').exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ['NoSuchKey', '404']:
+            return False
+        raise
+    return True
+
+
+def register_cache(cache):
+    # 学習したモデルがすべて S3 にアップロードされていることを確認してから、学習の再利用のキャッシュに登録する
+    registered = 0
+    for entry in cache['entries']:
+        missing = [file for file in entry['files']
+                   if not object_exists(*split_s3_uri(f"{entry['uri']}/{file}"))]
+        if missing:
+            print(f"WARN: {entry['uri']} is not registered, missing {missing}")
+            continue
+        bucket, key = split_s3_uri(f"{cache['uri']}/{entry['fingerprint']}.json")
+        get_client('s3').put_object(Bucket=bucket, Key=key,
+                                    Body=json.dumps(entry, indent=2).encode('utf-8'))
+        registered += 1
+    return registered
+
+
+def register_models(train_output):
+    bucket, prefix = split_s3_uri(train_output)
+    parts = load_parts(bucket, prefix)
+    if not parts:
+        # 学習ジョブは成功したインスタンスごとに必ず書き出すので、ない場合は出力先が誤っている
+        raise RuntimeError(f'no {PART_PREFIX}*.json in {train_output}')
+    models = {}
+    for part in parts:
+        models.update(part['models'])
+    get_client('s3').put_object(Bucket=bucket, Key=f'{prefix}/{REGISTRY_NAME}',
+                                Body=json.dumps({'models': models}).encode('utf-8'))
+    print(f'merged {len(parts)} parts ({len(models)} models) into '
+          f's3://{bucket}/{prefix}/{REGISTRY_NAME}')
+    cached = sum(register_cache(part['cache']) for part in parts if part.get('cache'))
+    print(f'registered {cached} models to the cache')
+    return {'parts': len(parts), 'models': len(models), 'cached': cached}
+
+
+def lambda_handler(event, context):
+    with timing(context):
+        print(event)
+        return register_models(event['train_output'])
+
+
+end_init()
@@ -0,0 +1,62 @@
+import importlib.util
+import json
+import os
+
+import boto3
+import pytest
+
+BUCKET = 'bucket'
+PREFIX = 'prefix/train/job'
+
+
+@pytest.fixture
+def index(s3_client):
+    # 他の Lambda 関数の index.py と区別するため、ファイルから別の名前で読み込む
+    spec = importlib.util.spec_from_file_location(
+        'register_models', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'index.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def put_json(key, obj):
+    boto3.client('s3').put_object(Bucket=BUCKET, Key=key, Body=json.dumps(obj).encode('utf-8'))
+
+
+def get_json(key):
+    body = boto3.client('s3').get_object(Bucket=BUCKET, Key=key)['Body'].read()
+    return json.loads(body.decode('utf-8'))
+
+
+def test_register_models_merges_parts(index):
+    put_json(f'{PREFIX}/registry-algo-1.json', {'host': 'algo-1', 'models': {'000': {'MAE': 1.0}}})
+    put_json(f'{PREFIX}/registry-algo-2.json', {'host': 'algo-2', 'models': {'001': {'MAE': 2.0}}})
+    # 別の学習ジョブの出力は含めない
+    put_json('prefix/train/job-2/registry-algo-1.json', {'models': {'009': {'MAE': 9.0}}})
+    result = index.lambda_handler({'train_output': f's3://{BUCKET}/{PREFIX}/'}, None)
+    assert result == {'parts': 2, 'models': 2, 'cached': 0}
+    assert get_json(f'{PREFIX}/registry.json') == {
+        'models': {'000': {'MAE': 1.0}, '001': {'MAE': 2.0}}}
+
+
+def test_register_models_without_parts(index):
+    with pytest.raises(RuntimeError):
+        index.lambda_handler({'train_output': f's3://{BUCKET}/{PREFIX}'}, None)
+
+
+def test_register_models_registers_uploaded_models(index):
+    cache = {'uri': f's3://{BUCKET}/prefix/train/_cache', 'entries': [
+        {'fingerprint': 'fp0', 'uri': f's3://{BUCKET}/{PREFIX}/000', 'files': ['eval.yml', 'model.zip']},
+        {'fingerprint': 'fp1', 'uri': f's3://{BUCKET}/{PREFIX}/001', 'files': ['eval.yml', 'model.zip']},
+    ]}
+    put_json(f'{PREFIX}/registry-algo-1.json', {'models': {'000': {}, '001': {}}, 'cache': cache})
+    for file in ['eval.yml', 'model.zip']:
+        put_json(f'{PREFIX}/000/{file}', {})
+    # 001 はアップロードされていない（途中で失敗した）ので登録しない
+    put_json(f'{PREFIX}/001/eval.yml', {})
+    result = index.lambda_handler({'train_output': f's3://{BUCKET}/{PREFIX}'}, None)
+    assert result['cached'] == 1
+    assert get_json('prefix/train/_cache/fp0.json') == cache['entries'][0]
+    keys = [obj['Key'] for obj in boto3.client('s3').list_objects_v2(
+        Bucket=BUCKET, Prefix='prefix/train/_cache/')['Contents']]
+    assert keys == ['prefix/train/_cache/fp0.json']
@@ -1,26 +1,46 @@
-import boto3
+# コールドスタート時の初期化の時間を測るため、最初に読み込む
+from lambda_timing import end_init, get_client, timing
+from concurrent.futures import ThreadPoolExecutor
 import json
-from datetime import datetime
-from dateutil import tz
+from datetime import datetime, timedelta, timezone
+import math
 import os
-import urllib
+import urllib.parse
 import uuid
 
-sns_client = boto3.client('sns')
-sfn_client = boto3.client('stepfunctions')
-ecr_client = boto3.client('ecr')
-jmespath_expression = 'sort_by(imageDetails, &to_string(imagePushedAt))[-1].imageTags'
-client_paginator = ecr_client.get_paginator('describe_images')
-JST = tz.gettz('Asia/Tokyo')
+# 日本は夏時間がないので、dateutil を読み込まずに固定のオフセットで扱う
+JST = timezone(timedelta(hours=9), 'JST')
 
 STEPFUNCTION_ARN = os.environ['STEPFUNCTION_ARN']
 BUCKET_NAME = os.environ['BUCKET_NAME']
 PREFIX = os.environ['PREFIX']
 METRIC_THRESHOLD = os.environ['METRIC_THRESHOLD']
+TRAIN_MAX_RUNTIME = os.environ.get('TRAIN_MAX_RUNTIME', '86400')
+
+# 入力データの大きさから、セグメント数と各ステップのインスタンス数を決める
+# - セグメント数: NUM_OF_SEGMENT 以上 MAX_OF_SEGMENT 以下で、1 セグメントが ROWS_PER_SEGMENT 行程度になる数
+#   前回の prep の出力（差分処理の manifest）がある場合は、REBUILD_FACTOR 倍以上に増えるまで前回と同じ数にする
+#   （セグメント数が変わると、prep は差分処理ではなく全件を作り直す）
+# - 学習のインスタンス数: 過去の学習ステップの時間から、学習が TARGET_RUNTIME 秒程度で終わる数（履歴がなければ行数から）
+# - 推論のインスタンス数: PRED_ROWS_PER_INSTANCE 行ごとに 1 インスタンス
+NUM_OF_SEGMENT = int(os.environ.get('NUM_OF_SEGMENT', '2'))
+MAX_OF_SEGMENT = int(os.environ.get('MAX_OF_SEGMENT', str(NUM_OF_SEGMENT * 8)))
+ROWS_PER_SEGMENT = int(os.environ.get('ROWS_PER_SEGMENT', '1000000'))
+MAX_INSTANCE_COUNT = int(os.environ.get('MAX_INSTANCE_COUNT', '10'))
+TARGET_RUNTIME = int(os.environ.get('TARGET_RUNTIME', '3600'))
+TRAIN_ROWS_PER_INSTANCE = int(os.environ.get('TRAIN_ROWS_PER_INSTANCE', '1000000'))
+PRED_ROWS_PER_INSTANCE = int(os.environ.get('PRED_ROWS_PER_INSTANCE', '5000000'))
+REBUILD_FACTOR = float(os.environ.get('REBUILD_FACTOR', '2'))
+PREP_STATE_URI = f's3://{BUCKET_NAME}/{PREFIX}/prep/_state'
+DEFAULT_BYTES_PER_ROW = 100
+SAMPLE_BYTES = 64 * 1024
+HISTORY_SIZE = 10
+# pipeline.py の学習ステップの名前
+TRAIN_STEP_NAME = 'Model Training'
 
 
 def publish_message(sns_topic_arn, message):
-    response = sns_client.publish(
+    response = get_client('sns').publish(
         TopicArn=sns_topic_arn,
         Message=message,
         Subject="ML Pipeline Started."
@@ -29,13 +49,249 @@ def publish_message(sns_topic_arn, message):
     return response
 
 
+def get_input_size(bucket, prefix):
+    # 入力データの合計サイズ（LIST のみでオブジェクトは読まない）
+    total_bytes = 0
+    largest = None
+    paginator = get_client('s3').get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix.strip('/') + '/'):
+        for obj in page.get('Contents', []):
+            total_bytes += obj['Size']
+            if largest is None or obj['Size'] > largest['Size']:
+                largest = obj
+    return total_bytes, largest
+
+
+def read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return result, pos
+
+
+def skip_thrift(buf, pos, type_id):
+    # Thrift compact protocol の値を 1 つ読み飛ばす（parquet のフッターの FileMetaData 用）
+    if type_id in (1, 2):
+        return pos
+    if type_id == 3:
+        return pos + 1
+    if type_id in (4, 5, 6):
+        return read_varint(buf, pos)[1]
+    if type_id == 7:
+        return pos + 8
+    if type_id == 8:
+        size, pos = read_varint(buf, pos)
+        return pos + size
+    if type_id in (9, 10):
+        size, element_type = buf[pos] >> 4, buf[pos] & 0x0f
+        pos += 1
+        if size == 15:
+            size, pos = read_varint(buf, pos)
+        for _ in range(size):
+            # リストの要素の bool は 1 バイトで表す
+            pos = pos + 1 if element_type in (1, 2) else skip_thrift(buf, pos, element_type)
+        return pos
+    if type_id == 11:
+        size, pos = read_varint(buf, pos)
+        if not size:
+            return pos
+        key_type, value_type = buf[pos] >> 4, buf[pos] & 0x0f
+        pos += 1
+        for _ in range(size):
+            for element_type in (key_type, value_type):
+                pos = pos + 1 if element_type in (1, 2) else skip_thrift(buf, pos, element_type)
+        return pos
+    if type_id == 12:
+        while buf[pos]:
+            header = buf[pos]
+            pos += 1
+            if not header >> 4:
+                pos = read_varint(buf, pos)[1]
+            pos = skip_thrift(buf, pos, header & 0x0f)
+        return pos + 1
+    raise ValueError(f'unknown thrift type: {type_id}')
+
+
+def get_parquet_rows(bucket, obj):
+    # parquet はフッター（FileMetaData）の num_rows（フィールド 3）から行数を取り出す
+    # 末尾 8 バイトはフッターの長さ（リトルエンディアン）と PAR1
+    body = get_client('s3').get_object(Bucket=bucket, Key=obj['Key'],
+                                       Range=f'bytes=-{min(SAMPLE_BYTES, obj["Size"])}')['Body'].read()
+    if len(body) < 8 or body[-4:] != b'PAR1':
+        return None
+    length = int.from_bytes(body[-8:-4], 'little')
+    if length + 8 > len(body):
+        body = get_client('s3').get_object(Bucket=bucket, Key=obj['Key'],
+                                           Range=f'bytes=-{length + 8}')['Body'].read()
+    metadata = body[-8 - length:-8]
+    pos = 0
+    field_id = 0
+    while metadata[pos]:
+        header = metadata[pos]
+        pos += 1
+        if header >> 4:
+            field_id += header >> 4
+        else:
+            value, pos = read_varint(metadata, pos)
+            field_id = (value >> 1) ^ -(value & 1)
+        if field_id == 3 and header & 0x0f == 6:
+            value = read_varint(metadata, pos)[0]
+            return (value >> 1) ^ -(value & 1)
+        pos = skip_thrift(metadata, pos, header & 0x0f)
+    return None
+
+
+def get_bytes_per_row(bucket, obj):
+    # 一番大きいファイルから 1 行あたりのバイト数を見積もる
+    # - CSV: 先頭だけを読んで改行を数える
+    # - parquet: フッターの行数を使う
+    # - arrow など、その他の列指向の形式: 既定値を使う
+    if obj is None or not obj['Size']:
+        return DEFAULT_BYTES_PER_ROW
+    extension = os.path.splitext(obj['Key'])[1].lower()
+    if extension == '.parquet':
+        try:
+            num_of_rows = get_parquet_rows(bucket, obj)
+        except (IndexError, ValueError) as e:
+            print(f'WARN: failed to read the parquet footer of {obj["Key"]}: {e}')
+            num_of_rows = None
+        if not num_of_rows:
+            return DEFAULT_BYTES_PER_ROW
+        return obj['Size'] / num_of_rows
+    if extension != '.csv':
+        return DEFAULT_BYTES_PER_ROW
+    body = get_client('s3').get_object(Bucket=bucket, Key=obj['Key'],
+                                       Range=f'bytes=0-{SAMPLE_BYTES - 1}')['Body'].read()
+    num_of_lines = body.count(b'\n')
+    if not num_of_lines:
+        return DEFAULT_BYTES_PER_ROW
+    return len(body) / num_of_lines
+
+
+def get_train_rate(execution_arn):
+    # 実行の履歴から、入力の Plan と学習ステップの開始・終了時刻を取り出し、
+    # 学習インスタンス 1 台で 1 行の学習にかかった時間（秒）を返す（前処理・推論などの時間は含めない）
+    plan = None
+    entered = None
+    exited = None
+    paginator = get_client('stepfunctions').get_paginator('get_execution_history')
+    for page in paginator.paginate(executionArn=execution_arn):
+        for event in page['events']:
+            if event['type'] == 'ExecutionStarted':
+                plan = json.loads(event['executionStartedEventDetails']['input']).get('Plan')
+            elif (event['type'] == 'TaskStateEntered'
+                  and event['stateEnteredEventDetails']['name'] == TRAIN_STEP_NAME):
+                entered = event['timestamp']
+            elif (event['type'] == 'TaskStateExited'
+                  and event['stateExitedEventDetails']['name'] == TRAIN_STEP_NAME):
+                exited = event['timestamp']
+    if not plan or not plan.get('rows') or entered is None or exited is None:
+        return None
+    return (exited - entered).total_seconds() * plan['train_instance_count'] / plan['rows']
+
+
+def get_history():
+    # 過去に成功した実行の学習の時間（get_train_rate）
+    # 実行ごとの履歴の取得は並列に行う
+    response = get_client('stepfunctions').list_executions(
+        stateMachineArn=STEPFUNCTION_ARN, statusFilter='SUCCEEDED',
+        maxResults=HISTORY_SIZE)
+    execution_arns = [execution['executionArn'] for execution in response['executions']]
+    if not execution_arns:
+        return []
+    with ThreadPoolExecutor(max_workers=len(execution_arns)) as executor:
+        rates = list(executor.map(get_train_rate, execution_arns))
+    return [rate for rate in rates if rate is not None]
+
+
+def get_object_json(bucket, key):
+    try:
+        body = get_client('s3').get_object(Bucket=bucket, Key=key)['Body'].read()
+    except get_client('s3').exceptions.NoSuchKey:
+        return None
+    return json.loads(body.decode('utf-8'))
+
+
+def get_previous_num_of_segment():
+    # prep.py の差分処理と同じく、latest.json が指す前回の出力の manifest.json を読む
+    bucket, prefix = PREP_STATE_URI[5:].split('/', 1)
+    latest = get_object_json(bucket, f'{prefix}/latest.json')
+    if latest is None:
+        return None
+    bucket, prefix = latest['output'][5:].split('/', 1)
+    manifest = get_object_json(bucket, f'{prefix}/manifest.json')
+    if manifest is None:
+        return None
+    return len(manifest['train_counts'])
+
+
+def clamp(value, lower, upper):
+    return max(lower, min(value, upper))
+
+
+def plan_run(bucket, prefix):
+    total_bytes, largest = get_input_size(bucket, prefix)
+    bytes_per_row = get_bytes_per_row(bucket, largest)
+    rows = int(total_bytes / bytes_per_row)
+
+    num_of_segment = clamp(math.ceil(rows / ROWS_PER_SEGMENT),
+                           NUM_OF_SEGMENT, MAX_OF_SEGMENT)
+    previous_num_of_segment = get_previous_num_of_segment()
+    rebuild = True
+    if (previous_num_of_segment is not None
+            and NUM_OF_SEGMENT <= previous_num_of_segment <= MAX_OF_SEGMENT
+            and num_of_segment < previous_num_of_segment * REBUILD_FACTOR):
+        num_of_segment = previous_num_of_segment
+        rebuild = False
+    max_instance_count = min(num_of_segment, MAX_INSTANCE_COUNT)
+
+    rates = sorted(get_history())
+    if rates:
+        # 外れ値の影響を受けないよう中央値を使う
+        rate = rates[len(rates) // 2]
+        train_instance_count = math.ceil(rate * rows / TARGET_RUNTIME)
+    else:
+        rate = None
+        train_instance_count = math.ceil(rows / TRAIN_ROWS_PER_INSTANCE)
+    train_instance_count = clamp(train_instance_count, 1, max_instance_count)
+    pred_instance_count = clamp(math.ceil(rows / PRED_ROWS_PER_INSTANCE),
+                                1, max_instance_count)
+
+    plan = {
+        'bytes': total_bytes,
+        'bytes_per_row': bytes_per_row,
+        'rows': rows,
+        'num_of_segment': num_of_segment,
+        'previous_num_of_segment': previous_num_of_segment,
+        'rebuild': rebuild,
+        'train_instance_count': train_instance_count,
+        'pred_instance_count': pred_instance_count,
+        'history': len(rates),
+        'seconds_per_row': rate,
+    }
+    print('plan:', json.dumps(plan))
+    return plan
+
+
 def lambda_handler(event, context):
+    with timing(context):
+        return start_pipeline(event)
+
+
+def start_pipeline(event):
     print(event)
     bucket = event['Records'][0]['s3']['bucket']['name']
     key = urllib.parse.unquote_plus(
             event['Records'][0]['s3']['object']['key'], encoding='utf-8')
 
-    num_of_segment = 2
+    raw_data_key = os.path.dirname(key)
+    plan = plan_run(bucket, raw_data_key)
+    num_of_segment = plan['num_of_segment']
     sfn_timestamp = datetime.now(JST).strftime('%Y%m%d')
     job_name_prefix = 'ml-' + sfn_timestamp + '-' + str(uuid.uuid4())
     data_timestamp = datetime.now(JST).strftime('%Y%m')
@@ -44,38 +300,60 @@ def lambda_handler(event, context):
     pred_job_name = job_name_prefix + '-pred'
     post_job_name = job_name_prefix + '-post'
 
-    raw_data_key = os.path.dirname(key)
     raw_data_s3_path = f's3://{bucket}/{raw_data_key}'
     prep_output_data = f's3://{BUCKET_NAME}/{PREFIX}/prep/{prep_job_name}'
     train_output_data = f's3://{BUCKET_NAME}/{PREFIX}/train/{train_job_name}'
     pred_output_data = f's3://{BUCKET_NAME}/{PREFIX}/pred/{pred_job_name}'
     post_output_data = f's3://{BUCKET_NAME}/{PREFIX}/post/{post_job_name}'
 
+    # 前回から追加された生データだけを処理する（セグメント数などが変わった場合は prep.py が全件を作り直す）
+    prep_args = [
+            '--num-of-dataset', str(num_of_segment),
+            '--incremental',
+            '--state-path', PREP_STATE_URI,
+            '--raw-data-uri', raw_data_s3_path
+        ]
+    train_args = [
+            '--num-of-dataset', str(num_of_segment),
+            '--max-runtime', TRAIN_MAX_RUNTIME
+        ]
+    post_args = [
+            '--num-of-dataset', str(num_of_segment),
+            '--sketch-path', f's3://{BUCKET_NAME}/{PREFIX}/post-sketches'
+        ]
+
     pred_args = [
             '--num-of-dataset', str(num_of_segment),
             '--metric-threshold', METRIC_THRESHOLD,
             '--latest-model-path', train_output_data,
-            '--previous-model-path', train_output_data
+            '--previous-model-path', train_output_data,
+            '--memo-path', f's3://{BUCKET_NAME}/{PREFIX}/pred-memo'
         ]
 
     sfn_input = {
         "TimeStamp": data_timestamp,
+        "Plan": plan,
         "PrepJobName": prep_job_name,
+        "PrepArgs": prep_args,
         "PrepInput": raw_data_s3_path,
         "PrepOutput": prep_output_data,
         "TrainJobName": train_job_name,
+        "TrainArgs": train_args,
+        "TrainInstanceCount": plan['train_instance_count'],
         "TrainInput": prep_output_data + '/train',
         "TrainOutput": train_output_data,
         "PredJobName": pred_job_name,
+        "PredInstanceCount": plan['pred_instance_count'],
         "PredArgs": pred_args,
         "PredInput": prep_output_data + '/pred',
         "PredOutput": pred_output_data,
         "PostJobName": post_job_name,
+        "PostArgs": post_args,
         "PostInput": pred_output_data,
         "PostOutput": post_output_data,
     }
 
-    response = sfn_client.start_execution(
+    response = get_client('stepfunctions').start_execution(
         stateMachineArn=STEPFUNCTION_ARN,
         input=json.dumps(sfn_input)
     )
@@ -97,3 +375,6 @@ def lambda_handler(event, context):
         'statusCode': 200,
         'body': json.dumps('Hello from Lambda!')
     }
+
+
+end_init()
@@ -0,0 +1,160 @@
+from datetime import datetime, timedelta, timezone
+import importlib.util
+import json
+import os
+
+from botocore.stub import Stubber
+import pytest
+
+BUCKET = 'bucket'
+STATE_MACHINE_ARN = 'arn:aws:states:us-east-1:123456789012:stateMachine:ml-pipeline'
+ENVS = {
+    'STEPFUNCTION_ARN': STATE_MACHINE_ARN,
+    'BUCKET_NAME': BUCKET,
+    'PREFIX': 'prefix',
+    'METRIC_THRESHOLD': '30000',
+    'NUM_OF_SEGMENT': '2',
+    'MAX_OF_SEGMENT': '16',
+    'ROWS_PER_SEGMENT': '1000',
+    'MAX_INSTANCE_COUNT': '4',
+    'TARGET_RUNTIME': '3600',
+    'TRAIN_ROWS_PER_INSTANCE': '2000',
+    'PRED_ROWS_PER_INSTANCE': '5000',
+}
+ROW = b'1.0,2.0,3.0,4.0,5.0,6.0,7.0,8.0\n'
+
+
+@pytest.fixture
+def index(monkeypatch, s3_client):
+    for name, value in ENVS.items():
+        monkeypatch.setenv(name, value)
+    # 他の Lambda 関数の index.py と区別するため、ファイルから別の名前で読み込む
+    spec = importlib.util.spec_from_file_location(
+        'start_pipeline', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'index.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def put_input(index, num_of_rows):
+    index.get_client('s3').put_object(Bucket=BUCKET, Key='prefix/input/data.csv',
+                                      Body=ROW * num_of_rows)
+
+
+def put_previous_prep(index, num_of_segment):
+    s3_client = index.get_client('s3')
+    output = f's3://{BUCKET}/prefix/prep/job-1'
+    s3_client.put_object(Bucket=BUCKET, Key='prefix/prep/_state/latest.json',
+                         Body=json.dumps({'output': output}).encode('utf-8'))
+    s3_client.put_object(Bucket=BUCKET, Key='prefix/prep/job-1/manifest.json',
+                         Body=json.dumps({'train_counts': [1] * num_of_segment}).encode('utf-8'))
+
+
+def get_history_events(plan, train_seconds):
+    start = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    events = [{'timestamp': start, 'type': 'ExecutionStarted', 'id': 1,
+               'executionStartedEventDetails': {'input': json.dumps({'Plan': plan})}}]
+    for i, name in enumerate(['Data Preparation', 'Model Training', 'Batch Inference']):
+        # 前処理・推論は学習の時間に含めない
+        seconds = train_seconds if name == 'Model Training' else 10000
+        entered = start + timedelta(seconds=100000 * (i + 1))
+        events += [
+            {'timestamp': entered, 'type': 'TaskStateEntered', 'id': 2 * i + 2,
+             'stateEnteredEventDetails': {'name': name}},
+            {'timestamp': entered + timedelta(seconds=seconds), 'type': 'TaskStateExited',
+             'id': 2 * i + 3, 'stateExitedEventDetails': {'name': name}},
+        ]
+    return {'events': events}
+
+
+def test_plan_run_without_history(index, monkeypatch):
+    monkeypatch.setattr(index, 'get_history', lambda: [])
+    put_input(index, 5000)
+    plan = index.plan_run(BUCKET, 'prefix/input')
+    assert plan['rows'] == 5000
+    assert plan['num_of_segment'] == 5
+    assert plan['previous_num_of_segment'] is None
+    assert plan['rebuild']
+    assert plan['train_instance_count'] == 3
+    assert plan['pred_instance_count'] == 1
+    assert plan['seconds_per_row'] is None
+
+
+def test_plan_run_keeps_previous_segments(index, monkeypatch):
+    monkeypatch.setattr(index, 'get_history', lambda: [])
+    put_previous_prep(index, 4)
+    put_input(index, 5000)
+    # 前回の 2 倍未満なので前回と同じセグメント数にする（prep は差分処理になる）
+    plan = index.plan_run(BUCKET, 'prefix/input')
+    assert plan['num_of_segment'] == 4
+    assert plan['previous_num_of_segment'] == 4
+    assert not plan['rebuild']
+
+    put_input(index, 9000)
+    plan = index.plan_run(BUCKET, 'prefix/input')
+    assert plan['num_of_segment'] == 9
+    assert plan['rebuild']
+
+
+def test_plan_run_uses_median_rate(index, monkeypatch):
+    monkeypatch.setattr(index, 'get_history', lambda: [10.0, 0.5, 1.0])
+    put_input(index, 5000)
+    plan = index.plan_run(BUCKET, 'prefix/input')
+    assert plan['history'] == 3
+    assert plan['seconds_per_row'] == 1.0
+    # 1.0 秒/行 x 5000 行 / 3600 秒 -> 2 台
+    assert plan['train_instance_count'] == 2
+
+
+def test_get_bytes_per_row_by_format(index):
+    pa = pytest.importorskip('pyarrow')
+    pq = pytest.importorskip('pyarrow.parquet')
+    s3_client = index.get_client('s3')
+    put_input(index, 5000)
+    obj = {'Key': 'prefix/input/data.csv', 'Size': len(ROW) * 5000}
+    assert index.get_bytes_per_row(BUCKET, obj) == len(ROW)
+    # parquet は改行ではなくフッターの行数から見積もる（行グループが多くフッターが大きい場合も）
+    for row_group_size in [None, 2]:
+        buffer = pa.BufferOutputStream()
+        pq.write_table(pa.table({'x': [float(i) for i in range(3000)]}), buffer,
+                       row_group_size=row_group_size)
+        body = buffer.getvalue().to_pybytes()
+        s3_client.put_object(Bucket=BUCKET, Key='prefix/input/data.parquet', Body=body)
+        obj = {'Key': 'prefix/input/data.parquet', 'Size': len(body)}
+        assert index.get_bytes_per_row(BUCKET, obj) == len(body) / 3000
+    # 行数を読めない列指向のファイルは既定値を使う
+    s3_client.put_object(Bucket=BUCKET, Key='prefix/input/data.arrow', Body=b'\n' * 100)
+    obj = {'Key': 'prefix/input/data.arrow', 'Size': 100}
+    assert index.get_bytes_per_row(BUCKET, obj) == index.DEFAULT_BYTES_PER_ROW
+    s3_client.put_object(Bucket=BUCKET, Key='prefix/input/broken.parquet', Body=b'\n' * 100)
+    obj = {'Key': 'prefix/input/broken.parquet', 'Size': 100}
+    assert index.get_bytes_per_row(BUCKET, obj) == index.DEFAULT_BYTES_PER_ROW
+
+
+def test_get_history_uses_train_step_duration(index):
+    sfn_client = index.get_client('stepfunctions')
+    executions = [f'{STATE_MACHINE_ARN}:{i}' for i in range(3)]
+    with Stubber(sfn_client) as stubber:
+        stubber.add_response('list_executions', {'executions': [
+            {'executionArn': arn, 'stateMachineArn': STATE_MACHINE_ARN, 'name': str(i),
+             'status': 'SUCCEEDED', 'startDate': datetime(2026, 1, 1, tzinfo=timezone.utc)}
+            for i, arn in enumerate(executions)]})
+        # 履歴の取得は並列に行うので、どの実行も同じ結果になるようにする
+        for _ in executions:
+            stubber.add_response('get_execution_history', get_history_events(
+                {'rows': 1000, 'train_instance_count': 2}, 500))
+        rates = index.get_history()
+        stubber.assert_no_pending_responses()
+    # 学習ステップの 500 秒 x 2 台 / 1000 行（実行全体の時間ではない）
+    assert rates == [1.0, 1.0, 1.0]
+
+
+def test_get_history_skips_executions_without_plan(index):
+    sfn_client = index.get_client('stepfunctions')
+    with Stubber(sfn_client) as stubber:
+        stubber.add_response('list_executions', {'executions': [
+            {'executionArn': f'{STATE_MACHINE_ARN}:0', 'stateMachineArn': STATE_MACHINE_ARN,
+             'name': '0', 'status': 'SUCCEEDED',
+             'startDate': datetime(2026, 1, 1, tzinfo=timezone.utc)}]})
+        stubber.add_response('get_execution_history', get_history_events({}, 500))
+        assert index.get_history() == []
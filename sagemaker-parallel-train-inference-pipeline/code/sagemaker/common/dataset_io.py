@@ -0,0 +1,254 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+import queue
+from schema import apply_schema, get_read_dtypes
+import threading
+
+
+class CsvFormat:
+    extension = '.csv'
+
+    def columns(self, path):
+        return list(pd.read_csv(path, nrows=0).columns)
+
+    def num_rows(self, path):
+        # ヘッダーを除いた行数
+        with open(path, 'rb') as f:
+            return max(sum(block.count(b'\n') for block in
+                           iter(lambda: f.read(1024 * 1024), b'')) - 1, 0)
+
+    def read(self, path, columns=None):
+        return pd.read_csv(path, usecols=columns, dtype=get_read_dtypes())
+
+    def iter_chunks(self, path, chunk_size, columns=None):
+        return pd.read_csv(path, usecols=columns, dtype=get_read_dtypes(),
+                           chunksize=chunk_size)
+
+    def open_writer(self, path, compression=None):
+        return CsvWriter(path)
+
+
+class CsvWriter:
+    def __init__(self, path):
+        self.file = open(path, 'w', newline='')
+        self.header = True
+
+    def write(self, df):
+        apply_schema(df).to_csv(self.file, index=None, header=self.header)
+        self.header = False
+
+    def close(self):
+        self.file.close()
+
+
+class ArrowWriter:
+    # 最初に書き込んだ DataFrame のスキーマに以降のチャンクを合わせる
+    def __init__(self, path, open_file):
+        self.path = path
+        self.open_file = open_file
+        self.writer = None
+        self.schema = None
+
+    def write(self, df):
+        table = pa.Table.from_pandas(apply_schema(df), schema=self.schema,
+                                     preserve_index=False)
+        if self.writer is None:
+            self.schema = table.schema
+            self.writer = self.open_file(self.path, self.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class ParquetFormat:
+    extension = '.parquet'
+
+    def columns(self, path):
+        return pq.read_schema(path).names
+
+    def num_rows(self, path):
+        return pq.read_metadata(path).num_rows
+
+    def read(self, path, columns=None):
+        return pq.read_table(path, columns=columns).to_pandas()
+
+    def iter_chunks(self, path, chunk_size, columns=None):
+        parquet_file = pq.ParquetFile(path)
+        for batch in parquet_file.iter_batches(batch_size=chunk_size,
+                                               columns=columns):
+            yield batch.to_pandas()
+
+    def open_writer(self, path, compression=None):
+        return ArrowWriter(path, lambda p, schema: pq.ParquetWriter(
+                                    p, schema, compression=compression or 'none'))
+
+
+class ArrowIpcFormat:
+    extension = '.arrow'
+
+    def columns(self, path):
+        with pa.memory_map(path) as source:
+            return ipc.open_file(source).schema.names
+
+    def num_rows(self, path):
+        with pa.memory_map(path) as source:
+            reader = ipc.open_file(source)
+            return sum(reader.get_batch(i).num_rows
+                       for i in range(reader.num_record_batches))
+
+    def read(self, path, columns=None):
+        return feather.read_table(path, columns=columns).to_pandas()
+
+    def iter_chunks(self, path, chunk_size, columns=None):
+        # IPC ファイルは書き込み時のバッチ単位で保存されているので（前処理ではセグメントごとに 1 バッチ）、
+        # バッチを chunk_size 行ずつに分けて読み出す（slice はコピーしない）
+        with pa.memory_map(path) as source:
+            reader = ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                batch = reader.get_batch(i)
+                for offset in range(0, batch.num_rows, chunk_size):
+                    table = pa.Table.from_batches([batch.slice(offset, chunk_size)])
+                    if columns is not None:
+                        table = table.select(columns)
+                    yield table.to_pandas()
+
+    def open_writer(self, path, compression=None):
+        options = ipc.IpcWriteOptions(compression=compression)
+        return ArrowWriter(path, lambda p, schema: ipc.new_file(
+                                    p, schema, options=options))
+
+
+FORMATS = {
+    'csv': CsvFormat(),
+    'parquet': ParquetFormat(),
+    'arrow': ArrowIpcFormat(),
+}
+
+
+def register_format(name, dataset_format):
+    FORMATS[name] = dataset_format
+
+
+def get_format(name):
+    if name not in FORMATS:
+        raise ValueError(f'unknown dataset format: {name} '
+                         f'(available: {list(FORMATS)})')
+    return FORMATS[name]
+
+
+def detect_format(path):
+    ext = os.path.splitext(path)[1]
+    for name, dataset_format in FORMATS.items():
+        if dataset_format.extension == ext:
+            return name
+    raise ValueError(f'unknown dataset extension: {path}')
+
+
+def is_dataset_file(path):
+    ext = os.path.splitext(path)[1]
+    return any(f.extension == ext for f in FORMATS.values())
+
+
+def get_dataset_config(config):
+    # config.yml の dataset_format / dataset_compression を読み出す
+    name = config.get('dataset_format', 'csv')
+    compression = config.get('dataset_compression')
+    if compression == 'none':
+        compression = None
+    get_format(name)
+    return name, compression
+
+
+def get_dataset_path(path, name, format_name):
+    return os.path.join(path, name + get_format(format_name).extension)
+
+
+def resolve_columns(path, columns=None, exclude=None):
+    # exclude が指定された場合は、ファイルの列から除外した列だけを読み込む
+    if exclude is None:
+        return columns
+    if columns is None:
+        columns = get_format(detect_format(path)).columns(path)
+    return [c for c in columns if c not in exclude]
+
+
+def count_rows(path):
+    # データを読み込まずに行数だけを数える
+    return get_format(detect_format(path)).num_rows(path)
+
+
+def read_dataset(path, columns=None, exclude=None):
+    # 読み込んだデータには常に schema.py で宣言した型を適用する
+    dataset_format = get_format(detect_format(path))
+    df = dataset_format.read(path, resolve_columns(path, columns, exclude))
+    return apply_schema(df)
+
+
+def iter_dataset(path, chunk_size, columns=None, exclude=None):
+    dataset_format = get_format(detect_format(path))
+    for chunk in dataset_format.iter_chunks(
+            path, chunk_size, resolve_columns(path, columns, exclude)):
+        yield apply_schema(chunk)
+
+
+def iter_datasets(paths, chunk_size, columns=None, threads=4, prefetch=2):
+    # 複数のファイルを threads 個まで並列に先読みしながら、paths の順に (path, chunk) を返す
+    # 読み込み済みで待っているチャンクは 1 ファイルあたり prefetch 個までなので、
+    # メモリはファイル数によらず最大で threads x (prefetch + 1) チャンク分
+    stop = threading.Event()
+
+    def put(chunks, item):
+        # 呼び出し側が途中で読むのをやめた場合は、待たずに終了する
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read(path, chunks):
+        try:
+            for chunk in iter_dataset(path, chunk_size, columns):
+                if not put(chunks, chunk):
+                    return
+            put(chunks, None)
+        except Exception as e:
+            put(chunks, e)
+
+    executor = ThreadPoolExecutor(max_workers=max(threads, 1))
+    try:
+        # 先に投入したファイルから読み込むので、先頭のファイルの読み込みが待たされることはない
+        queues = [queue.Queue(maxsize=max(prefetch, 1)) for _ in paths]
+        for path, chunks in zip(paths, queues):
+            executor.submit(read, path, chunks)
+        for path, chunks in zip(paths, queues):
+            while True:
+                chunk = chunks.get()
+                if chunk is None:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield path, chunk
+    finally:
+        stop.set()
+        executor.shutdown(wait=True)
+
+
+def open_writer(path, compression=None):
+    return get_format(detect_format(path)).open_writer(path, compression)
+
+
+def write_dataset(df, path, compression=None):
+    writer = open_writer(path, compression)
+    try:
+        writer.write(df)
+    finally:
+        writer.close()
@@ -0,0 +1,147 @@
+import json
+import os
+import shutil
+import tarfile
+import time
+
+from botocore.exceptions import ClientError
+
+import storage
+
+# zip: これまでと同じ ZIP（シングルスレッド）
+# tar / tar.zst / tar.lz4: tar をストリームで圧縮し、推論時はダウンロードしながら展開する
+# files: 圧縮せずにファイルごとにアップロードし、推論時は並列にダウンロードする
+ARTIFACT_FORMATS = ['zip', 'tar', 'tar.zst', 'tar.lz4', 'files']
+MANIFEST_NAME = 'artifact.json'
+
+
+def get_artifact_config(config):
+    # config.yml の model_artifact_format / model_artifact_level を読み出す
+    format_name = config.get('model_artifact_format', 'zip')
+    if format_name not in ARTIFACT_FORMATS:
+        raise ValueError(f'unknown model artifact format: {format_name} '
+                         f'(available: {ARTIFACT_FORMATS})')
+    return format_name, config.get('model_artifact_level')
+
+
+def list_files(path):
+    files = []
+    for root, _, names in os.walk(path):
+        for name in names:
+            files.append(os.path.relpath(os.path.join(root, name), path))
+    return sorted(files)
+
+
+def get_dir_size(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in list_files(path))
+
+
+def open_compressor(f, format_name, level=None, threads=1):
+    if format_name == 'tar.zst':
+        import zstandard
+        compressor = zstandard.ZstdCompressor(
+            level=3 if level is None else level,
+            threads=threads if threads > 1 else 0)
+        return compressor.stream_writer(f, closefd=False)
+    if format_name == 'tar.lz4':
+        import lz4.frame
+        return lz4.frame.open(f, 'wb',
+                              compression_level=0 if level is None else level)
+    return None
+
+
+def open_decompressor(f, format_name):
+    if format_name == 'tar.zst':
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(f, closefd=False)
+    if format_name == 'tar.lz4':
+        import lz4.frame
+        return lz4.frame.open(f, 'rb')
+    return f
+
+
+def extract_tar(f, format_name, model_path):
+    # ファイル全体を受け取る前から、読み込んだ分だけ順に展開する
+    stream = open_decompressor(f, format_name)
+    with tarfile.open(fileobj=stream, mode='r|') as tar:
+        tar.extractall(model_path)
+
+
+def pack(model_path, output_path, format_name, level=None, threads=1):
+    # 学習済みモデルのディレクトリを output_path に書き出し、artifact.json に記録する
+    start_time = time.time()
+    if format_name == 'zip':
+        shutil.make_archive(os.path.join(output_path, 'model'), format='zip',
+                            root_dir=model_path)
+        files = ['model.zip']
+    elif format_name == 'files':
+        shutil.copytree(model_path, os.path.join(output_path, 'model'))
+        files = [os.path.join('model', f) for f in list_files(model_path)]
+    else:
+        files = [f'model.{format_name}']
+        with open(os.path.join(output_path, files[0]), 'wb') as f:
+            stream = open_compressor(f, format_name, level, threads)
+            with tarfile.open(fileobj=stream or f, mode='w|') as tar:
+                tar.add(model_path, arcname='.')
+            if stream is not None:
+                stream.close()
+
+    manifest = {
+        'format': format_name,
+        'files': files,
+        'raw_bytes': get_dir_size(model_path),
+        'bytes': sum(os.path.getsize(os.path.join(output_path, f)) for f in files),
+        'pack_seconds': time.time() - start_time,
+    }
+    with open(os.path.join(output_path, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def load_manifest(s3_client, bucket, prefix):
+    try:
+        response = s3_client.get_object(Bucket=bucket,
+                                        Key=f'{prefix}/{MANIFEST_NAME}')
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchKey':
+            raise
+        # artifact.json がないモデルは ZIP で保存されている
+        return {'format': 'zip', 'files': ['model.zip']}
+    return json.loads(response['Body'].read().decode('utf-8'))
+
+
+def fetch(s3_client, bucket, prefix, model_path, threads=1, manifest=None):
+    # S3 の prefix にあるモデルを model_path に展開する
+    start_time = time.time()
+    prefix = prefix.strip('/')
+    if manifest is None:
+        manifest = load_manifest(s3_client, bucket, prefix)
+    manifest = dict(manifest)
+    format_name = manifest['format']
+    if format_name == 'zip':
+        download_path = os.path.join(model_path, 'model.zip')
+        storage.download_file(s3_client, bucket, f'{prefix}/model.zip',
+                              download_path, threads)
+        manifest.setdefault('bytes', os.path.getsize(download_path))
+        shutil.unpack_archive(download_path, model_path)
+        os.remove(download_path)
+    elif format_name == 'files':
+        storage.download_files(s3_client, bucket, [
+            (f'{prefix}/{file}',
+             os.path.join(model_path, os.path.relpath(file, 'model')))
+            for file in manifest['files']], threads)
+    else:
+        # 範囲 GET で並列にダウンロードしながら、先頭から順に展開する
+        with storage.open_stream(s3_client, bucket,
+                                 f"{prefix}/{manifest['files'][0]}", threads,
+                                 manifest.get('bytes')) as stream:
+            extract_tar(stream, format_name, model_path)
+
+    stats = {
+        'format': format_name,
+        'bytes': manifest.get('bytes'),
+        'unpack_seconds': time.time() - start_time,
+    }
+    print(f"model artifact {format_name}: {stats['bytes']} bytes, "
+          f"unpacked in {stats['unpack_seconds']:.2f} sec")
+    return stats
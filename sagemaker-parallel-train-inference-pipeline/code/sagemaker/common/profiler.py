@@ -0,0 +1,153 @@
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def get_cpu_seconds():
+    # 終了を待った子プロセスの CPU 時間も含める
+    total = 0
+    for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]:
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+def get_rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * PAGE_SIZE
+
+
+def get_io_bytes():
+    # read/write システムコールで読み書きしたバイト数（取得できない環境では None）
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+    except OSError:
+        return None, None
+    return int(counters['rchar']), int(counters['wchar'])
+
+
+class RssSampler(threading.Thread):
+    # フェーズ中の RSS の最大値を一定間隔で記録する
+    def __init__(self, interval):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = get_rss()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, get_rss())
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.peak = max(self.peak, get_rss())
+        return self.peak
+
+
+class Profiler:
+    def __init__(self, name, interval=0.1):
+        self.name = name
+        self.interval = interval
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        # with profiler.phase('fit'): のように、計測したい処理を囲む
+        # 同じ名前のフェーズを繰り返した場合（チャンクごとの処理など）は合算する
+        sampler = RssSampler(self.interval)
+        sampler.start()
+        wall_start = time.time()
+        cpu_start = get_cpu_seconds()
+        read_start, written_start = get_io_bytes()
+        try:
+            yield
+        finally:
+            read_end, written_end = get_io_bytes()
+            record = self.get_phase(name)
+            if record is None:
+                record = {
+                    'phase': name,
+                    'wall_seconds': 0,
+                    'cpu_seconds': 0,
+                    'peak_rss_bytes': 0,
+                    'bytes_read': None,
+                    'bytes_written': None,
+                    'calls': 0,
+                }
+                self.phases.append(record)
+            record['wall_seconds'] += time.time() - wall_start
+            record['cpu_seconds'] += get_cpu_seconds() - cpu_start
+            record['peak_rss_bytes'] = max(record['peak_rss_bytes'], sampler.stop())
+            if read_start is not None:
+                record['bytes_read'] = (record['bytes_read'] or 0) + read_end - read_start
+                record['bytes_written'] = ((record['bytes_written'] or 0)
+                                           + written_end - written_start)
+            record['calls'] += 1
+
+    def get_phase(self, name):
+        for record in self.phases:
+            if record['phase'] == name:
+                return record
+        return None
+
+    def print_phases(self):
+        for record in self.phases:
+            print(f"[{self.name}] {record['phase']}: "
+                  f"{record['wall_seconds']:.2f} sec wall, "
+                  f"{record['cpu_seconds']:.2f} sec cpu, "
+                  f"peak rss {record['peak_rss_bytes'] / 1024 / 1024:.1f} MB")
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'phases': self.phases,
+            'wall_seconds': sum(p['wall_seconds'] for p in self.phases),
+            'cpu_seconds': sum(p['cpu_seconds'] for p in self.phases),
+            'peak_rss_bytes': max([p['peak_rss_bytes'] for p in self.phases],
+                                  default=0),
+        }
+
+    def save(self, path):
+        self.print_phases()
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+def rollup(profiles):
+    # 複数セグメントの profile.json をフェーズごとに合計する
+    phases = {}
+    for profile in profiles:
+        for record in profile['phases']:
+            total = phases.setdefault(record['phase'], {
+                'segments': 0,
+                'wall_seconds': 0,
+                'cpu_seconds': 0,
+                'peak_rss_bytes': 0,
+                'bytes_read': 0,
+                'bytes_written': 0,
+            })
+            total['segments'] += 1
+            total['wall_seconds'] += record['wall_seconds']
+            total['cpu_seconds'] += record['cpu_seconds']
+            total['peak_rss_bytes'] = max(total['peak_rss_bytes'],
+                                          record['peak_rss_bytes'])
+            total['bytes_read'] += record['bytes_read'] or 0
+            total['bytes_written'] += record['bytes_written'] or 0
+    return phases
+
+
+def print_rollup(phases):
+    for phase, total in phases.items():
+        print(f"{phase}: {total['segments']} segments, "
+              f"{total['wall_seconds']:.1f} sec wall, "
+              f"{total['cpu_seconds']:.1f} sec cpu, "
+              f"peak rss {total['peak_rss_bytes'] / 1024 / 1024:.1f} MB, "
+              f"read {total['bytes_read'] / 1024 / 1024:.1f} MB, "
+              f"written {total['bytes_written'] / 1024 / 1024:.1f} MB")
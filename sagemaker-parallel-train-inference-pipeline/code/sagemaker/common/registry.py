@@ -0,0 +1,85 @@
+import json
+import os
+import time
+
+from botocore.exceptions import ClientError
+import yaml
+
+import model_artifact
+import storage
+
+# 学習ジョブ全体のモデル一覧
+# 学習は複数インスタンスで行うため、各インスタンスは registry-<host>.json を書き出し、
+# 学習ステップの後に Lambda 関数（code/lambda/register-models）が registry.json にまとめる
+REGISTRY_NAME = 'registry.json'
+PART_PREFIX = 'registry-'
+
+# 同じプロセスで同じ学習ジョブの registry を何度も取得しないようにする
+registries = {}
+
+
+def create_entry(eval_dict, manifest):
+    return {
+        'MAE': eval_dict['MAE'],
+        'fingerprint': eval_dict.get('fingerprint'),
+        'artifact': manifest,
+    }
+
+
+def load_local_entry(model_path):
+    # 学習したモデルの出力フォルダ（eval.yml と artifact.json）から作る
+    with open(os.path.join(model_path, 'eval.yml')) as f:
+        eval_dict = yaml.safe_load(f)
+    with open(os.path.join(model_path, model_artifact.MANIFEST_NAME)) as f:
+        manifest = json.load(f)
+    return create_entry(eval_dict, manifest)
+
+
+def load_s3_entry(s3_client, bucket, prefix):
+    eval_dict = yaml.safe_load(
+        storage.get_bytes(s3_client, bucket, f'{prefix}/eval.yml').decode('utf-8'))
+    manifest = model_artifact.load_manifest(s3_client, bucket, prefix)
+    return create_entry(eval_dict, manifest)
+
+
+def write_part(output_data_path, host, models, cache=None):
+    # cache: このインスタンスで学習したモデルのキャッシュのエントリ {'uri': ..., 'entries': [...]}
+    # （Register Models がモデルのアップロードを確認してからキャッシュに登録する）
+    path = os.path.join(output_data_path, f'{PART_PREFIX}{host}.json')
+    with open(path, 'w') as f:
+        json.dump({
+            'host': host,
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'models': models,
+            'cache': cache,
+        }, f, indent=2)
+    return path
+
+
+def load_registry(s3_client, bucket, prefix):
+    # 学習ジョブの出力先 prefix にあるモデル一覧 {model_id: entry} を返す（ない場合は空）
+    prefix = prefix.strip('/')
+    if (bucket, prefix) in registries:
+        return registries[(bucket, prefix)]
+    try:
+        body = storage.get_bytes(s3_client, bucket, f'{prefix}/{REGISTRY_NAME}')
+        models = json.loads(body.decode('utf-8'))['models']
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchKey':
+            raise
+        # まとめる前の学習ジョブ（Step Functions を通さずに実行した場合など）は、読み込むだけで書き込まない
+        models = merge_parts(s3_client, bucket, prefix)
+    registries[(bucket, prefix)] = models
+    return models
+
+
+def merge_parts(s3_client, bucket, prefix):
+    models = {}
+    keys = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=f'{prefix}/{PART_PREFIX}'):
+        keys += [obj['Key'] for obj in page.get('Contents', [])]
+    for body in storage.fetch_objects(s3_client, bucket, keys, len(keys)):
+        models.update(json.loads(body.decode('utf-8'))['models'])
+    print(f'registry: merged {len(keys)} parts ({len(models)} models) of s3://{bucket}/{prefix} in memory')
+    return models
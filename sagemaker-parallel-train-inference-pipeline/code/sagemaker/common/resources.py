@@ -0,0 +1,54 @@
+import os
+
+CGROUP_MEMORY_LIMIT_FILES = [
+    '/sys/fs/cgroup/memory.max',                    # cgroup v2
+    '/sys/fs/cgroup/memory/memory.limit_in_bytes',  # cgroup v1
+]
+
+
+def get_cpu_count():
+    # コンテナに割り当てられた CPU 数（取得できない場合はホストの CPU 数）
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def get_total_memory():
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemTotal:'):
+                return int(line.split()[1]) * 1024
+    return None
+
+
+def get_memory_limit():
+    # cgroup のメモリ上限（bytes）。上限がない場合は物理メモリの量を返す
+    total = get_total_memory()
+    for path in CGROUP_MEMORY_LIMIT_FILES:
+        if not os.path.exists(path):
+            continue
+        with open(path) as f:
+            value = f.read().strip()
+        if value == 'max':
+            break
+        limit = int(value)
+        # cgroup v1 で上限がない場合は非常に大きな値が入っている
+        if total is None or limit < total:
+            return limit
+        break
+    return total
+
+
+def get_available_memory():
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) * 1024
+    return get_memory_limit()
+
+
+def limit_threads(num_threads):
+    # 並列に動くプロセスがそれぞれ全コアを使おうとしないよう、スレッド数を制限する
+    for name in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                 'NUMEXPR_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS']:
+        os.environ[name] = str(num_threads)
@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+
+LABEL = 'medianHouseValue'
+
+# 列名: (型, 欠損を許すか)
+# 型は float32 / int32 / category などを指定する
+# 欠損を許す整数の列は、NaN を表現できるよう float32 で保持する
+SCHEMA = {
+    'longitude': ('float32', False),
+    'latitude': ('float32', False),
+    'housingMedianAge': ('int32', False),
+    'totalRooms': ('int32', False),
+    'totalBedrooms': ('int32', True),
+    'population': ('int32', False),
+    'households': ('int32', False),
+    'medianIncome': ('float32', False),
+    'medianHouseValue': ('float32', True),
+}
+
+# post.py が推論結果に付ける列（CSV でも 003 のような ID の 0 埋めを残すため文字列で読む）
+ID_COLUMNS = ['segment', 'model']
+
+
+def get_storage_dtype(name):
+    dtype, nullable = SCHEMA[name]
+    if dtype.startswith('int') and nullable:
+        return 'float32'
+    return dtype
+
+
+def get_read_dtypes():
+    # CSV を読み込むときに型推論をさせないための dtype 指定
+    # 整数の列も 41.0 のような表記を読めるよう、いったん float32 で読む
+    dtypes = {}
+    for name, (dtype, _) in SCHEMA.items():
+        dtypes[name] = 'float32' if dtype.startswith('int') else dtype
+    for name in ID_COLUMNS:
+        dtypes[name] = 'str'
+    return dtypes
+
+
+def get_row_bytes(columns):
+    # スキーマの型で保持した場合の 1 行あたりのバイト数（category などは 8 bytes とみなす）
+    row_bytes = 0
+    for name in columns:
+        try:
+            row_bytes += np.dtype(get_storage_dtype(name)).itemsize
+        except (KeyError, TypeError):
+            row_bytes += 8
+    return row_bytes
+
+
+def apply_schema(df):
+    # スキーマに定義された列を宣言した型に変換する（定義にない列はそのまま）
+    columns = {}
+    for name in df.columns:
+        if name not in SCHEMA:
+            continue
+        dtype = get_storage_dtype(name)
+        if str(df[name].dtype) == dtype:
+            continue
+        if not SCHEMA[name][1] and df[name].isna().any():
+            raise ValueError(f'column {name} must not contain missing values')
+        columns[name] = df[name].astype(dtype)
+    if not columns:
+        return df
+    return df.assign(**columns)
+
+
+def get_memory_report(df):
+    # 型推論に任せた場合（数値列はすべて 64bit）と比べたメモリ使用量
+    actual = df.memory_usage(index=False, deep=True)
+    inferred = 0
+    for name in df.columns:
+        if pd.api.types.is_numeric_dtype(df[name].dtype):
+            inferred += len(df) * np.dtype('float64').itemsize
+        else:
+            inferred += actual[name]
+    actual = int(actual.sum())
+    num_of_rows = max(len(df), 1)
+    return {
+        'rows': len(df),
+        'inferred_bytes': int(inferred),
+        'actual_bytes': actual,
+        'inferred_bytes_per_row': inferred / num_of_rows,
+        'actual_bytes_per_row': actual / num_of_rows,
+    }
+
+
+def print_memory_report(name, df):
+    report = get_memory_report(df)
+    print(f"memory of {name}: {report['inferred_bytes'] / 1024 / 1024:.1f} MB "
+          f"-> {report['actual_bytes'] / 1024 / 1024:.1f} MB "
+          f"({report['inferred_bytes_per_row']:.1f} -> "
+          f"{report['actual_bytes_per_row']:.1f} bytes/row)")
+    return report
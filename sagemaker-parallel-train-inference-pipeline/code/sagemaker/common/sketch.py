@@ -0,0 +1,149 @@
+import math
+import numpy as np
+
+RELATIVE_ACCURACY = 0.01
+
+
+class QuantileSketch:
+    # 値を対数の幅のバケットに数えるヒストグラム（DDSketch と同じ考え方）
+    # - 分位点の相対誤差は relative_accuracy 以下
+    # - バケット数は値の範囲（最大/最小の比）だけで決まり、データ量によらず一定
+    # - 同じ relative_accuracy のスケッチはバケットの件数を足すだけで合成でき、
+    #   複数インスタンスで作ったものを合成しても 1 つで作ったものと完全に一致する
+    def __init__(self, relative_accuracy=RELATIVE_ACCURACY, min_value=1e-9):
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        self.zero = 0
+        self.missing = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add_counts(self, store, values):
+        keys, counts = np.unique(np.ceil(np.log(values) / self.log_gamma).astype('int64'),
+                                 return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            store[key] = store.get(key, 0) + count
+
+    def add(self, values):
+        values = np.asarray(values, dtype='float64')
+        missing = np.isnan(values)
+        values = values[~missing]
+        self.missing += int(missing.sum())
+        if not len(values):
+            return
+        self.count += len(values)
+        self.sum += float(values.sum())
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self.add_counts(self.positive, values[values > self.min_value])
+        self.add_counts(self.negative, -values[values < -self.min_value])
+        self.zero += int((np.abs(values) <= self.min_value).sum())
+
+    def merge(self, other):
+        if other.gamma != self.gamma or other.min_value != self.min_value:
+            raise ValueError('sketches with different parameters cannot be merged')
+        for store, other_store in [(self.positive, other.positive),
+                                   (self.negative, other.negative)]:
+            for key, count in other_store.items():
+                store[key] = store.get(key, 0) + count
+        self.zero += other.zero
+        self.missing += other.missing
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def get_buckets(self):
+        # (代表値, 件数) を値の小さい順に返す
+        buckets = [(-self.get_value(key), count)
+                   for key, count in sorted(self.negative.items(), reverse=True)]
+        if self.zero:
+            buckets.append((0.0, self.zero))
+        buckets += [(self.get_value(key), count)
+                    for key, count in sorted(self.positive.items())]
+        return buckets
+
+    def get_value(self, key):
+        # バケット (gamma^(key-1), gamma^key] の代表値（相対誤差が最小になる値）
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def quantile(self, q):
+        if not self.count:
+            return math.nan
+        rank = q * (self.count - 1)
+        seen = 0
+        for value, count in self.get_buckets():
+            seen += count
+            if seen > rank:
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def mean(self):
+        return self.sum / self.count if self.count else math.nan
+
+    def to_dict(self):
+        return {
+            'relative_accuracy': self.relative_accuracy,
+            'min_value': self.min_value,
+            'positive': {str(k): v for k, v in sorted(self.positive.items())},
+            'negative': {str(k): v for k, v in sorted(self.negative.items())},
+            'zero': self.zero,
+            'missing': self.missing,
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min if self.count else None,
+            'max': self.max if self.count else None,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        sketch = cls(d['relative_accuracy'], d['min_value'])
+        sketch.positive = {int(k): v for k, v in d['positive'].items()}
+        sketch.negative = {int(k): v for k, v in d['negative'].items()}
+        sketch.zero = d['zero']
+        sketch.missing = d['missing']
+        sketch.count = d['count']
+        sketch.sum = d['sum']
+        if d['count']:
+            sketch.min = d['min']
+            sketch.max = d['max']
+        return sketch
+
+
+def compare(previous, current, num_of_bins=10, epsilon=1e-4):
+    # 2 つのスケッチの分布の違い
+    # - ks: 累積分布の差の最大値（バケット単位で計算するので、同じパラメタのスケッチでは正確）
+    # - psi: 前回の分位点で num_of_bins 個に分けた区間の割合から計算する Population Stability Index
+    result = {
+        'previous_count': previous.count,
+        'current_count': current.count,
+        'previous_mean': previous.mean(),
+        'current_mean': current.mean(),
+        'previous_p50': previous.quantile(0.5),
+        'current_p50': current.quantile(0.5),
+        'ks': math.nan,
+        'psi': math.nan,
+    }
+    if not previous.count or not current.count:
+        return result
+
+    previous_buckets = dict(previous.get_buckets())
+    current_buckets = dict(current.get_buckets())
+    values = np.array(sorted(set(previous_buckets) | set(current_buckets)))
+    p = np.array([previous_buckets.get(v, 0) for v in values]) / previous.count
+    q = np.array([current_buckets.get(v, 0) for v in values]) / current.count
+    result['ks'] = float(np.abs(np.cumsum(p) - np.cumsum(q)).max())
+
+    edges = np.unique([previous.quantile(i / num_of_bins) for i in range(1, num_of_bins)])
+    bins = np.searchsorted(edges, values, side='left')
+    p_bins = np.bincount(bins, weights=p, minlength=len(edges) + 1) + epsilon
+    q_bins = np.bincount(bins, weights=q, minlength=len(edges) + 1) + epsilon
+    result['psi'] = float(((q_bins - p_bins) * np.log(q_bins / p_bins)).sum())
+    return result
@@ -0,0 +1,148 @@
+import io
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+import botocore.exceptions
+
+MAX_POOL_CONNECTIONS = 64
+PART_SIZE = 16 * 1024 * 1024
+
+# 通信の途中で切れた場合など、botocore の再試行の対象にならないエラー
+RETRYABLE_ERRORS = tuple(
+    getattr(botocore.exceptions, name) for name in [
+        'ConnectionError', 'ConnectionClosedError', 'EndpointConnectionError',
+        'ReadTimeoutError', 'IncompleteReadError', 'ResponseStreamingError',
+    ] if hasattr(botocore.exceptions, name))
+
+# botocore の再試行を使い切った後でも、時間を置けば成功することがある S3 のエラーコード
+RETRYABLE_CODES = ['SlowDown', 'InternalError', 'ServiceUnavailable', 'RequestTimeout',
+                   'Throttling', 'ThrottlingException', '500', '503']
+
+# プロセスごとに 1 つのクライアントを使い回す
+clients = {}
+
+
+def split_s3_uri(uri):
+    bucket = uri.split('/')[2]
+    key = uri[6+len(bucket):].strip('/')
+    return bucket, key
+
+
+def get_client(max_pool_connections=MAX_POOL_CONNECTIONS):
+    # 並列にダウンロードしてもコネクションを待たないよう、プールを大きくしたクライアント
+    # S3_ENDPOINT_URL を指定すると、moto などのローカルの S3 互換サーバーに接続する
+    if max_pool_connections not in clients:
+        config = Config(max_pool_connections=max_pool_connections,
+                        retries={'max_attempts': 10, 'mode': 'adaptive'},
+                        tcp_keepalive=True)
+        clients[max_pool_connections] = boto3.client(
+            's3', config=config, endpoint_url=os.environ.get('S3_ENDPOINT_URL'))
+    return clients[max_pool_connections]
+
+
+def is_retryable(e):
+    if isinstance(e, RETRYABLE_ERRORS):
+        return True
+    return (isinstance(e, botocore.exceptions.ClientError)
+            and e.response.get('Error', {}).get('Code') in RETRYABLE_CODES)
+
+
+def with_retry(func, *args, attempts=5, base_delay=0.5, **kwargs):
+    # 指数バックオフ（ジッター付き）で再試行する
+    for attempt in range(attempts):
+        try:
+            return func(*args, **kwargs)
+        except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as e:
+            if not is_retryable(e) or attempt == attempts - 1:
+                raise
+            delay = base_delay * 2 ** attempt * (0.5 + random.random())
+            print(f'WARN: {e}, retrying in {delay:.1f} sec')
+            time.sleep(delay)
+
+
+def get_transfer_config(threads):
+    # 大きなファイルは PART_SIZE ごとの範囲 GET を並列に行う
+    return TransferConfig(multipart_threshold=PART_SIZE,
+                          multipart_chunksize=PART_SIZE,
+                          max_concurrency=max(threads, 1))
+
+
+def get_bytes(s3_client, bucket, key, byte_range=None):
+    kwargs = {'Bucket': bucket, 'Key': key}
+    if byte_range is not None:
+        kwargs['Range'] = f'bytes={byte_range[0]}-{byte_range[1]}'
+
+    def get():
+        return s3_client.get_object(**kwargs)['Body'].read()
+    return with_retry(get)
+
+
+def fetch_objects(s3_client, bucket, keys, threads):
+    # 複数のオブジェクトを並列に取得し、keys と同じ順序で返す
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+        return list(executor.map(lambda key: get_bytes(s3_client, bucket, key),
+                                 keys))
+
+
+def download_file(s3_client, bucket, key, path, threads):
+    with_retry(s3_client.download_file, bucket, key, path,
+               Config=get_transfer_config(threads))
+
+
+def download_files(s3_client, bucket, items, threads):
+    # items: [(key, path)] を並列にダウンロードする
+    def download(item):
+        key, path = item
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        download_file(s3_client, bucket, key, path, 1)
+
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+        list(executor.map(download, items))
+
+
+class RangeReader(io.RawIOBase):
+    # オブジェクトを PART_SIZE ごとに並列に先読みしながら、先頭から順に読み出す
+    # tar の展開など、ストリームで処理する場合もシングルストリームの GET より速くダウンロードできる
+    # メモリは最大で threads x part_size 使う
+    def __init__(self, s3_client, bucket, key, size, threads, part_size=PART_SIZE):
+        self.ranges = [(start, min(start + part_size, size) - 1)
+                       for start in range(0, size, part_size)]
+        self.executor = ThreadPoolExecutor(max_workers=max(threads, 1))
+        self.futures = [self.executor.submit(get_bytes, s3_client, bucket, key, r)
+                        for r in self.ranges[:max(threads, 1)]]
+        self.submitted = len(self.futures)
+        self.fetch = lambda r: self.executor.submit(get_bytes, s3_client, bucket, key, r)
+        self.buffer = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not len(self.buffer) and self.futures:
+            self.buffer = memoryview(self.futures.pop(0).result())
+            if self.submitted < len(self.ranges):
+                self.futures.append(self.fetch(self.ranges[self.submitted]))
+                self.submitted += 1
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            for future in self.futures:
+                future.cancel()
+            self.executor.shutdown(wait=True)
+        super().close()
+
+
+def open_stream(s3_client, bucket, key, threads, size=None):
+    if size is None:
+        size = s3_client.head_object(Bucket=bucket, Key=key)['ContentLength']
+    return io.BufferedReader(RangeReader(s3_client, bucket, key, size, threads),
+                             buffer_size=1024 * 1024)
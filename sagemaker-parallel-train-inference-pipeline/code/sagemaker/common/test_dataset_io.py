@@ -0,0 +1,16 @@
+import pandas as pd
+import pytest
+
+from dataset_io import count_rows, iter_dataset, write_dataset
+
+
+@pytest.mark.parametrize('extension', ['.csv', '.parquet', '.arrow'])
+def test_iter_dataset_splits_into_chunks(tmp_path, extension):
+    # 1 回の書き込み（arrow では 1 バッチ）のファイルでも chunk_size 行ずつ読み出す
+    path = str(tmp_path / f'data{extension}')
+    write_dataset(pd.DataFrame({'x': range(5), 'y': [float(i) for i in range(5)]}), path)
+    assert count_rows(path) == 5
+    chunks = list(iter_dataset(path, 2, columns=['x']))
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+    assert [list(chunk.columns) for chunk in chunks] == [['x']] * 3
+    assert [x for chunk in chunks for x in chunk['x']] == list(range(5))
@@ -0,0 +1,43 @@
+import json
+
+import pytest
+
+import registry
+
+BUCKET = 'bucket'
+PREFIX = 'prefix/train/job'
+
+
+@pytest.fixture(autouse=True)
+def clear_registries(monkeypatch):
+    monkeypatch.setattr(registry, 'registries', {})
+
+
+def put_part(s3_client, tmp_path, host, models):
+    path = registry.write_part(str(tmp_path), host, models)
+    s3_client.upload_file(path, BUCKET, f'{PREFIX}/{registry.PART_PREFIX}{host}.json')
+
+
+def test_merge_parts_is_read_only(s3_client, tmp_path):
+    put_part(s3_client, tmp_path, 'algo-1', {'000': {'MAE': 1.0}})
+    put_part(s3_client, tmp_path, 'algo-2', {'001': {'MAE': 2.0}, '002': {'MAE': 3.0}})
+    models = registry.load_registry(s3_client, BUCKET, PREFIX + '/')
+    assert sorted(models) == ['000', '001', '002']
+    assert models['001']['MAE'] == 2.0
+    # 推論は学習の出力先に書き込まない
+    keys = [obj['Key'] for obj in s3_client.list_objects_v2(Bucket=BUCKET)['Contents']]
+    assert f'{PREFIX}/{registry.REGISTRY_NAME}' not in keys
+
+
+def test_load_registry_prefers_merged_registry(s3_client, tmp_path):
+    put_part(s3_client, tmp_path, 'algo-1', {'000': {'MAE': 1.0}})
+    s3_client.put_object(Bucket=BUCKET, Key=f'{PREFIX}/{registry.REGISTRY_NAME}',
+                         Body=json.dumps({'models': {'000': {'MAE': 5.0}}}).encode('utf-8'))
+    assert registry.load_registry(s3_client, BUCKET, PREFIX) == {'000': {'MAE': 5.0}}
+    # 同じプロセスでは 2 回目以降は S3 から取得しない
+    s3_client.delete_object(Bucket=BUCKET, Key=f'{PREFIX}/{registry.REGISTRY_NAME}')
+    assert registry.load_registry(s3_client, BUCKET, PREFIX) == {'000': {'MAE': 5.0}}
+
+
+def test_load_registry_without_parts(s3_client):
+    assert registry.load_registry(s3_client, BUCKET, 'prefix/train/missing') == {}
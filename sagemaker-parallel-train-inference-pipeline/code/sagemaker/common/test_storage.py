@@ -0,0 +1,65 @@
+import io
+import os
+
+from botocore.exceptions import ClientError
+import pytest
+
+import storage
+
+DATA = bytes(range(256)) * 40
+
+
+def test_range_reader_reassembles_parts(s3_client, bucket):
+    s3_client.put_object(Bucket=bucket, Key='model/model.tar', Body=DATA)
+    # 11 個の範囲 GET を 3 並列で先読みしても、先頭から順に読み出せる
+    reader = storage.RangeReader(s3_client, bucket, 'model/model.tar', len(DATA), 3,
+                                 part_size=1000)
+    assert len(reader.ranges) == 11
+    with io.BufferedReader(reader, buffer_size=300) as stream:
+        assert stream.read(10) == DATA[:10]
+        assert stream.read() == DATA[10:]
+    # サイズを指定しない場合は HEAD で取得する
+    with storage.open_stream(s3_client, bucket, 'model/model.tar', 2) as stream:
+        assert stream.read() == DATA
+
+
+def test_download_files_under_prefix(s3_client, bucket, tmp_path):
+    files = {'eval.yml': b'MAE: 1.0\n', 'models/a/model.pkl': b'a', 'models/b/model.pkl': b'b'}
+    for file, body in files.items():
+        s3_client.put_object(Bucket=bucket, Key=f'prefix/000/{file}', Body=body)
+    keys = [obj['Key'] for obj in s3_client.list_objects_v2(
+        Bucket=bucket, Prefix='prefix/000/')['Contents']]
+    storage.download_files(s3_client, bucket,
+                           [(key, str(tmp_path / os.path.relpath(key, 'prefix/000')))
+                            for key in keys], 2)
+    for file, body in files.items():
+        assert (tmp_path / file).read_bytes() == body
+    # 複数のオブジェクトはキーと同じ順序で返す
+    assert storage.fetch_objects(s3_client, bucket, sorted(keys, reverse=True), 3) == [
+        files[os.path.relpath(key, 'prefix/000')] for key in sorted(keys, reverse=True)]
+
+
+def test_with_retry(s3_client, bucket, monkeypatch):
+    monkeypatch.setattr(storage.time, 'sleep', lambda seconds: None)
+    calls = []
+
+    def get():
+        calls.append(1)
+        if len(calls) < 3:
+            raise ClientError({'Error': {'Code': 'SlowDown', 'Message': 'Please reduce'}},
+                              'GetObject')
+        return 'ok'
+    # 一時的なエラーは再試行し、成功した結果を返す
+    assert storage.with_retry(get) == 'ok'
+    assert len(calls) == 3
+
+    calls.clear()
+
+    def get_missing():
+        calls.append(1)
+        return s3_client.get_object(Bucket=bucket, Key='missing')
+    # 存在しないキーなどは再試行せずにそのまま送出する
+    with pytest.raises(ClientError) as e:
+        storage.with_retry(get_missing)
+    assert e.value.response['Error']['Code'] == 'NoSuchKey'
+    assert len(calls) == 1
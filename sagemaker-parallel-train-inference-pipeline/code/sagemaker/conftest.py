@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 各ステップのスクリプトは common のモジュールと同じ場所に配置して実行するので、テストでも同じように読み込む
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'common'))
@@ -0,0 +1,95 @@
+from botocore.exceptions import ClientError
+from dataset_io import iter_datasets, resolve_columns
+import json
+import pandas as pd
+from sketch import QuantileSketch, compare
+import storage
+import time
+
+SKETCH_NAME = 'sketches.json'
+PREDICTION = 'prediction'
+
+
+def sketch_features(label_files, features, chunk_size, threads):
+    # 推論の入力（pred_<id>）の特徴量ごとのスケッチ {segment_id: {feature: QuantileSketch}}
+    sketches = {}
+    paths = [(segment_id, path) for segment_id, files in sorted(label_files.items())
+             for path in files]
+    if not paths:
+        return sketches
+    columns = [c for c in resolve_columns(paths[0][1], exclude=[]) if c in features]
+    segment_of = {path: segment_id for segment_id, path in paths}
+    for path, chunk in iter_datasets([path for _, path in paths], chunk_size,
+                                     columns=columns, threads=threads):
+        segment = sketches.setdefault(segment_of[path], {})
+        for column in columns:
+            segment.setdefault(column, QuantileSketch()).add(chunk[column].to_numpy())
+    return sketches
+
+
+def to_dict(prediction_sketches, feature_sketches):
+    # セグメントごとのスケッチと、全セグメントを合成したもの（'all'）
+    segments = {}
+    for segment_id in sorted(set(prediction_sketches) | set(feature_sketches)):
+        variables = dict(feature_sketches.get(segment_id, {}))
+        if segment_id in prediction_sketches:
+            variables[PREDICTION] = prediction_sketches[segment_id]
+        segments[segment_id] = variables
+    merged = {}
+    for variables in segments.values():
+        for name, sketch in variables.items():
+            merged.setdefault(name, QuantileSketch(sketch.relative_accuracy,
+                                                   sketch.min_value)).merge(sketch)
+    segments['all'] = merged
+    return {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'segments': {segment_id: {name: sketch.to_dict() for name, sketch in variables.items()}
+                     for segment_id, variables in segments.items()},
+    }
+
+
+def from_dict(d):
+    return {segment_id: {name: QuantileSketch.from_dict(sketch)
+                         for name, sketch in variables.items()}
+            for segment_id, variables in d['segments'].items()}
+
+
+def load_previous(s3_client, sketch_path):
+    bucket, prefix = storage.split_s3_uri(sketch_path)
+    key = f'{prefix}/{SKETCH_NAME}'
+    try:
+        body = storage.get_bytes(s3_client, bucket, key)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchKey':
+            raise
+        print(f'previous sketches not found: s3://{bucket}/{key}')
+        return None
+    previous = json.loads(body.decode('utf-8'))
+    print(f"previous sketches: s3://{bucket}/{key} ({previous['created_at']})")
+    return previous
+
+
+def save_latest(s3_client, sketch_path, sketches):
+    # 次回の実行で比較できるよう、決まった場所に今回のスケッチを置く
+    bucket, prefix = storage.split_s3_uri(sketch_path)
+    s3_client.put_object(Bucket=bucket, Key=f'{prefix}/{SKETCH_NAME}',
+                         Body=json.dumps(sketches).encode('utf-8'))
+
+
+def compare_runs(previous, current, psi_threshold, ks_threshold):
+    # 前回と今回で共通するセグメント・変数ごとに分布を比較した表
+    previous = from_dict(previous)
+    current = from_dict(current)
+    rows = []
+    for segment_id, variables in current.items():
+        for name, sketch in variables.items():
+            if name not in previous.get(segment_id, {}):
+                continue
+            row = {'segment': segment_id, 'variable': name}
+            row.update(compare(previous[segment_id][name], sketch))
+            row['drift'] = bool(row['psi'] > psi_threshold or row['ks'] > ks_threshold)
+            rows.append(row)
+    return pd.DataFrame(rows, columns=[
+        'segment', 'variable', 'previous_count', 'current_count',
+        'previous_mean', 'current_mean', 'previous_p50', 'current_p50',
+        'ks', 'psi', 'drift'])
@@ -0,0 +1,88 @@
+from dataset_io import count_rows, iter_dataset, resolve_columns
+import numpy as np
+import pandas as pd
+from schema import LABEL
+
+QUANTILES = [0.5, 0.9, 0.99]
+
+
+class LabelReader:
+    # 推論に使ったファイル（pred_<id>）の正解ラベルを、推論結果と同じ行の順に読み出す
+    # pred.py と同じくファイル名の順に読み、ラベルの列がないファイルは欠損（NaN）とする
+    def __init__(self, files, chunk_size):
+        self.chunks = self.iter_labels(files, chunk_size)
+        self.buffer = np.array([], dtype='float64')
+
+    def iter_labels(self, files, chunk_size):
+        for file in files:
+            if LABEL in resolve_columns(file, exclude=[]):
+                for chunk in iter_dataset(file, chunk_size, columns=[LABEL]):
+                    yield chunk[LABEL].to_numpy(dtype='float64')
+            else:
+                yield np.full(count_rows(file), np.nan)
+
+    def read(self, num_of_rows):
+        while len(self.buffer) < num_of_rows:
+            labels = next(self.chunks, None)
+            if labels is None:
+                # 推論結果より行が少ない場合は、足りない分を欠損とする
+                labels = np.full(num_of_rows - len(self.buffer), np.nan)
+            self.buffer = np.concatenate([self.buffer, labels])
+        labels, self.buffer = self.buffer[:num_of_rows], self.buffer[num_of_rows:]
+        return labels
+
+
+class ErrorCollector:
+    # ラベルのある行の誤差だけを保持し、最後に全セグメントをまとめて集計する
+    # 1 行あたり 8 bytes（誤差 float32 + セグメント番号 int32）
+    def __init__(self, segment_ids):
+        self.segment_ids = list(segment_ids)
+        self.codes = {segment_id: i for i, segment_id in enumerate(self.segment_ids)}
+        self.segments = []
+        self.errors = []
+
+    def add(self, segment_id, predictions, labels):
+        errors = np.asarray(predictions, dtype='float64') - labels
+        errors = errors[~np.isnan(errors)].astype('float32')
+        self.segments.append(np.full(len(errors), self.codes[segment_id], dtype='int32'))
+        self.errors.append(errors)
+
+    def evaluate(self):
+        # セグメントごとの MAE / RMSE / 誤差の分位点を groupby で一度に計算する
+        segments = np.concatenate(self.segments) if self.segments else np.array([], dtype='int32')
+        errors = np.concatenate(self.errors).astype('float64') if self.errors else np.array([])
+        columns = ['labeled_rows', 'MAE', 'RMSE', 'bias'] + [
+            f'p{int(q * 100)}_abs_error' for q in QUANTILES]
+        if len(errors):
+            df = pd.DataFrame({'segment': segments, 'error': errors,
+                               'abs_error': np.abs(errors), 'squared_error': errors ** 2})
+            grouped = df.groupby('segment')
+            table = pd.DataFrame({
+                'labeled_rows': grouped.size(),
+                'MAE': grouped['abs_error'].mean(),
+                'RMSE': np.sqrt(grouped['squared_error'].mean()),
+                'bias': grouped['error'].mean(),
+            })
+            quantiles = grouped['abs_error'].quantile(QUANTILES).unstack()
+            for q in QUANTILES:
+                table[f'p{int(q * 100)}_abs_error'] = quantiles[q]
+        else:
+            table = pd.DataFrame(columns=columns, dtype='float64')
+
+        # ラベルのないセグメントも行を残し、全体の行を最後に加える
+        table = table.reindex(range(len(self.segment_ids)))
+        table['labeled_rows'] = table['labeled_rows'].fillna(0).astype('int64')
+        table.index = self.segment_ids
+        overall = {
+            'labeled_rows': len(errors),
+            'MAE': np.abs(errors).mean() if len(errors) else np.nan,
+            'RMSE': np.sqrt((errors ** 2).mean()) if len(errors) else np.nan,
+            'bias': errors.mean() if len(errors) else np.nan,
+        }
+        for q in QUANTILES:
+            overall[f'p{int(q * 100)}_abs_error'] = (
+                np.quantile(np.abs(errors), q) if len(errors) else np.nan)
+        table.loc['all'] = pd.Series(overall)
+        table['labeled_rows'] = table['labeled_rows'].astype('int64')
+        table.index.name = 'segment'
+        return table
@@ -1,23 +1,128 @@
 import argparse
+from dataset_io import (get_dataset_path, is_dataset_file, iter_datasets,
+                        open_writer)
+import drift
+from evaluation import ErrorCollector, LabelReader
 import json
 import logging
 import os
 import pandas as pd
+from profiler import print_rollup, rollup
+from schema import LABEL
+from sketch import QuantileSketch
 from sklearn.model_selection import train_test_split
+import storage
 import sys
 import glob
+import time
+import yaml
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 logger.addHandler(logging.StreamHandler(sys.stdout))
 
 
+def get_segment_id(path):
+    # result_00.csv, 00.log, profile_00.json などからセグメント（モデル）の ID を取り出す
+    name = os.path.splitext(os.path.basename(path))[0]
+    return name.split('_')[-1]
+
+
+def list_inputs(input_files):
+    # pred.py の出力をセグメントごとの推論結果・使用したモデル・プロファイルなどに分ける
+    inputs = {'result': {}, 'log': {}, 'profile': {}, 'memo': {}, 'other': []}
+    for file in sorted(input_files):
+        name = os.path.basename(file)
+        if name.startswith('result_') and is_dataset_file(name):
+            inputs['result'][get_segment_id(file)] = file
+        elif name.endswith('.log'):
+            inputs['log'][get_segment_id(file)] = file
+        elif name.startswith('profile_') and name.endswith('.json'):
+            inputs['profile'][get_segment_id(file)] = file
+        elif name.startswith('memo_') and name.endswith('.json'):
+            inputs['memo'][get_segment_id(file)] = file
+        else:
+            inputs['other'].append(file)
+    return inputs
+
+
+def load_json(files):
+    result = {}
+    for segment_id, file in files.items():
+        with open(file) as f:
+            result[segment_id] = json.load(f)
+    return result
+
+
+def load_models(log_files):
+    # 各セグメントの推論に使用したモデルのパス（pred.py が <id>.log に書き出したもの）
+    models = {}
+    for segment_id, file in log_files.items():
+        with open(file) as f:
+            models[segment_id] = f.read().strip()
+    return models
+
+
+def list_label_files(path):
+    # 推論の入力（pred_<id>）をセグメントごとにまとめる（pred.py と同じくファイル名の順）
+    label_files = {}
+    if path and os.path.isdir(path):
+        for file in sorted(os.listdir(path)):
+            if is_dataset_file(file):
+                label_files.setdefault(get_segment_id(file), []).append(
+                    os.path.join(path, file))
+    return label_files
+
+
+def merge_results(result_files, models, output_file, chunk_size, threads,
+                  label_files=None, collector=None, sketches=None):
+    # 全セグメントの推論結果を 1 つのファイルにまとめる
+    # チャンク単位で読み書きするので、メモリは結果の合計サイズによらず一定
+    # collector を指定すると、同じ行の正解ラベルと突き合わせて誤差を集める
+    # sketches を指定すると、セグメントごとの推論結果の分布のスケッチを作る
+    segments = {segment_id: {'rows': 0, 'seconds': 0.0} for segment_id in result_files}
+    segment_ids = sorted(result_files)
+    paths = [result_files[segment_id] for segment_id in segment_ids]
+    segment_of = dict(zip(paths, segment_ids))
+    label_readers = {}
+    writer = open_writer(output_file)
+    try:
+        last_time = time.time()
+        for path, chunk in iter_datasets(paths, chunk_size, threads=threads):
+            segment_id = segment_of[path]
+            if collector is not None and segment_id in label_files:
+                if segment_id not in label_readers:
+                    label_readers = {segment_id: LabelReader(label_files[segment_id],
+                                                             chunk_size)}
+                collector.add(segment_id, chunk[LABEL].to_numpy(),
+                              label_readers[segment_id].read(len(chunk)))
+            if sketches is not None:
+                sketches.setdefault(segment_id, QuantileSketch()).add(
+                    chunk[LABEL].to_numpy())
+            chunk.insert(0, 'segment', segment_id)
+            chunk.insert(1, 'model', models.get(segment_id, ''))
+            writer.write(chunk)
+            segments[segment_id]['rows'] += len(chunk)
+            now = time.time()
+            segments[segment_id]['seconds'] += now - last_time
+            last_time = now
+    finally:
+        writer.close()
+    return segments
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
 
     # Data and model checkpoints directories
     parser.add_argument('--num-of-dataset', type=int, default=1, metavar='N',
                         help='N of dataset')
+    parser.add_argument('--chunk-size', type=int, default=1000000, metavar='N',
+                        help='rows read and written at once')
+    parser.add_argument('--num-of-threads', type=int, default=4, metavar='N',
+                        help='result files read concurrently')
+    parser.add_argument('--sketch-path', type=str, default='',
+                        help='s3 uri to keep distribution sketches for comparison with the next run (disabled if omitted)')
     args = parser.parse_args()
 
     # 複数インスタンスを使用した場合に、自分がどのインスタンス（ID）なのかを取得
@@ -39,15 +144,116 @@ if __name__ == '__main__':
         inputs = processingjobconfig['ProcessingInputs']
         code_path = ''
         input_data_path = ''
+        label_data_path = ''
         for i in inputs:
             if i['InputName'] == 'code':
                 code_path = i['S3Input']['LocalPath']
             elif i['InputName'] == 'data':
                 input_data_path = i['S3Input']['LocalPath']
+            elif i['InputName'] == 'labels':
+                label_data_path = i['S3Input']['LocalPath']
 
+    start_time = time.time()
     input_files = glob.glob(f"{input_data_path}/*")
     print('input:', str(len(input_files)), input_files[:100])
     print('code:', glob.glob(f"{code_path}/*"))
 
-    for file in input_files:
-        print(file)
\ No newline at end of file
+    config_file = os.path.join(code_path, 'config.yml')
+    with open(config_file) as f:
+        config = yaml.safe_load(f)
+    output_format = config.get('output_prediction_format', 'csv')
+
+    inputs = list_inputs(input_files)
+    for file in inputs['other']:
+        print(file)
+    models = load_models(inputs['log'])
+    profiles = load_json(inputs['profile'])
+    memos = load_json(inputs['memo'])
+
+    # セグメントごとの推論結果を、セグメント ID と使用したモデルの列を付けて 1 つにまとめる
+    result_file = get_dataset_path(output_data_path, 'result', output_format)
+    label_files = list_label_files(label_data_path)
+    collector = ErrorCollector(sorted(inputs['result'])) if label_files else None
+    prediction_sketches = {}
+    merge_start = time.time()
+    segments = merge_results(inputs['result'], models, result_file,
+                             args.chunk_size, args.num_of_threads,
+                             label_files, collector, prediction_sketches)
+    merge_seconds = time.time() - merge_start
+    num_of_rows = sum(s['rows'] for s in segments.values())
+    print(f'merged {num_of_rows} rows of {len(segments)} segments into {result_file} '
+          f'in {merge_seconds:.1f} sec ({num_of_rows / max(merge_seconds, 1e-9):.0f} rows/sec)')
+
+    expected = [str(i).zfill(2) for i in range(args.num_of_dataset)]
+    missing = [segment_id for segment_id in expected if segment_id not in segments]
+    if missing:
+        print('WARN: no result for segments', missing)
+
+    # 各セグメントの推論でどのフェーズに時間がかかったかを集計する
+    phases = rollup(list(profiles.values()))
+    print_rollup(phases)
+
+    # 正解ラベルが分かっている行について、セグメントごとの推論の誤差を集計する
+    evaluation = None
+    overall = None
+    if collector is not None:
+        evaluation = collector.evaluate()
+        evaluation.to_csv(os.path.join(output_data_path, 'evaluation.csv'))
+        with pd.option_context('display.width', 200, 'display.max_columns', None,
+                               'display.max_rows', 20):
+            print(evaluation)
+        overall = json.loads(evaluation.loc['all'].to_json())
+        overall['labeled_rows'] = int(overall['labeled_rows'])
+
+    # 推論結果と主な特徴量の分布をスケッチにして保存し、前回の実行と比較する
+    # スケッチの大きさは行数によらず一定で、前回の推論結果を読み直す必要はない
+    feature_sketches = drift.sketch_features(label_files, config.get('drift_features', []),
+                                             args.chunk_size, args.num_of_threads)
+    sketches = drift.to_dict(prediction_sketches, feature_sketches)
+    with open(os.path.join(output_data_path, drift.SKETCH_NAME), 'w') as f:
+        json.dump(sketches, f)
+    drift_summary = None
+    if args.sketch_path:
+        s3_client = storage.get_client()
+        previous = drift.load_previous(s3_client, args.sketch_path)
+        if previous is not None:
+            drift_table = drift.compare_runs(previous, sketches,
+                                             config.get('drift_psi_threshold', 0.2),
+                                             config.get('drift_ks_threshold', 0.1))
+            drift_table.to_csv(os.path.join(output_data_path, 'drift.csv'), index=False)
+            drifted = drift_table[drift_table['drift']]
+            for _, row in drifted.iterrows():
+                print(f"WARN: drift in segment {row['segment']} {row['variable']}: "
+                      f"psi {row['psi']:.3f}, ks {row['ks']:.3f}, "
+                      f"mean {row['previous_mean']:.4g} -> {row['current_mean']:.4g}")
+            drift_summary = {
+                'previous_created_at': previous['created_at'],
+                'compared': len(drift_table),
+                'drifted': drifted[['segment', 'variable']].to_dict('records'),
+            }
+        drift.save_latest(s3_client, args.sketch_path, sketches)
+
+    # 実行結果の概要（行数・使用したモデル・処理時間）
+    for segment_id, segment in segments.items():
+        segment['model'] = models.get(segment_id)
+        if segment_id in profiles:
+            segment['pred_seconds'] = profiles[segment_id]['wall_seconds']
+        if segment_id in memos:
+            segment['memo_hit_rate'] = memos[segment_id]['hit_rate']
+        if evaluation is not None and evaluation.loc[segment_id, 'labeled_rows']:
+            segment['MAE'] = float(evaluation.loc[segment_id, 'MAE'])
+    summary = {
+        'rows': num_of_rows,
+        'segments': segments,
+        'missing_segments': missing,
+        'result': os.path.basename(result_file),
+        'evaluation': overall,
+        'drift': drift_summary,
+        'timings': {
+            'merge_seconds': merge_seconds,
+            'post_seconds': time.time() - start_time,
+            'pred_phases': phases,
+        },
+    }
+    with open(os.path.join(output_data_path, 'summary.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
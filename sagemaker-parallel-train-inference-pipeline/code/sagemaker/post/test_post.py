@@ -0,0 +1,27 @@
+import pandas as pd
+import pytest
+
+from dataset_io import iter_dataset, read_dataset, write_dataset
+import post
+from schema import LABEL
+
+
+@pytest.mark.parametrize('extension', ['.csv', '.parquet', '.arrow'])
+def test_merge_results_keeps_segment_ids(tmp_path, extension):
+    result_files = {}
+    for segment_id, values in [('000', [1.0, 2.0]), ('003', [3.0])]:
+        path = str(tmp_path / f'result_{segment_id}{extension}')
+        write_dataset(pd.DataFrame({LABEL: values}), path)
+        result_files[segment_id] = path
+    output_file = str(tmp_path / f'result{extension}')
+    segments = post.merge_results(result_files, {'000': 'model-a'}, output_file, 1, 2)
+    assert {segment_id: s['rows'] for segment_id, s in segments.items()} == {'000': 2, '003': 1}
+
+    # 読み直しても 0 埋めの ID のまま（CSV でも整数として読まない）
+    df = read_dataset(output_file)
+    assert list(df['segment']) == ['000', '000', '003']
+    assert list(df['model'].fillna('')) == ['model-a', 'model-a', '']
+    assert list(df[LABEL]) == [1.0, 2.0, 3.0]
+    chunks = list(iter_dataset(output_file, 2))
+    assert all(len(chunk) <= 2 for chunk in chunks)
+    assert list(chunks[-1]['segment']) == ['003']
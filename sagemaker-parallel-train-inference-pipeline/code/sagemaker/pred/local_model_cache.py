@@ -0,0 +1,75 @@
+import hashlib
+import os
+import shutil
+
+import model_artifact
+
+
+class LocalModelCache:
+    # 展開済みのモデルをローカル（またはマウントしたボリューム）に保存し、同じモデルの再ダウンロードを省く
+    # キーは bucket / key / ETag から作るので、S3 のモデルが上書きされた場合は別のエントリになる
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_key(self, s3_client, bucket, prefix, manifest):
+        etags = {}
+        paginator = s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=f'{prefix}/'):
+            for obj in page.get('Contents', []):
+                etags[obj['Key']] = obj['ETag']
+        h = hashlib.sha256(bucket.encode('utf-8'))
+        for file in sorted(manifest['files']):
+            key = f'{prefix}/{file}'
+            h.update(f'{key}:{etags[key]}'.encode('utf-8'))
+        return h.hexdigest()
+
+    def fetch(self, s3_client, bucket, prefix, threads=1, manifest=None):
+        # キャッシュにあればそのパスを、なければダウンロード・展開してからパスを返す
+        prefix = prefix.strip('/')
+        if manifest is None:
+            manifest = model_artifact.load_manifest(s3_client, bucket, prefix)
+        key = self.get_key(s3_client, bucket, prefix, manifest)
+        path = os.path.join(self.cache_dir, key)
+        if os.path.isdir(path):
+            print(f'model cache hit: s3://{bucket}/{prefix} -> {path}')
+            os.utime(path)
+            return path
+
+        print(f'model cache miss: s3://{bucket}/{prefix}')
+        # 展開途中のディレクトリを他のプロセスが使わないよう、別名で展開してから rename する
+        tmp_path = f'{path}.tmp-{os.getpid()}'
+        os.makedirs(tmp_path)
+        try:
+            model_artifact.fetch(s3_client, bucket, prefix, tmp_path, threads,
+                                 manifest)
+            os.rename(tmp_path, path)
+        except OSError:
+            # 他のプロセスが先に同じモデルを保存した
+            if not os.path.isdir(path):
+                raise
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        os.utime(path)
+        self.evict(keep=key)
+        return path
+
+    def evict(self, keep=None):
+        # 合計サイズが上限を超えた場合は、最後に使ってから時間が経ったものから削除する
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if '.tmp-' in name or not os.path.isdir(path):
+                continue
+            entries.append((os.path.getmtime(path), name,
+                            model_artifact.get_dir_size(path)))
+        total = sum(size for _, _, size in entries)
+        for _, name, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            print(f'model cache evict: {name} ({size} bytes)')
+            shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors=True)
+            total -= size
@@ -0,0 +1,60 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing as mp
+import os
+import pandas as pd
+from resources import get_cpu_count, limit_threads
+from threadpoolctl import threadpool_limits
+import time
+import torch
+from autogluon.tabular import TabularPredictor
+
+# ワーカープロセスごとに 1 回だけ読み込んだモデル
+predictor = None
+
+
+def init_worker(model_path, num_threads):
+    # 各ワーカーが全コアを使おうとして取り合わないよう、スレッド数を CPU 数 / ワーカー数にする
+    global predictor
+    limit_threads(num_threads)
+    threadpool_limits(num_threads)
+    torch.set_num_threads(num_threads)
+    predictor = TabularPredictor.load(model_path)
+
+
+def predict_block(df):
+    return predictor.predict(df)
+
+
+def get_worker_pid(_):
+    time.sleep(0.1)
+    return os.getpid()
+
+
+def warm_up(executor, num_of_workers, max_tries=10):
+    # 最初のチャンクの推論時間に、プロセスの起動とモデルの読み込みが含まれないようにする
+    pids = set()
+    for _ in range(max_tries):
+        pids.update(executor.map(get_worker_pid, range(num_of_workers)))
+        if len(pids) >= num_of_workers:
+            break
+
+
+def split_blocks(df, num_of_blocks):
+    block_size = max(-(-len(df) // num_of_blocks), 1)
+    return [df.iloc[i:i + block_size] for i in range(0, len(df), block_size)]
+
+
+def create_executor(model_path, num_of_workers):
+    num_threads = max(1, get_cpu_count() // num_of_workers)
+    print(f'parallel inference: {num_of_workers} workers x {num_threads} threads')
+    return ProcessPoolExecutor(max_workers=num_of_workers,
+                               mp_context=mp.get_context('spawn'),
+                               initializer=init_worker,
+                               initargs=(model_path, num_threads))
+
+
+def predict(executor, df, num_of_workers):
+    # map は投入した順に結果を返すので、元の行の順序のまま連結できる
+    if len(df) == 0:
+        return executor.submit(predict_block, df).result()
+    return pd.concat(executor.map(predict_block, split_blocks(df, num_of_workers)))
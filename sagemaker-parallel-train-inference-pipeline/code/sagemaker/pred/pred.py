@@ -1,27 +1,54 @@
 import argparse
-import boto3
+from dataset_io import (get_dataset_path, is_dataset_file, iter_dataset,
+                        open_writer, resolve_columns)
 import json
+from local_model_cache import LocalModelCache
+import model_artifact
 import os
-import pandas as pd
+import parallel_predict
+from prediction_memo import PredictionMemo, get_model_fingerprint
+import registry
 from pprint import pprint
+from profiler import Profiler, get_rss
+from resources import get_cpu_count, get_memory_limit
+from schema import LABEL, get_row_bytes
 import shutil
+import storage
+import time
 from sklearn.metrics import mean_absolute_error
 from sklearn.model_selection import train_test_split
 import torch
 import yaml
 from autogluon.tabular import TabularDataset, TabularPredictor
 
-s3_client = boto3.client('s3')
-s3 = boto3.resource('s3')
+PREDICT_MEMORY_FACTOR = 16
 
 
-def get_input_path(path):
-    file = os.listdir(path)[0]
-    if len(os.listdir(path)) > 1:
-        print("WARN: more than one file is found in this directory")
-    print(f"Using {file}")
-    filename = f"{path}/{file}"
-    return filename
+def get_input_files(path):
+    files = sorted(f for f in os.listdir(path) if is_dataset_file(f))
+    print(f"Using {len(files)} files: {files}")
+    return [f"{path}/{file}" for file in files]
+
+
+def get_model_id(filename):
+    return filename.split('_')[-1].split('.')[0]
+
+
+def group_by_model_id(files):
+    # ShardedByS3Key で割り当てられたファイルを、使うモデル（セグメント）ごとにまとめる
+    groups = {}
+    for file in files:
+        groups.setdefault(get_model_id(file), []).append(file)
+    return groups
+
+
+def get_chunk_size(columns, memory_fraction, reserved_bytes=0,
+                   min_chunk_size=1000):
+    # モデルを読み込んだ後の空きメモリのうち memory_fraction を 1 チャンクに使う
+    # 推論中は特徴量の変換や各モデルへの入力で、元のデータの数倍のメモリを使う
+    budget = (get_memory_limit() - get_rss() - reserved_bytes) * memory_fraction
+    row_bytes = get_row_bytes(columns) * PREDICT_MEMORY_FACTOR
+    return max(int(budget // row_bytes), min_chunk_size)
 
 
 def get_env_if_present(name):
@@ -33,16 +60,23 @@ def get_env_if_present(name):
 
 def latest_model_is_best(latest_model_path, num_of_dataset, thresh):
     result = True
+    s3_client = storage.get_client()
     bucket_name = latest_model_path.split('/')[2]
     latest_model_prefix = latest_model_path[6+len(bucket_name):]
 
+    # 学習ジョブのモデル一覧（registry.json）があれば、1 回の GET で全セグメントの評価値を得る
+    models = registry.load_registry(s3_client, bucket_name, latest_model_prefix)
+
     # ひとつでも評価値が閾値よりも低い場合は古いモデルを使う
     for i in range(num_of_dataset):
         model_id = str(i).zfill(2)
-        response = s3_client.get_object(
-                            Bucket=bucket_name,
-                            Key=os.path.join(latest_model_prefix, model_id, 'eval.yml'))
-        eval_dict = yaml.safe_load(response['Body'].read().decode('utf-8'))
+        if model_id in models:
+            eval_dict = models[model_id]
+        else:
+            response = s3_client.get_object(
+                                Bucket=bucket_name,
+                                Key=os.path.join(latest_model_prefix, model_id, 'eval.yml'))
+            eval_dict = yaml.safe_load(response['Body'].read().decode('utf-8'))
         print(f'MAE of model {model_id} is', eval_dict['MAE'], ', thresh is', thresh)
         if eval_dict['MAE'] > thresh:
             print('MAE', eval_dict['MAE'], 'is worse than thresh', thresh)
@@ -55,8 +89,10 @@ def latest_model_is_best(latest_model_path, num_of_dataset, thresh):
 def get_pretrained_model(model_id, latest_model_path,
                          previous_model_path, thresh,
                          num_of_dataset,
-                         model_path
+                         model_path,
+                         model_cache=None
                          ):
+    s3_client = storage.get_client()
     bucket_name = latest_model_path.split('/')[2]
     latest_model_prefix = latest_model_path[6+len(bucket_name):]
     previous_model_prefix = previous_model_path[6+len(bucket_name):]
@@ -83,13 +119,132 @@ def get_pretrained_model(model_id, latest_model_path,
     # else:
     #     print('The previous models are used.')
     #     prefix = previous_model_prefix
-    model_download_path = os.path.join(model_path, 'model.zip')
-    s3.meta.client.download_file(bucket_name,
-                                 os.path.join(prefix, model_id, 'model.zip'),
-                                 model_download_path
-                                 )
-    shutil.unpack_archive(model_download_path, model_path)
-    return prefix
+    # registry.json に保存形式が記録されていれば artifact.json を取得しない
+    manifest = registry.load_registry(s3_client, bucket_name, prefix).get(
+        model_id, {}).get('artifact')
+
+    # キャッシュを使う場合は、キャッシュ内の展開済みのディレクトリからモデルを読み込む
+    if model_cache is not None:
+        model_path = model_cache.fetch(s3_client, bucket_name,
+                                       os.path.join(prefix, model_id),
+                                       os.cpu_count() or 1, manifest)
+    else:
+        model_artifact.fetch(s3_client, bucket_name,
+                             os.path.join(prefix, model_id), model_path,
+                             os.cpu_count() or 1, manifest)
+    return prefix, model_path
+
+
+def get_model_entry(latest_model_path, prefix, model_id):
+    # 推論に使うモデルの評価値と保存形式（registry.json になければ eval.yml と artifact.json）
+    s3_client = storage.get_client()
+    bucket_name = latest_model_path.split('/')[2]
+    entry = registry.load_registry(s3_client, bucket_name, prefix).get(model_id)
+    if entry is None:
+        entry = registry.load_s3_entry(s3_client, bucket_name,
+                                       os.path.join(prefix, model_id))
+    return entry
+
+
+def predict_segment(model_id, pred_files, args, output_data_path,
+                    output_format, model_cache=None):
+    # 1 つのセグメントのモデルを 1 回だけ読み込み、そのセグメントのファイルをすべて推論する
+    profiler = Profiler(model_id)
+
+    download_path = os.path.join('/opt/ml/processing/input/model', model_id)
+    os.makedirs(download_path)
+    with profiler.phase('download'):
+        model_prefix, model_path = get_pretrained_model(
+                model_id,
+                args.latest_model_path,
+                args.previous_model_path,
+                args.metric_threshold,
+                args.num_of_dataset,
+                download_path,
+                model_cache
+        )
+
+    with open(os.path.join(output_data_path, f'{model_id}.log'), 'w') as f:
+        f.write(model_prefix)
+
+    # 並列に推論する場合は、各ワーカープロセスがモデルを 1 回だけ読み込む
+    num_of_workers = args.num_of_workers or get_cpu_count()
+    executor = None
+    reserved_bytes = 0
+    with profiler.phase('load'):
+        if num_of_workers > 1:
+            executor = parallel_predict.create_executor(model_path, num_of_workers)
+            parallel_predict.warm_up(executor, num_of_workers)
+            reserved_bytes = model_artifact.get_dir_size(model_path) * num_of_workers
+        else:
+            predictor = TabularPredictor.load(model_path)
+
+    def predict(df):
+        if executor is not None:
+            return parallel_predict.predict(executor, df, num_of_workers)
+        return predictor.predict(df)
+
+    # 前回の推論結果があれば、特徴量が前回と同じ行は推論せずに前回の結果を使う
+    memo = None
+    if args.memo_path:
+        model_fingerprint = get_model_fingerprint(
+            get_model_entry(args.latest_model_path, model_prefix, model_id))
+        memo = PredictionMemo(storage.get_client(), args.memo_path, model_id,
+                              model_fingerprint)
+
+    # 正解ラベルの列は推論に使わないので読み込まない
+    columns = resolve_columns(pred_files[0], exclude=[LABEL])
+    chunk_size = args.chunk_size or get_chunk_size(columns, args.memory_fraction,
+                                                   reserved_bytes)
+    print(f'[{model_id}] chunk size: {chunk_size} rows')
+
+    # チャンクごとに推論して結果を追記する（インスタンスのメモリより大きいファイルも推論できる）
+    # 同じセグメントのファイルが複数ある場合は、ファイル名の順に 1 つの結果ファイルにまとめる
+    result_file = get_dataset_path(output_data_path, f'result_{model_id}',
+                                   output_format)
+    writer = open_writer(result_file)
+    num_of_rows = 0
+    start_time = time.time()
+    try:
+        for pred_file in pred_files:
+            chunks = iter_dataset(pred_file, chunk_size, columns=columns)
+            while True:
+                with profiler.phase('read'):
+                    pred_df = next(chunks, None)
+                if pred_df is None:
+                    break
+                with profiler.phase('predict'):
+                    if memo is not None:
+                        result = memo.predict(pred_df, predict).rename(LABEL)
+                    else:
+                        result = predict(pred_df)
+                with profiler.phase('write'):
+                    writer.write(result.to_frame())
+                num_of_rows += len(pred_df)
+    finally:
+        writer.close()
+        if executor is not None:
+            executor.shutdown()
+    elapsed = time.time() - start_time
+    peak_rss = max(profiler.get_phase(name)['peak_rss_bytes']
+                   for name in ['read', 'predict', 'write']
+                   if profiler.get_phase(name) is not None)
+    print(f'[{model_id}] {num_of_rows} rows predicted in {elapsed:.1f} sec '
+          f'({num_of_rows / max(elapsed, 1e-9):.0f} rows/sec), '
+          f'peak rss {peak_rss / 1024 / 1024:.1f} MB')
+    if memo is not None:
+        print(f'[{model_id}] prediction memo hit rate: {memo.get_hit_rate():.1%} '
+              f'({memo.num_of_hits} / {memo.num_of_rows} rows)')
+        memo.save()
+        with open(os.path.join(output_data_path, f'memo_{model_id}.json'), 'w') as f:
+            json.dump({'model_id': model_id, 'rows': memo.num_of_rows,
+                       'hits': memo.num_of_hits, 'hit_rate': memo.get_hit_rate()},
+                      f, indent=2)
+    profiler.save(os.path.join(output_data_path, f'profile_{model_id}.json'))
+
+    # キャッシュ以外にダウンロードしたモデルは、次のセグメントのためにディスクから削除する
+    shutil.rmtree(download_path, ignore_errors=True)
+    return num_of_rows
 
 
 if __name__ == "__main__":
@@ -107,6 +262,18 @@ if __name__ == "__main__":
                         help='latest-model-path')
     parser.add_argument('--previous-model-path', type=str, default='', metavar='N',
                         help='previous-model-path')
+    parser.add_argument('--chunk-size', type=int, default=0, metavar='N',
+                        help='rows predicted at once (0: decided by the memory limit)')
+    parser.add_argument('--memory-fraction', type=float, default=0.5,
+                        help='fraction of free memory used by one chunk')
+    parser.add_argument('--model-cache-dir', type=str, default=None,
+                        help='directory to keep unpacked models across runs (disabled if omitted)')
+    parser.add_argument('--model-cache-size', type=float, default=10, metavar='GB',
+                        help='maximum total size of the model cache')
+    parser.add_argument('--num-of-workers', type=int, default=1, metavar='N',
+                        help='processes predicting in parallel (0: number of CPUs)')
+    parser.add_argument('--memo-path', type=str, default='',
+                        help='s3 uri to keep predictions for reuse in the next run (disabled if omitted)')
     args = parser.parse_args()
 
     # 複数インスタンスを使用した場合に、自分がどのインスタンス（ID）なのかを取得
@@ -134,25 +301,19 @@ if __name__ == "__main__":
             elif i['InputName'] == 'data':
                 input_data_path = i['S3Input']['LocalPath']
 
-    pred_file = get_input_path(input_data_path)
-    pred_df = pd.read_csv(pred_file)
-
-    model_path = '/opt/ml/processing/input/model'
-    os.makedirs(model_path)
-    model_id = pred_file.split('_')[-1].split('.')[0]
-    model_prefix = get_pretrained_model(
-            model_id,
-            args.latest_model_path,
-            args.previous_model_path,
-            args.metric_threshold,
-            args.num_of_dataset,
-            model_path
-    )
-
-    with open(os.path.join(output_data_path, f'{model_id}.log'), 'w') as f:
-        f.write(model_prefix)
+    config_file = os.path.join(code_path, 'config.yml')
+    with open(config_file) as f:
+        config = yaml.safe_load(f)
+    output_format = config.get('output_prediction_format', 'csv')
 
-    predictor = TabularPredictor.load(model_path)
+    model_cache = None
+    if args.model_cache_dir:
+        model_cache = LocalModelCache(args.model_cache_dir,
+                                      int(args.model_cache_size * 1024 ** 3))
 
-    result = predictor.predict(pred_df.drop(columns=['medianHouseValue']))
-    result.to_csv(os.path.join(output_data_path, f'result_{model_id}.csv'), index=None)
+    # このインスタンスに割り当てられたすべてのセグメントを推論する
+    groups = group_by_model_id(get_input_files(input_data_path))
+    for model_id, pred_files in sorted(groups.items()):
+        print(f'[{model_id}] predicting {len(pred_files)} files: {pred_files}')
+        predict_segment(model_id, pred_files, args, output_data_path,
+                        output_format, model_cache)
@@ -0,0 +1,87 @@
+import hashlib
+import io
+import json
+import numpy as np
+import pandas as pd
+
+from botocore.exceptions import ClientError
+
+import storage
+
+MEMO_NAME = 'memo.parquet'
+
+
+def get_model_fingerprint(entry):
+    # 学習の入力の fingerprint と artifact.json（ファイル・サイズ・保存時間）から作る
+    # キャッシュから復元したモデルは同じ値に、学習し直したモデルは別の値になる
+    return hashlib.sha256(json.dumps({
+        'fingerprint': entry.get('fingerprint'),
+        'artifact': entry.get('artifact'),
+    }, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def hash_rows(df):
+    # 特徴量の値から行ごとの 64 bit のハッシュを作る（行番号は含めない）
+    return pd.util.hash_pandas_object(df, index=False).to_numpy()
+
+
+class PredictionMemo:
+    # 前回の推論結果を行のハッシュで引けるようにしたもの
+    # <memo_path>/<model_id>/<モデルの fingerprint>/memo.parquet に保存するので、
+    # モデルが変わった場合は前回の結果を使わない
+    def __init__(self, s3_client, memo_path, model_id, model_fingerprint):
+        self.s3_client = s3_client
+        self.bucket, prefix = storage.split_s3_uri(memo_path)
+        self.key = f'{prefix}/{model_id}/{model_fingerprint}/{MEMO_NAME}'
+        self.previous = self.load()
+        self.hashes = []
+        self.predictions = []
+        self.num_of_rows = 0
+        self.num_of_hits = 0
+
+    def load(self):
+        try:
+            body = storage.get_bytes(self.s3_client, self.bucket, self.key)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchKey':
+                raise
+            print(f'prediction memo not found: s3://{self.bucket}/{self.key}')
+            return pd.Series(dtype='float32')
+        df = pd.read_parquet(io.BytesIO(body))
+        print(f'prediction memo: {len(df)} rows from s3://{self.bucket}/{self.key}')
+        return pd.Series(df['prediction'].to_numpy(), index=df['row_hash'].to_numpy())
+
+    def predict(self, df, predict):
+        # 前回と同じ行は前回の結果を使い、新しい行・変わった行だけを predict で推論する
+        hashes = hash_rows(df)
+        found = self.previous.reindex(hashes)
+        hit = found.notna().to_numpy()
+        if not hit.any():
+            result = np.asarray(predict(df))
+        elif hit.all():
+            result = found.to_numpy()
+        else:
+            predicted = np.asarray(predict(df[~hit]))
+            result = found.to_numpy().astype(
+                np.result_type(found.dtype, predicted.dtype))
+            result[~hit] = predicted
+        self.hashes.append(hashes)
+        self.predictions.append(result)
+        self.num_of_rows += len(df)
+        self.num_of_hits += int(hit.sum())
+        return pd.Series(result, index=df.index)
+
+    def get_hit_rate(self):
+        return self.num_of_hits / self.num_of_rows if self.num_of_rows else 0.0
+
+    def save(self):
+        # 次回のために今回の入力の行だけを保存する（前回にしかない行は捨てる）
+        df = pd.DataFrame({
+            'row_hash': np.concatenate(self.hashes) if self.hashes else np.array([], dtype='uint64'),
+            'prediction': np.concatenate(self.predictions) if self.predictions else np.array([]),
+        }).drop_duplicates('row_hash')
+        buffer = io.BytesIO()
+        df.to_parquet(buffer, index=False)
+        self.s3_client.put_object(Bucket=self.bucket, Key=self.key,
+                                  Body=buffer.getvalue())
+        print(f'prediction memo: saved {len(df)} rows to s3://{self.bucket}/{self.key}')
@@ -0,0 +1,472 @@
+import argparse
+from concurrent.futures import Future
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+from local_model_cache import LocalModelCache
+import math
+import os
+import pandas as pd
+from pred import get_pretrained_model
+import queue
+import re
+from schema import LABEL, apply_schema, get_read_dtypes
+import shutil
+import tempfile
+import threading
+import time
+from autogluon.tabular import TabularPredictor
+
+
+class LatencyHistogram:
+    # 指数的に幅が広がるバケット（ms）で件数を数え、パーセンタイルを近似する
+    # 値を保持しないので、長時間動かしてもメモリは増えない
+    def __init__(self, min_ms=0.1, max_ms=60000, buckets_per_decade=10):
+        self.min_ms = min_ms
+        self.buckets_per_decade = buckets_per_decade
+        num_of_buckets = int(math.ceil(
+            math.log10(max_ms / min_ms) * buckets_per_decade)) + 1
+        self.counts = [0] * (num_of_buckets + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.lock = threading.Lock()
+
+    def get_upper_ms(self, i):
+        return self.min_ms * 10 ** (i / self.buckets_per_decade)
+
+    def record(self, seconds):
+        ms = seconds * 1000
+        if ms <= self.min_ms:
+            i = 0
+        else:
+            i = int(math.ceil(math.log10(ms / self.min_ms) * self.buckets_per_decade))
+        with self.lock:
+            self.counts[min(i, len(self.counts) - 1)] += 1
+            self.count += 1
+            self.total_ms += ms
+            self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, p):
+        # p パーセンタイルを含むバケットの上限を返す
+        with self.lock:
+            if not self.count:
+                return 0.0
+            rank = self.count * p / 100
+            seen = 0
+            for i, count in enumerate(self.counts):
+                seen += count
+                if seen >= rank and count:
+                    return min(self.get_upper_ms(i), self.max_ms)
+            return self.max_ms
+
+    def to_dict(self):
+        result = {
+            'count': self.count,
+            'mean_ms': self.total_ms / self.count if self.count else 0.0,
+            'max_ms': self.max_ms,
+        }
+        for p in [50, 90, 99]:
+            result[f'p{p}_ms'] = self.percentile(p)
+        return result
+
+
+class LoadedModel:
+    # 読み込み中・読み込み済みのモデル
+    # 使用中（refs > 0）に捨てられた場合は、最後の推論が終わってからファイルを消す
+    def __init__(self, model_id):
+        self.model_id = model_id
+        self.loaded = Future()
+        self.download_path = None
+        self.last_used = time.time()
+        self.refs = 0
+        self.evicted = False
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.evicted:
+                return False
+            self.refs += 1
+            self.last_used = time.time()
+            return True
+
+    def release(self):
+        with self.lock:
+            self.refs -= 1
+            return self.evicted and self.refs == 0
+
+    def evict(self):
+        with self.lock:
+            self.evicted = True
+            return self.refs == 0
+
+
+class ModelStore:
+    # 読み込み済みの TabularPredictor を最大 max_models 個まで保持し、最後に使ってから時間が経ったものから捨てる
+    def __init__(self, args, max_models, model_cache=None):
+        self.args = args
+        self.max_models = max_models
+        self.model_cache = model_cache
+        self.models = {}
+        # models の追加・削除にだけ使う（ダウンロードや読み込みの間は持たない）
+        self.lock = threading.Lock()
+        self.load_times = LatencyHistogram()
+        self.download_dir = tempfile.mkdtemp(prefix='serve-')
+
+    def get_model_path(self, model_id):
+        # ファイルシステム上のモデル（展開済みのディレクトリ）を使う場合は S3 にアクセスしない
+        if self.args.model_dir:
+            return os.path.join(self.args.model_dir, model_id), None
+        # 捨てたモデルを使用中に同じモデルを読み込み直すことがあるので、読み込みごとに別のディレクトリにする
+        download_path = tempfile.mkdtemp(prefix=f'{model_id}-', dir=self.download_dir)
+        _, model_path = get_pretrained_model(
+                model_id,
+                self.args.latest_model_path,
+                self.args.previous_model_path,
+                self.args.metric_threshold,
+                self.args.num_of_dataset,
+                download_path,
+                self.model_cache
+        )
+        return model_path, download_path
+
+    @contextmanager
+    def use(self, model_id):
+        # with model_store.use(model_id) as predictor: の間はモデルのファイルを消さない
+        # 読み込み済みのモデルはストア全体のロックを取らずに使う
+        entry = self.models.get(model_id)
+        if entry is None or not entry.acquire():
+            entry = self.load(model_id)
+        try:
+            yield entry.loaded.result()
+        finally:
+            if entry.release():
+                self.delete(entry)
+
+    def load(self, model_id):
+        with self.lock:
+            entry = self.models.get(model_id)
+            # 他のスレッドが読み込み中・読み込み済みの場合は、その結果を待つ
+            if entry is not None and entry.acquire():
+                return entry
+            entry = LoadedModel(model_id)
+            entry.acquire()
+            self.models[model_id] = entry
+        # 同じモデルの読み込みは 1 回だけで、読み込み中も他のモデルの推論は止めない
+        start_time = time.time()
+        try:
+            model_path, entry.download_path = self.get_model_path(model_id)
+            predictor = TabularPredictor.load(model_path)
+            # AutoGluon は predict のときにモデルをディスクから読み込むので、メモリに載せておく
+            # （ローカルのキャッシュの容量制限などでファイルが消されても推論できるようにする）
+            predictor.persist_models(max_memory=None)
+        except Exception as e:
+            with self.lock:
+                if self.models.get(model_id) is entry:
+                    del self.models[model_id]
+            entry.evict()
+            entry.loaded.set_exception(e)
+            return entry
+        self.load_times.record(time.time() - start_time)
+        print(f'[{model_id}] loaded from {model_path} in {time.time() - start_time:.2f} sec')
+        entry.loaded.set_result(predictor)
+        self.evict()
+        return entry
+
+    def evict(self):
+        with self.lock:
+            # 使用中でないものを優先して、最後に使ってから時間が経ったものから捨てる
+            loaded = sorted((entry for entry in self.models.values() if entry.loaded.done()),
+                            key=lambda entry: (entry.refs > 0, entry.last_used))
+            evicted = loaded[:max(len(self.models) - self.max_models, 0)]
+            for entry in evicted:
+                del self.models[entry.model_id]
+        for entry in evicted:
+            print(f'[{entry.model_id}] unloaded')
+            if entry.evict():
+                self.delete(entry)
+
+    def delete(self, entry):
+        if entry.download_path is not None:
+            shutil.rmtree(entry.download_path, ignore_errors=True)
+
+    def close(self):
+        shutil.rmtree(self.download_dir, ignore_errors=True)
+
+
+def normalize_model_id(model_id, num_of_dataset):
+    # リクエストのパスの model_id は、0 以上 num_of_dataset 未満の数字だけを受け付ける
+    # （ディレクトリ名や S3 のキーに使うので、それ以外の文字列は扱わない）
+    if not re.fullmatch('[0-9]+', model_id) or int(model_id) >= num_of_dataset:
+        return None
+    return str(int(model_id)).zfill(2)
+
+
+class MicroBatcher(threading.Thread):
+    # 同じモデルへのリクエストを最大 max_wait_ms 待って max_batch_rows 行までまとめ、1 回の predict で推論する
+    # idle_timeout 秒リクエストがなければスレッドを終了し、on_exit でサーバーから外す
+    def __init__(self, model_id, model_store, max_batch_rows, max_wait_ms,
+                 idle_timeout=None, on_exit=None):
+        super().__init__(daemon=True)
+        self.model_id = model_id
+        self.model_store = model_store
+        self.max_batch_rows = max_batch_rows
+        self.max_wait = max_wait_ms / 1000
+        self.idle_timeout = idle_timeout
+        self.on_exit = on_exit
+        self.requests = queue.Queue()
+        self.stopped = False
+        self.lock = threading.Lock()
+        self.queue_times = LatencyHistogram()
+        self.predict_times = LatencyHistogram()
+        self.batch_rows = []
+        self.start()
+
+    def submit(self, df):
+        # 終了したスレッドには追加せず None を返す（呼び出し側が新しいスレッドに送り直す）
+        future = Future()
+        with self.lock:
+            if self.stopped:
+                return None
+            self.requests.put((df, future, time.time()))
+        return future
+
+    def stop_if_idle(self):
+        with self.lock:
+            if self.requests.empty():
+                self.stopped = True
+        return self.stopped
+
+    def collect(self):
+        try:
+            batch = [self.requests.get(timeout=self.idle_timeout)]
+        except queue.Empty:
+            return None
+        num_of_rows = len(batch[0][0])
+        deadline = time.time() + self.max_wait
+        while num_of_rows < self.max_batch_rows:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            num_of_rows += len(request[0])
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect()
+            if batch is None:
+                if self.stop_if_idle():
+                    break
+                continue
+            self.predict(batch)
+        print(f'[{self.model_id}] batcher stopped after {self.idle_timeout} sec idle')
+        if self.on_exit is not None:
+            self.on_exit(self)
+
+    def predict(self, batch):
+        start_time = time.time()
+        for _, _, submitted_at in batch:
+            self.queue_times.record(start_time - submitted_at)
+        try:
+            with self.model_store.use(self.model_id) as predictor:
+                df = pd.concat([df for df, _, _ in batch], ignore_index=True)
+                result = predictor.predict(df).to_numpy()
+        except Exception as e:
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+        self.predict_times.record(time.time() - start_time)
+        self.batch_rows.append(len(df))
+        # 各リクエストの行数で結果を分けて返す
+        offset = 0
+        for request_df, future, _ in batch:
+            future.set_result(result[offset:offset + len(request_df)])
+            offset += len(request_df)
+
+    def get_metrics(self):
+        batch_rows = self.batch_rows[-1000:]
+        return {
+            'queue': self.queue_times.to_dict(),
+            'predict': self.predict_times.to_dict(),
+            'batches': len(self.batch_rows),
+            'mean_batch_rows': sum(batch_rows) / len(batch_rows) if batch_rows else 0,
+        }
+
+
+class InferenceServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, model_store, num_of_dataset, max_batch_rows,
+                 max_wait_ms, request_timeout, idle_timeout):
+        super().__init__(address, RequestHandler)
+        self.model_store = model_store
+        self.num_of_dataset = num_of_dataset
+        self.max_batch_rows = max_batch_rows
+        self.max_wait_ms = max_wait_ms
+        self.request_timeout = request_timeout
+        self.idle_timeout = idle_timeout
+        # model_id は num_of_dataset 未満に限るので、スレッドは最大 num_of_dataset 個
+        self.batchers = {}
+        self.batchers_lock = threading.Lock()
+        self.request_times = LatencyHistogram()
+
+    def get_batcher(self, model_id):
+        with self.batchers_lock:
+            if model_id not in self.batchers or self.batchers[model_id].stopped:
+                self.batchers[model_id] = MicroBatcher(
+                    model_id, self.model_store, self.max_batch_rows, self.max_wait_ms,
+                    self.idle_timeout, self.remove_batcher)
+            return self.batchers[model_id]
+
+    def remove_batcher(self, batcher):
+        with self.batchers_lock:
+            if self.batchers.get(batcher.model_id) is batcher:
+                del self.batchers[batcher.model_id]
+
+    def submit(self, model_id, df):
+        while True:
+            future = self.get_batcher(model_id).submit(df)
+            if future is not None:
+                return future
+
+    def get_metrics(self):
+        return {
+            'request': self.request_times.to_dict(),
+            'load': self.model_store.load_times.to_dict(),
+            'loaded_models': list(self.model_store.models),
+            'models': {model_id: batcher.get_metrics()
+                       for model_id, batcher in sorted(list(self.batchers.items()))},
+        }
+
+
+def read_request(body, content_type):
+    # JSON（レコードのリスト、または {"instances": [...]}）か、ヘッダー付きの CSV を受け付ける
+    # バッチの推論（read_dataset）と同じく、schema.py で宣言した型で読み込む
+    dtypes = get_read_dtypes()
+    if content_type.startswith('text/csv'):
+        df = pd.read_csv(io.BytesIO(body), dtype=dtypes)
+    else:
+        records = json.loads(body.decode('utf-8'))
+        if isinstance(records, dict):
+            records = records['instances']
+        if not isinstance(records, list) or not all(isinstance(r, dict) for r in records):
+            raise ValueError('expected a list of records')
+        df = pd.DataFrame.from_records(records)
+        df = df.astype({name: dtypes[name] for name in df.columns if name in dtypes})
+    return apply_schema(df.drop(columns=[LABEL], errors='ignore'))
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    # GET  /ping                    : ヘルスチェック
+    # GET  /metrics                 : レイテンシのヒストグラム（JSON）
+    # POST /models/<model_id>/predict : 推論
+    def send_json(self, status, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/ping':
+            self.send_json(200, {'status': 'ok'})
+        elif self.path == '/metrics':
+            self.send_json(200, self.server.get_metrics())
+        else:
+            self.send_json(404, {'error': f'not found: {self.path}'})
+
+    def do_POST(self):
+        start_time = time.time()
+        parts = self.path.strip('/').split('/')
+        if len(parts) != 3 or parts[0] != 'models' or parts[2] != 'predict':
+            self.send_json(404, {'error': f'not found: {self.path}'})
+            return
+        model_id = normalize_model_id(parts[1], self.server.num_of_dataset)
+        if model_id is None:
+            self.send_json(404, {'error': f'unknown model: {parts[1]}'})
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            df = read_request(body, self.headers.get('Content-Type', ''))
+        except Exception as e:
+            # 読み込めないリクエストは、接続を切らずに 400 を返す
+            self.send_json(400, {'error': f'invalid request: {type(e).__name__}: {e}'})
+            return
+        if not len(df):
+            self.send_json(200, {'model_id': model_id, 'predictions': []})
+            return
+        try:
+            result = self.server.submit(model_id, df).result(
+                timeout=self.server.request_timeout)
+        except Exception as e:
+            self.send_json(500, {'error': f'{type(e).__name__}: {e}'})
+            return
+        self.send_json(200, {'model_id': model_id, 'predictions': result.tolist()})
+        self.server.request_times.record(time.time() - start_time)
+
+    def log_message(self, format, *args):
+        # リクエストごとのアクセスログは出さない（/metrics で確認する）
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='serve predictions of the trained models over HTTP')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='address to listen on')
+    parser.add_argument('--port', type=int, default=8080, metavar='N',
+                        help='port to listen on')
+    parser.add_argument('--model-dir', type=str, default=None,
+                        help='local directory of unpacked models (<model-dir>/<model_id>); S3 is not used if set')
+    parser.add_argument('--num-of-dataset', type=int, default=1, metavar='N',
+                        help='N of dataset')
+    parser.add_argument('--metric-threshold', type=float, default=1, metavar='N',
+                        help='metric-threshold')
+    parser.add_argument('--latest-model-path', type=str, default='', metavar='N',
+                        help='latest-model-path')
+    parser.add_argument('--previous-model-path', type=str, default='', metavar='N',
+                        help='previous-model-path')
+    parser.add_argument('--model-cache-dir', type=str, default=None,
+                        help='directory to keep unpacked models across runs (disabled if omitted)')
+    parser.add_argument('--model-cache-size', type=float, default=10, metavar='GB',
+                        help='maximum total size of the model cache')
+    parser.add_argument('--max-models', type=int, default=4, metavar='N',
+                        help='models kept loaded in memory')
+    parser.add_argument('--max-batch-rows', type=int, default=10000, metavar='N',
+                        help='rows predicted at once by merging requests')
+    parser.add_argument('--max-wait-ms', type=float, default=5, metavar='MS',
+                        help='time to wait for other requests to merge')
+    parser.add_argument('--request-timeout', type=float, default=300, metavar='SEC',
+                        help='time to wait for a prediction (including model loading)')
+    parser.add_argument('--idle-timeout', type=float, default=600, metavar='SEC',
+                        help='time after which the batching thread of an unused model stops')
+    args = parser.parse_args()
+
+    if not args.model_dir and not args.latest_model_path:
+        parser.error('either --model-dir or --latest-model-path is required')
+
+    model_cache = None
+    if args.model_cache_dir:
+        model_cache = LocalModelCache(args.model_cache_dir,
+                                      int(args.model_cache_size * 1024 ** 3))
+    model_store = ModelStore(args, args.max_models, model_cache)
+    server = InferenceServer((args.host, args.port), model_store,
+                             args.num_of_dataset, args.max_batch_rows,
+                             args.max_wait_ms, args.request_timeout,
+                             args.idle_timeout)
+    print(f'listening on http://{args.host}:{server.server_port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        model_store.close()
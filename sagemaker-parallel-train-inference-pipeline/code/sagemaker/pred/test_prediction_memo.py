@@ -0,0 +1,88 @@
+import numpy as np
+import pandas as pd
+
+import prediction_memo
+from prediction_memo import PredictionMemo, get_model_fingerprint
+
+BUCKET = 'bucket'
+MEMO_PATH = f's3://{BUCKET}/prefix/pred-memo'
+ENTRY = {'MAE': 1.0, 'fingerprint': 'fp', 'artifact': {'format': 'zip', 'files': ['model.zip']}}
+
+
+class CountingModel:
+    # 推論した行数を数える
+    def __init__(self):
+        self.rows = 0
+
+    def __call__(self, df):
+        self.rows += len(df)
+        return (df['x'] * 10).astype('float32').to_numpy()
+
+
+def test_model_fingerprint():
+    fingerprint = get_model_fingerprint(ENTRY)
+    # 評価値が違っても同じモデル（キャッシュから復元したモデルなど）なら同じ値
+    assert fingerprint == get_model_fingerprint(dict(ENTRY, MAE=2.0))
+    assert fingerprint != get_model_fingerprint(dict(ENTRY, fingerprint='fp2'))
+    assert fingerprint != get_model_fingerprint(dict(ENTRY, artifact={'format': 'tar'}))
+
+
+def test_hash_rows_ignores_index():
+    df = pd.DataFrame({'x': [1.0, 2.0], 'y': [3, 4]})
+    assert (prediction_memo.hash_rows(df) == prediction_memo.hash_rows(df.set_axis([5, 6]))).all()
+    assert prediction_memo.hash_rows(df)[0] != prediction_memo.hash_rows(df)[1]
+
+
+def test_memo_reuses_previous_predictions(s3_client):
+    model = CountingModel()
+    memo = PredictionMemo(s3_client, MEMO_PATH, '00', 'model-fp')
+    df = pd.DataFrame({'x': [1.0, 2.0, 3.0]})
+    assert list(memo.predict(df, model)) == [10.0, 20.0, 30.0]
+    assert memo.get_hit_rate() == 0.0
+    memo.save()
+
+    # 2 回目は前回と同じ行を推論しない（変わった行・新しい行だけを推論する）
+    memo = PredictionMemo(s3_client, MEMO_PATH, '00', 'model-fp')
+    df = pd.DataFrame({'x': [3.0, 4.0, 1.0, 5.0]}, index=[10, 11, 12, 13])
+    result = memo.predict(df, model)
+    assert list(result.index) == [10, 11, 12, 13]
+    assert np.allclose(result.to_numpy(), [30.0, 40.0, 10.0, 50.0])
+    assert model.rows == 3 + 2
+    assert memo.num_of_hits == 2
+    assert memo.get_hit_rate() == 0.5
+
+    # すべて前回と同じ場合は推論しない
+    memo.save()
+    memo = PredictionMemo(s3_client, MEMO_PATH, '00', 'model-fp')
+    memo.predict(df, model)
+    assert model.rows == 5
+    assert memo.get_hit_rate() == 1.0
+
+
+def test_memo_is_separated_by_model(s3_client):
+    model = CountingModel()
+    memo = PredictionMemo(s3_client, MEMO_PATH, '00', 'model-fp')
+    df = pd.DataFrame({'x': [1.0, 2.0]})
+    memo.predict(df, model)
+    memo.save()
+    # モデルが変わった場合・別のセグメントは前回の結果を使わない
+    for model_id, model_fingerprint in [('00', 'other-fp'), ('01', 'model-fp')]:
+        memo = PredictionMemo(s3_client, MEMO_PATH, model_id, model_fingerprint)
+        memo.predict(df, model)
+        assert memo.num_of_hits == 0
+    assert model.rows == 6
+
+
+def test_memo_save_keeps_only_current_rows(s3_client):
+    model = CountingModel()
+    memo = PredictionMemo(s3_client, MEMO_PATH, '00', 'model-fp')
+    memo.predict(pd.DataFrame({'x': [1.0, 2.0]}), model)
+    memo.predict(pd.DataFrame({'x': [2.0, 3.0]}), model)
+    memo.save()
+    memo = PredictionMemo(s3_client, MEMO_PATH, '00', 'model-fp')
+    assert sorted(memo.previous.to_numpy()) == [10.0, 20.0, 30.0]
+
+    memo.predict(pd.DataFrame({'x': [3.0]}), model)
+    memo.save()
+    memo = PredictionMemo(s3_client, MEMO_PATH, '00', 'model-fp')
+    assert list(memo.previous.to_numpy()) == [30.0]
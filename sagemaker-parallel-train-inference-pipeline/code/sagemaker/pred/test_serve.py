@@ -0,0 +1,198 @@
+import json
+import os
+import threading
+import time
+from types import SimpleNamespace
+import urllib.error
+import urllib.request
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('autogluon.tabular')
+import serve  # noqa: E402
+
+
+class FakePredictor:
+    # TabularPredictor の代わり（load をブロックして、読み込み中の動作を確認できる）
+    loads = []
+    gate = {}
+
+    def __init__(self, path):
+        self.path = path
+        self.persisted = False
+
+    @classmethod
+    def load(cls, path):
+        cls.loads.append(os.path.basename(path))
+        event = cls.gate.get(os.path.basename(path))
+        if event is not None:
+            event.wait(10)
+        if os.path.basename(path) == '02':
+            raise FileNotFoundError(path)
+        return cls(path)
+
+    def persist_models(self, max_memory=0.1):
+        self.persisted = True
+
+    def predict(self, df):
+        return df['x'] * 2
+
+
+@pytest.fixture
+def store(monkeypatch, tmp_path):
+    monkeypatch.setattr(serve, 'TabularPredictor', FakePredictor)
+    FakePredictor.loads = []
+    FakePredictor.gate = {}
+    args = SimpleNamespace(model_dir=str(tmp_path), num_of_dataset=3)
+    model_store = serve.ModelStore(args, max_models=1)
+
+    def get_model_path(model_id):
+        download_path = os.path.join(str(tmp_path), 'download', f'{model_id}-{len(FakePredictor.loads)}')
+        os.makedirs(download_path)
+        return os.path.join(str(tmp_path), model_id), download_path
+    monkeypatch.setattr(model_store, 'get_model_path', get_model_path)
+    yield model_store
+    model_store.close()
+
+
+def test_normalize_model_id():
+    assert serve.normalize_model_id('00', 3) == '00'
+    assert serve.normalize_model_id('2', 3) == '02'
+    assert serve.normalize_model_id('123', 200) == '123'
+    for model_id in ['3', '..', '00/..', '-1', '', '１', '0x1']:
+        assert serve.normalize_model_id(model_id, 3) is None
+
+
+def test_store_loads_once_and_persists(store):
+    results = []
+
+    def use():
+        with store.use('00') as predictor:
+            results.append(predictor)
+    threads = [threading.Thread(target=use) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert FakePredictor.loads == ['00']
+    assert len(set(map(id, results))) == 1
+    assert results[0].persisted
+
+
+def test_store_serves_loaded_model_while_loading_another(store):
+    store.max_models = 2
+    with store.use('00'):
+        pass
+    FakePredictor.gate['01'] = threading.Event()
+
+    def load():
+        with store.use('01'):
+            pass
+    loader = threading.Thread(target=load)
+    loader.start()
+    time.sleep(0.1)
+    # 01 の読み込み中でも、読み込み済みの 00 はすぐに使える
+    start = time.time()
+    with store.use('00') as predictor:
+        assert predictor.path.endswith('00')
+    assert time.time() - start < 1
+    FakePredictor.gate['01'].set()
+    loader.join()
+
+
+def test_store_defers_deletion_of_evicted_model(store):
+    with store.use('00'):
+        download_path = store.models['00'].download_path
+        # 使用中の 00 は 01 の読み込みで捨てられるが、ファイルは使い終わるまで残す
+        with store.use('01'):
+            pass
+        assert '00' not in store.models
+        assert os.path.exists(download_path)
+    assert not os.path.exists(download_path)
+    assert list(store.models) == ['01']
+
+
+def test_store_does_not_keep_failed_load(store):
+    for _ in range(2):
+        with pytest.raises(FileNotFoundError):
+            with store.use('02'):
+                pass
+    assert FakePredictor.loads == ['02', '02']
+    assert not store.models
+
+
+def test_batcher_stops_when_idle(store):
+    stopped = []
+    batcher = serve.MicroBatcher('00', store, 100, 1, idle_timeout=0.2,
+                                 on_exit=stopped.append)
+    assert list(batcher.submit(pd.DataFrame({'x': [1, 2]})).result(5)) == [2, 4]
+    batcher.join(5)
+    assert stopped == [batcher]
+    assert batcher.submit(pd.DataFrame({'x': [1]})) is None
+
+
+def test_read_request_applies_schema():
+    csv = b'longitude,housingMedianAge,medianHouseValue\n-122.2,41.0,100000\n-122.3,21,\n'
+    records = [{'longitude': -122.2, 'housingMedianAge': 41.0, 'medianHouseValue': 100000},
+               {'longitude': -122.3, 'housingMedianAge': 21}]
+    # CSV と JSON のどちらでも、バッチの推論と同じ型になる（正解ラベルの列は外す）
+    for df in [serve.read_request(csv, 'text/csv'),
+               serve.read_request(json.dumps(records).encode('utf-8'), 'application/json'),
+               serve.read_request(json.dumps({'instances': records}).encode('utf-8'), '')]:
+        assert list(df.columns) == ['longitude', 'housingMedianAge']
+        assert [str(dtype) for dtype in df.dtypes] == ['float32', 'int32']
+        assert list(df['housingMedianAge']) == [41, 21]
+    for body in [b'[1, 2]', b'1', b'{"rows": []}', b'[{"housingMedianAge": "a"}]', b'{']:
+        with pytest.raises(Exception):
+            serve.read_request(body, 'application/json')
+
+
+def post(port, path, body, content_type='application/json'):
+    request = urllib.request.Request(f'http://127.0.0.1:{port}{path}', data=body,
+                                     headers={'Content-Type': content_type})
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def test_server_validates_model_id(store):
+    server = serve.InferenceServer(('127.0.0.1', 0), store, 3, 100, 1, 10, 0.2)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        body = json.dumps([{'x': 1}, {'x': 3}]).encode('utf-8')
+        assert post(server.server_port, '/models/1/predict', body) == (
+            200, {'model_id': '01', 'predictions': [2, 6]})
+        for model_id in ['3', '..', '%2e%2e', 'abc']:
+            status, _ = post(server.server_port, f'/models/{model_id}/predict', body)
+            assert status == 404
+        assert set(server.batchers) <= {'01'}
+        # 使われなくなったモデルのスレッドは終了して外される
+        time.sleep(0.5)
+        assert not server.batchers
+        assert post(server.server_port, '/models/01/predict', body)[0] == 200
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_server_rejects_invalid_body(store):
+    server = serve.InferenceServer(('127.0.0.1', 0), store, 3, 100, 1, 10, 0.2)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        # レコードのリストでない JSON や読めない CSV は、接続を切らずに 400 を返す
+        for body, content_type in [(b'[1, 2]', 'application/json'), (b'3', 'application/json'),
+                                   (b'x\n"a', 'text/csv')]:
+            status, response = post(server.server_port, '/models/1/predict', body, content_type)
+            assert status == 400
+            assert response['error'].startswith('invalid request')
+        body = b'x,housingMedianAge\n1,41.0\n'
+        assert post(server.server_port, '/models/1/predict', body, 'text/csv') == (
+            200, {'model_id': '01', 'predictions': [2]})
+    finally:
+        server.shutdown()
+        server.server_close()
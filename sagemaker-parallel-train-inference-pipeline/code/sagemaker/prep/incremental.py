@@ -0,0 +1,119 @@
+import json
+import os
+import time
+
+from botocore.exceptions import ClientError
+from dataset_io import is_dataset_file, iter_dataset, open_writer
+from storage import download_file, download_files, split_s3_uri
+
+MANIFEST_NAME = 'manifest.json'
+LATEST_NAME = 'latest.json'
+
+
+def get_object_json(s3_client, uri):
+    bucket, key = split_s3_uri(uri)
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ['NoSuchKey', '404']:
+            return None
+        raise
+    return json.loads(response['Body'].read().decode('utf-8'))
+
+
+def put_object_json(s3_client, uri, obj):
+    bucket, key = split_s3_uri(uri)
+    s3_client.put_object(Bucket=bucket, Key=key,
+                         Body=json.dumps(obj, indent=2).encode('utf-8'))
+
+
+def list_raw_objects(s3_client, raw_data_uri):
+    # 生データのプレフィックス配下のファイルを、相対パスと ETag の辞書で返す
+    bucket, prefix = split_s3_uri(raw_data_uri)
+    paginator = s3_client.get_paginator('list_objects_v2')
+    objects = {}
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix + '/'):
+        for content in page.get('Contents', []):
+            key = content['Key']
+            if is_dataset_file(key):
+                objects[key[len(prefix)+1:]] = content['ETag'].strip('"')
+    return objects
+
+
+def download_raw_files(s3_client, raw_data_uri, files, path, threads):
+    # list_raw_objects の相対パスのファイルを、同じ相対パスで path の下にダウンロードする
+    bucket, prefix = split_s3_uri(raw_data_uri)
+    download_files(s3_client, bucket,
+                   [(f'{prefix}/{file}', os.path.join(path, file)) for file in files],
+                   threads)
+    print(f'downloaded {len(files)} raw files from {raw_data_uri}')
+
+
+def load_previous_manifest(s3_client, state_uri):
+    # latest.json が指す前回の出力先にある manifest.json を読み込む
+    # 前回のジョブが出力のアップロード前に失敗していた場合は見つからないので None
+    latest = get_object_json(s3_client, f'{state_uri}/{LATEST_NAME}')
+    if latest is None:
+        return None
+    return get_object_json(s3_client, f"{latest['output']}/{MANIFEST_NAME}")
+
+
+def get_new_files(manifest, objects, partition_args, format_name):
+    # 前回から追加されたファイルの一覧を返す
+    # 全件を作り直す必要がある場合は None を返す
+    if manifest is None:
+        print('incremental: no previous manifest is found')
+        return None
+    previous = manifest['partition']
+    for key in ['mode', 'num_of_dataset', 'column', 'grid_size']:
+        if previous.get(key, partition_args[key]) != partition_args[key]:
+            print(f'incremental: partition {key} has changed')
+            return None
+    if manifest['dataset_format'] != format_name:
+        print('incremental: dataset format has changed')
+        return None
+    # 処理済みのファイルが変更・削除された場合は、その行を取り除けないので作り直す
+    for key, etag in manifest['files'].items():
+        if objects.get(key) != etag:
+            print(f'incremental: {key} has been changed or removed')
+            return None
+    return sorted(k for k in objects if k not in manifest['files'])
+
+
+def create_manifest(objects, output_uri, params, format_name, report):
+    return {
+        'files': objects,
+        'output': output_uri,
+        'dataset_format': format_name,
+        'partition': params,
+        'train_counts': [s['train'] for s in report['segments']],
+        'pred_counts': [s['pred'] for s in report['segments']],
+        'updated_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+
+def merge_segment(s3_client, previous_uri, output_uri, relative_path,
+                  delta_path, delta_rows, output_path, compression,
+                  chunk_size, tmp_path):
+    # 追加分がないセグメントは S3 上でコピーするだけにして、ダウンロードしない
+    src_bucket, src_key = split_s3_uri(f'{previous_uri}/{relative_path}')
+    if delta_rows == 0:
+        dst_bucket, dst_key = split_s3_uri(f'{output_uri}/{relative_path}')
+        s3_client.copy({'Bucket': src_bucket, 'Key': src_key},
+                       dst_bucket, dst_key)
+        return
+
+    # 追加分があるセグメントは、前回の出力の後ろに追加分を書き足す
+    previous_path = os.path.join(tmp_path, os.path.basename(relative_path))
+    download_file(s3_client, src_bucket, src_key, previous_path,
+                  os.cpu_count() or 1)
+    writer = open_writer(output_path, compression)
+    try:
+        for chunk in iter_dataset(previous_path, chunk_size):
+            writer.write(chunk)
+        for chunk in iter_dataset(delta_path, chunk_size):
+            writer.write(chunk)
+    finally:
+        writer.close()
+    os.remove(previous_path)
+
@@ -0,0 +1,135 @@
+import numpy as np
+import pandas as pd
+
+PARTITION_MODES = ['copy', 'hash', 'grid', 'range']
+
+
+def get_partition_columns(mode, column=None,
+                          lon_column='longitude', lat_column='latitude'):
+    # 分割先の決定に必要な列（None はすべての列）
+    if mode == 'grid':
+        return [lon_column, lat_column]
+    if mode == 'range':
+        if column is None:
+            raise ValueError('--partition-column is required for range mode')
+        return [column]
+    if mode == 'hash' and column is not None:
+        return [column]
+    return None
+
+
+def sample_rows(chunks, sample_size, random_state=0):
+    # 乱数キーが小さい順に sample_size 行を残すことで、
+    # 全体の行数がわからなくても一様なサンプルを一定のメモリで取り出す
+    rng = np.random.RandomState(random_state)
+    sample = None
+    for chunk in chunks:
+        chunk = chunk.assign(_key=rng.rand(len(chunk)))
+        sample = chunk if sample is None else pd.concat([sample, chunk])
+        if len(sample) > sample_size:
+            sample = sample.nsmallest(sample_size, '_key')
+    return sample.drop(columns=['_key'])
+
+
+def fit_partitioner(mode, num_of_dataset, chunks, column=None,
+                    lon_column='longitude', lat_column='latitude',
+                    grid_size=32, sample_size=100000):
+    params = {'mode': mode, 'num_of_dataset': num_of_dataset}
+    if mode == 'copy':
+        return params
+    if mode == 'hash':
+        params['column'] = column
+        return params
+
+    sample = sample_rows(chunks, sample_size)
+    if mode == 'range':
+        values = sample[column].dropna().values
+        quantiles = np.arange(1, num_of_dataset) / num_of_dataset
+        params['column'] = column
+        params['boundaries'] = [float(b) for b in np.quantile(values, quantiles)]
+    elif mode == 'grid':
+        lon = sample[lon_column].dropna()
+        lat = sample[lat_column].dropna()
+        params['lon_column'] = lon_column
+        params['lat_column'] = lat_column
+        params['grid_size'] = grid_size
+        params['bounds'] = [float(lon.min()), float(lon.max()),
+                            float(lat.min()), float(lat.max())]
+        cells = get_grid_cells(sample, params)
+        counts = np.bincount(cells, minlength=grid_size * grid_size)
+        # 隣接するセルが同じセグメントにまとまるよう、蛇行順にセルを並べてから
+        # 累積行数が均等になる位置でセグメントを区切る
+        order = np.arange(grid_size * grid_size).reshape(grid_size, grid_size)
+        order[1::2] = order[1::2, ::-1]
+        order = order.ravel()
+        cumsum = np.cumsum(counts[order]) - counts[order] / 2
+        segments = np.floor(cumsum / max(counts.sum(), 1) * num_of_dataset)
+        cell_segments = np.zeros(grid_size * grid_size, dtype=int)
+        cell_segments[order] = np.clip(segments, 0, num_of_dataset - 1)
+        params['cell_segments'] = cell_segments.tolist()
+    else:
+        raise ValueError(f'unknown partition mode: {mode}')
+    return params
+
+
+def get_grid_cells(df, params):
+    grid_size = params['grid_size']
+    lon_min, lon_max, lat_min, lat_max = params['bounds']
+    lon = df[params['lon_column']].fillna(lon_min).values
+    lat = df[params['lat_column']].fillna(lat_min).values
+    # 学習時の範囲外の値は端のセルに寄せる
+    x = ((lon - lon_min) / max(lon_max - lon_min, 1e-12) * grid_size).astype(int)
+    y = ((lat - lat_min) / max(lat_max - lat_min, 1e-12) * grid_size).astype(int)
+    x = np.clip(x, 0, grid_size - 1)
+    y = np.clip(y, 0, grid_size - 1)
+    return x * grid_size + y
+
+
+def assign_segments(df, params):
+    mode = params['mode']
+    num_of_dataset = params['num_of_dataset']
+    if mode == 'hash':
+        target = df if params['column'] is None else df[params['column']]
+        hashes = pd.util.hash_pandas_object(target, index=False).values
+        return (hashes % np.uint64(num_of_dataset)).astype(int)
+    if mode == 'range':
+        values = df[params['column']].values
+        segments = np.searchsorted(params['boundaries'], values, side='right')
+        # 欠損値は最後のセグメントに入れる
+        segments[np.isnan(values)] = num_of_dataset - 1
+        return segments
+    if mode == 'grid':
+        cell_segments = np.asarray(params['cell_segments'])
+        return cell_segments[get_grid_cells(df, params)]
+    raise ValueError(f'unknown partition mode: {mode}')
+
+
+def split_by_segment(df, params):
+    # セグメントごとの DataFrame のリストを返す（行がないセグメントは空の DataFrame）
+    num_of_dataset = params['num_of_dataset']
+    if params['mode'] == 'copy':
+        return [df] * num_of_dataset
+    segments = assign_segments(df, params)
+    order = np.argsort(segments, kind='stable')
+    bounds = np.searchsorted(segments[order], np.arange(num_of_dataset + 1))
+    return [df.iloc[order[bounds[n]:bounds[n + 1]]]
+            for n in range(num_of_dataset)]
+
+
+def balance_report(params, train_counts, pred_counts):
+    train_counts = np.asarray(train_counts)
+    pred_counts = np.asarray(pred_counts)
+    total = train_counts + pred_counts
+    mean = total.mean() if len(total) else 0
+    return {
+        'partition': params,
+        'segments': [
+            {'id': str(n).zfill(2), 'train': int(t), 'pred': int(p)}
+            for n, (t, p) in enumerate(zip(train_counts, pred_counts))
+        ],
+        'total_rows': int(total.sum()),
+        'min_rows': int(total.min()),
+        'max_rows': int(total.max()),
+        # 最大セグメントの行数 / 平均行数（1.0 が完全に均等）
+        'imbalance': float(total.max() / mean) if mean else 0.0,
+    }
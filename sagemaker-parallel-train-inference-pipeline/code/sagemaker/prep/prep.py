@@ -1,16 +1,249 @@
 import argparse
+from dataset_io import (get_dataset_config, get_dataset_path, is_dataset_file,
+                        iter_dataset, open_writer, read_dataset, write_dataset)
+from incremental import (MANIFEST_NAME, LATEST_NAME, create_manifest,
+                         download_raw_files, get_new_files, list_raw_objects,
+                         load_previous_manifest, merge_segment,
+                         put_object_json)
 import json
 import logging
+import multiprocessing as mp
+import numpy as np
 import os
 import pandas as pd
+from partition import (PARTITION_MODES, balance_report, fit_partitioner,
+                       get_partition_columns, split_by_segment)
+import resource
+import queue
+from schema import print_memory_report
 from sklearn.model_selection import train_test_split
+import storage
 import sys
 import glob
+import time
+import yaml
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 logger.addHandler(logging.StreamHandler(sys.stdout))
 
+TEST_SIZE = 0.2
+TMP_PATH = '/opt/ml/processing/tmp'
+RAW_DATA_PATH = '/opt/ml/processing/input/data'
+# ライタープロセスが生きているかを確認する間隔（キューが空かない間）
+PUT_TIMEOUT = 5
+
+
+def get_peak_rss_mb():
+    # ru_maxrss は Linux では KB 単位
+    # RUSAGE_CHILDREN は終了した子プロセスのうち最大のものの値
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return self_rss, children_rss
+
+
+def list_raw_files(input_data_path):
+    # 入力フォルダ以下のデータファイル（.run などは除く）を相対パスで返す
+    files = glob.glob(f'{input_data_path}/**/*', recursive=True)
+    return sorted(os.path.relpath(f, input_data_path)
+                  for f in files if is_dataset_file(f))
+
+
+def make_output_dirs(output_data_path, num_of_dataset):
+    os.makedirs(os.path.join(output_data_path, 'train'))
+    os.makedirs(os.path.join(output_data_path, 'pred'))
+    for n in range(num_of_dataset):
+        idx = str(n).zfill(2)
+        os.makedirs(os.path.join(output_data_path, 'train', idx))
+
+
+def get_segment_paths(output_data_path, idx, format_name):
+    train_path = get_dataset_path(os.path.join(output_data_path, 'train'),
+                                  f'train_{idx}', format_name)
+    pred_path = get_dataset_path(os.path.join(output_data_path, 'pred'),
+                                 f'pred_{idx}', format_name)
+    return train_path, pred_path
+
+
+def prep(rawdata_files, output_data_path, partition_args,
+         format_name, compression, params=None):
+    rawdata_df = pd.concat([read_dataset(f) for f in rawdata_files],
+                           ignore_index=True)
+    print_memory_report('raw data', rawdata_df)
+    if params is None:
+        params = fit_partitioner(chunks=[rawdata_df], **partition_args)
+
+    train_df, test_df = train_test_split(
+        rawdata_df, test_size=TEST_SIZE, random_state=0
+    )
+    train_counts = []
+    pred_counts = []
+    for n, (train_seg_df, test_seg_df) in enumerate(zip(
+            split_by_segment(train_df, params),
+            split_by_segment(test_df, params))):
+        idx = str(n).zfill(2)
+        train_path, pred_path = get_segment_paths(output_data_path, idx,
+                                                  format_name)
+        write_dataset(train_seg_df, train_path, compression)
+        write_dataset(test_seg_df, pred_path, compression)
+        train_counts.append(len(train_seg_df))
+        pred_counts.append(len(test_seg_df))
+
+    return len(rawdata_df), balance_report(params, train_counts, pred_counts)
+
+
+def segment_writer(queue, compression):
+    # 担当するセグメントのファイルを開いたまま保持し、届いたチャンクを順に追記する
+    writers = {}
+    try:
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            for path, df in item:
+                if path not in writers:
+                    writers[path] = open_writer(path, compression)
+                writers[path].write(df)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+
+def put_item(q, writer, item):
+    # キューが満杯のまま待ち続けないよう、一定時間ごとにライタープロセスの終了を確認する
+    # （メモリ不足などでライターが落ちた場合に、ジョブが最大実行時間まで止まらないようにする）
+    while True:
+        try:
+            q.put(item, timeout=PUT_TIMEOUT)
+            return
+        except queue.Full:
+            if not writer.is_alive():
+                raise RuntimeError(
+                    f'segment writer exited with code {writer.exitcode}')
+
+
+def iter_raw_chunks(rawdata_files, chunk_size, columns=None):
+    for rawdata_file in rawdata_files:
+        for chunk in iter_dataset(rawdata_file, chunk_size, columns=columns):
+            yield chunk
+
+
+def prep_streaming(rawdata_files, output_data_path, partition_args,
+                   format_name, compression, chunk_size, num_of_workers,
+                   params=None):
+    num_of_dataset = partition_args['num_of_dataset']
+    # grid と range は分割の境界を決めるために、必要な列だけを先に読んでサンプリングする
+    if params is None:
+        usecols = get_partition_columns(
+                        partition_args['mode'], partition_args['column'],
+                        partition_args['lon_column'], partition_args['lat_column'])
+        chunks = []
+        if partition_args['mode'] in ['grid', 'range']:
+            chunks = iter_raw_chunks(rawdata_files, chunk_size, columns=usecols)
+        params = fit_partitioner(chunks=chunks, **partition_args)
+
+    # セグメントを担当するライタープロセスに振り分ける
+    # キューの長さを制限しているので、読み込みが書き込みを追い越してもメモリは増えない
+    num_of_workers = max(1, min(num_of_workers, num_of_dataset))
+    queues = [mp.Queue(maxsize=2) for _ in range(num_of_workers)]
+    workers = [mp.Process(target=segment_writer, args=(q, compression))
+               for q in queues]
+    for w in workers:
+        w.start()
+
+    segment_paths = [get_segment_paths(output_data_path, str(n).zfill(2),
+                                       format_name)
+                     for n in range(num_of_dataset)]
+
+    # チャンク単位で学習用と推論用に分割する（シードを固定して再現性を保つ）
+    rng = np.random.RandomState(0)
+    num_of_rows = 0
+    train_counts = np.zeros(num_of_dataset, dtype=int)
+    pred_counts = np.zeros(num_of_dataset, dtype=int)
+    try:
+        for chunk in iter_raw_chunks(rawdata_files, chunk_size):
+            if num_of_rows == 0:
+                print_memory_report('first chunk', chunk)
+            is_test = rng.rand(len(chunk)) < TEST_SIZE
+            train_chunk = chunk[~is_test]
+            test_chunk = chunk[is_test]
+            items = [[] for _ in range(num_of_workers)]
+            for n, (train_path, pred_path), train_seg, test_seg in zip(
+                    range(num_of_dataset), segment_paths,
+                    split_by_segment(train_chunk, params),
+                    split_by_segment(test_chunk, params)):
+                items[n % num_of_workers].append((train_path, train_seg))
+                items[n % num_of_workers].append((pred_path, test_seg))
+                train_counts[n] += len(train_seg)
+                pred_counts[n] += len(test_seg)
+            for q, w, item in zip(queues, workers, items):
+                put_item(q, w, item)
+            num_of_rows += len(chunk)
+    finally:
+        for q, w in zip(queues, workers):
+            try:
+                put_item(q, w, None)
+            except RuntimeError:
+                pass
+        for q, w in zip(queues, workers):
+            w.join()
+            if w.exitcode != 0:
+                # 終了したライターに送れなかったデータを待たずに終了できるようにする
+                q.cancel_join_thread()
+
+    failed = [w.exitcode for w in workers if w.exitcode != 0]
+    if failed:
+        raise RuntimeError(f'segment writer failed with exit code {failed}')
+
+    return num_of_rows, balance_report(params, train_counts, pred_counts)
+
+
+def run_prep(args, rawdata_files, output_data_path, partition_args,
+             format_name, compression, params=None):
+    if args.streaming:
+        return prep_streaming(rawdata_files, output_data_path, partition_args,
+                              format_name, compression, args.chunk_size,
+                              args.num_of_workers, params)
+    return prep(rawdata_files, output_data_path, partition_args,
+                format_name, compression, params)
+
+
+def prep_incremental(args, s3_client, rawdata_files, manifest,
+                     output_data_path, output_data_uri, partition_args,
+                     format_name, compression):
+    # 追加されたファイルだけを前回と同じ分割方法で処理して、前回の出力に追記する
+    num_of_dataset = partition_args['num_of_dataset']
+    params = manifest['partition']
+    delta_path = os.path.join(TMP_PATH, 'delta')
+    previous_path = os.path.join(TMP_PATH, 'previous')
+    make_output_dirs(delta_path, num_of_dataset)
+    os.makedirs(previous_path)
+
+    num_of_rows = 0
+    delta_train_counts = np.zeros(num_of_dataset, dtype=int)
+    delta_pred_counts = np.zeros(num_of_dataset, dtype=int)
+    if rawdata_files:
+        num_of_rows, delta_report = run_prep(
+                args, rawdata_files, delta_path, partition_args,
+                format_name, compression, params)
+        delta_train_counts += [s['train'] for s in delta_report['segments']]
+        delta_pred_counts += [s['pred'] for s in delta_report['segments']]
+
+    for n in range(num_of_dataset):
+        idx = str(n).zfill(2)
+        delta_files = get_segment_paths(delta_path, idx, format_name)
+        delta_counts = [delta_train_counts[n], delta_pred_counts[n]]
+        for delta_file, delta_rows in zip(delta_files, delta_counts):
+            relative_path = os.path.relpath(delta_file, delta_path)
+            merge_segment(s3_client, manifest['output'], output_data_uri,
+                          relative_path, delta_file, delta_rows,
+                          os.path.join(output_data_path, relative_path),
+                          compression, args.chunk_size, previous_path)
+
+    train_counts = delta_train_counts + manifest['train_counts']
+    pred_counts = delta_pred_counts + manifest['pred_counts']
+    return num_of_rows, balance_report(params, train_counts, pred_counts)
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -18,6 +251,27 @@ if __name__ == '__main__':
     # Data and model checkpoints directories
     parser.add_argument('--num-of-dataset', type=int, default=1, metavar='N',
                         help='N of dataset')
+    parser.add_argument('--streaming', action='store_true',
+                        help='read raw data in chunks and write segments in parallel')
+    parser.add_argument('--chunk-size', type=int, default=100000, metavar='N',
+                        help='number of rows per chunk in streaming mode')
+    parser.add_argument('--num-of-workers', type=int, default=os.cpu_count(), metavar='N',
+                        help='number of segment writer processes in streaming mode')
+    parser.add_argument('--partition-mode', type=str, default='hash',
+                        choices=PARTITION_MODES,
+                        help='how rows are assigned to segments')
+    parser.add_argument('--partition-column', type=str, default=None,
+                        help='column used by hash/range mode (hash: whole row if omitted)')
+    parser.add_argument('--grid-size', type=int, default=32, metavar='N',
+                        help='number of longitude/latitude cells per axis in grid mode')
+    parser.add_argument('--incremental', action='store_true',
+                        help='process only raw files added since the last run')
+    parser.add_argument('--state-path', type=str, default=None,
+                        help='S3 path to keep the pointer to the last output '
+                             '(default: <prep output parent>/_state)')
+    parser.add_argument('--raw-data-uri', type=str, default=None,
+                        help='S3 path of the raw data downloaded by this script instead of the '
+                             '"data" input (only new files in incremental mode)')
     args = parser.parse_args()
 
     # 複数インスタンスを使用した場合に、自分がどのインスタンス（ID）なのかを取得
@@ -31,19 +285,60 @@ if __name__ == '__main__':
         processingjobconfig = json.load(f)
         print('processingjobconfig', processingjobconfig)
         output_data_path = ''
+        output_data_uri = ''
         outputs = processingjobconfig['ProcessingOutputConfig']['Outputs']
         for o in outputs:
             if o['OutputName'] == 'result':
                 output_data_path = o['S3Output']['LocalPath']
+                output_data_uri = o['S3Output']['S3Uri']
 
         inputs = processingjobconfig['ProcessingInputs']
         code_path = ''
-        input_data_path = ''
+        input_data_path = RAW_DATA_PATH
+        input_data_uri = args.raw_data_uri or ''
         for i in inputs:
             if i['InputName'] == 'code':
                 code_path = i['S3Input']['LocalPath']
-            elif i['InputName'] == 'data':
+            elif i['InputName'] == 'data' and not args.raw_data_uri:
                 input_data_path = i['S3Input']['LocalPath']
+                input_data_uri = i['S3Input']['S3Uri']
+    input_data_uri = input_data_uri.rstrip('/')
+
+    config_file = os.path.join(code_path, 'config.yml')
+    with open(config_file) as f:
+        config = yaml.safe_load(f)
+    format_name, compression = get_dataset_config(config)
+    print('dataset format:', format_name, 'compression:', compression)
+
+    num_of_dataset = int(args.num_of_dataset)
+    make_output_dirs(output_data_path, num_of_dataset)
+
+    partition_args = {
+        'mode': args.partition_mode,
+        'num_of_dataset': num_of_dataset,
+        'column': args.partition_column,
+        'lon_column': 'longitude',
+        'lat_column': 'latitude',
+        'grid_size': args.grid_size,
+    }
+
+    # 差分処理の場合は、処理済みのファイルとその ETag を前回の manifest から取得する
+    new_files = None
+    if args.incremental or args.raw_data_uri:
+        s3_client = storage.get_client()
+        objects = list_raw_objects(s3_client, input_data_uri)
+    if args.incremental:
+        state_uri = args.state_path or f'{os.path.dirname(output_data_uri)}/_state'
+        manifest = load_previous_manifest(s3_client, state_uri)
+        new_files = get_new_files(manifest, objects, partition_args, format_name)
+
+    # ProcessingInput は生データをすべてダウンロードするので、--raw-data-uri の場合は
+    # 処理するファイル（差分処理では追加されたファイル）だけをこのスクリプトで取得する
+    if args.raw_data_uri:
+        download_raw_files(s3_client, input_data_uri,
+                           sorted(objects) if new_files is None else new_files,
+                           input_data_path, os.cpu_count() or 1)
+    rawdata_files = list_raw_files(input_data_path)
 
     input_files = glob.glob(f"{input_data_path}/*")
     print('input:', str(len(input_files)), input_files[:100])
@@ -53,17 +348,38 @@ if __name__ == '__main__':
     with open(log_file, 'w') as f:
         f.write('\n'.join(input_files))
 
-    num_of_dataset = int(args.num_of_dataset)
-    rawdata_path = os.path.join(input_data_path, 'rawdata.csv')
-    rawdata_df = pd.read_csv(rawdata_path)
+    start_time = time.time()
+    if new_files is None:
+        print('raw files:', len(rawdata_files))
+        num_of_rows, report = run_prep(
+                args, [os.path.join(input_data_path, f) for f in rawdata_files],
+                output_data_path, partition_args, format_name, compression)
+    else:
+        print('incremental: new raw files:', len(new_files), new_files[:100])
+        num_of_rows, report = prep_incremental(
+                args, s3_client,
+                [os.path.join(input_data_path, f) for f in new_files],
+                manifest, output_data_path, output_data_uri, partition_args,
+                format_name, compression)
+    elapsed = time.time() - start_time
 
-    train_df, test_df = train_test_split(
-        rawdata_df, test_size=0.2, random_state=0
-    )
-    os.makedirs(os.path.join(output_data_path, 'train'))
-    os.makedirs(os.path.join(output_data_path, 'pred'))
-    for n in range(num_of_dataset):
-        idx = str(n).zfill(2)
-        os.makedirs(os.path.join(output_data_path, 'train', idx))
-        train_df.to_csv(os.path.join(output_data_path, 'train', f'train_{idx}.csv'), index=None)
-        test_df.to_csv(os.path.join(output_data_path, 'pred', f'pred_{idx}.csv'), index=None)
+    # manifest.json は出力と一緒にアップロードされ、latest.json で次回の実行から参照される
+    if args.incremental:
+        manifest = create_manifest(objects, output_data_uri,
+                                   report['partition'], format_name, report)
+        with open(os.path.join(output_data_path, MANIFEST_NAME), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        put_object_json(s3_client, f'{state_uri}/{LATEST_NAME}',
+                        {'output': output_data_uri})
+
+    # セグメントごとの行数の偏りを確認できるよう出力しておく
+    print(f"partition: {args.partition_mode}, rows per segment: "
+          f"min {report['min_rows']}, max {report['max_rows']}, "
+          f"imbalance {report['imbalance']:.3f}")
+    with open(os.path.join(output_data_path, 'partition.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+
+    self_rss, children_rss = get_peak_rss_mb()
+    print(f'rows: {num_of_rows}, elapsed: {elapsed:.1f} sec, '
+          f'throughput: {num_of_rows / max(elapsed, 1e-6):.0f} rows/sec')
+    print(f'peak RSS: main {self_rss:.1f} MB, writer {children_rss:.1f} MB')
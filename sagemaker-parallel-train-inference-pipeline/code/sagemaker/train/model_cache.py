@@ -0,0 +1,80 @@
+import glob
+import hashlib
+import json
+import os
+import time
+
+from botocore.exceptions import ClientError
+from storage import split_s3_uri
+
+
+def update_file_hash(h, path):
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+
+
+def get_fingerprint(train_file, config, image_uri, code_path):
+    # 学習データの中身、config.yml（設定した time_limit を含む）、コンテナイメージ、スクリプトが同じなら同じモデルができる
+    # 実行ごとに割り当てる time_limit は他のセグメントやインスタンス数で変わるので含めず、lookup で比べる
+    h = hashlib.sha256()
+    update_file_hash(h, train_file)
+    h.update(json.dumps(config, sort_keys=True).encode('utf-8'))
+    h.update((image_uri or '').encode('utf-8'))
+    for code_file in sorted(glob.glob(os.path.join(code_path, '*.py'))):
+        # テストは学習に影響しない
+        if os.path.basename(code_file).startswith('test_'):
+            continue
+        update_file_hash(h, code_file)
+    return h.hexdigest()
+
+
+def covers_time_limit(cached_time_limit, time_limit, tolerance=0.0):
+    # time_limit が短いと精度が下がるので、今回より短い時間で学習したモデルは再利用しない
+    # （time_limit はジョブの経過時間でも少し変わるので、tolerance の割合までの差は同じとみなす）
+    if cached_time_limit is None:
+        return True
+    return time_limit is not None and cached_time_limit >= time_limit * (1 - tolerance)
+
+
+def lookup(s3_client, cache_uri, fingerprint, time_limit=None, tolerance=0.0):
+    # キャッシュのエントリと、それが指す学習済みモデルが S3 にあるかを確認する
+    bucket, key = split_s3_uri(f'{cache_uri}/{fingerprint}.json')
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=key)
+        entry = json.loads(response['Body'].read().decode('utf-8'))
+        if not covers_time_limit(entry.get('time_limit'), time_limit, tolerance):
+            return None
+        for file in entry['files']:
+            bucket, key = split_s3_uri(f"{entry['uri']}/{file}")
+            s3_client.head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ['NoSuchKey', '404']:
+            return None
+        raise
+    return entry
+
+
+def restore(s3_client, entry, output_uri):
+    # 前回のモデルを今回の出力先に S3 上でコピーする
+    for file in entry['files']:
+        src_bucket, src_key = split_s3_uri(f"{entry['uri']}/{file}")
+        dst_bucket, dst_key = split_s3_uri(f'{output_uri}/{file}')
+        s3_client.copy({'Bucket': src_bucket, 'Key': src_key},
+                       dst_bucket, dst_key)
+
+
+def create_entry(fingerprint, model_uri, model_path, train_seconds, time_limit=None):
+    # エントリはモデルが S3 にアップロードされた後（学習ステップの後の Register Models）に書き込む
+    files = sorted(os.path.relpath(f, model_path)
+                   for f in glob.glob(os.path.join(model_path, '**', '*'),
+                                      recursive=True)
+                   if os.path.isfile(f))
+    return {
+        'fingerprint': fingerprint,
+        'uri': model_uri,
+        'files': files,
+        'train_seconds': train_seconds,
+        'time_limit': time_limit,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
@@ -0,0 +1,109 @@
+import json
+import os
+
+import pytest
+
+import model_cache
+
+BUCKET = 'bucket'
+CACHE_URI = f's3://{BUCKET}/prefix/train/_cache'
+MODEL_URI = f's3://{BUCKET}/prefix/train/job/000'
+CONFIG = {'ag_fit_args': {'presets': 'medium_quality_faster_train'}}
+
+
+@pytest.fixture
+def train_file(tmp_path):
+    path = tmp_path / 'train_000.csv'
+    path.write_text('x,medianHouseValue\n1,2.0\n')
+    return str(path)
+
+
+@pytest.fixture
+def code_path(tmp_path):
+    path = tmp_path / 'code'
+    path.mkdir()
+    (path / 'train.py').write_text('print(1)\n')
+    return str(path)
+
+
+@pytest.fixture
+def model_path(tmp_path):
+    path = tmp_path / 'model'
+    (path / 'sub').mkdir(parents=True)
+    (path / 'eval.yml').write_text('MAE: 1.0\n')
+    (path / 'sub' / 'model.pkl').write_bytes(b'model')
+    return str(path)
+
+
+def put_entry(s3_client, entry):
+    s3_client.put_object(Bucket=BUCKET, Key=f"prefix/train/_cache/{entry['fingerprint']}.json",
+                         Body=json.dumps(entry).encode('utf-8'))
+
+
+def upload_model(s3_client, model_path, model_uri):
+    for root, _, files in os.walk(model_path):
+        for file in files:
+            path = os.path.join(root, file)
+            key = f'{model_uri[len(f"s3://{BUCKET}/"):]}/{os.path.relpath(path, model_path)}'
+            s3_client.upload_file(path, BUCKET, key)
+
+
+def test_fingerprint_excludes_planned_time_limit(train_file, code_path):
+    fingerprint = model_cache.get_fingerprint(train_file, CONFIG, 'image:1', code_path)
+    assert fingerprint == model_cache.get_fingerprint(train_file, CONFIG, 'image:1', code_path)
+    assert fingerprint != model_cache.get_fingerprint(train_file, CONFIG, 'image:2', code_path)
+    # config.yml で設定した time_limit は config の一部として含める
+    config = {'ag_fit_args': {'presets': 'medium_quality_faster_train', 'time_limit': 600}}
+    assert fingerprint != model_cache.get_fingerprint(train_file, config, 'image:1', code_path)
+
+
+def test_fingerprint_depends_on_data_and_code(train_file, code_path):
+    fingerprint = model_cache.get_fingerprint(train_file, CONFIG, None, code_path)
+    # テストは学習に影響しないので含めない
+    with open(os.path.join(code_path, 'test_train.py'), 'w') as f:
+        f.write('def test(): pass\n')
+    assert fingerprint == model_cache.get_fingerprint(train_file, CONFIG, None, code_path)
+    with open(os.path.join(code_path, 'train.py'), 'a') as f:
+        f.write('print(2)\n')
+    code_fingerprint = model_cache.get_fingerprint(train_file, CONFIG, None, code_path)
+    assert code_fingerprint != fingerprint
+    with open(train_file, 'a') as f:
+        f.write('2,3.0\n')
+    assert model_cache.get_fingerprint(train_file, CONFIG, None, code_path) != code_fingerprint
+
+
+def test_create_entry_lists_model_files(model_path):
+    entry = model_cache.create_entry('fp', MODEL_URI, model_path, 12.5)
+    assert entry['fingerprint'] == 'fp'
+    assert entry['uri'] == MODEL_URI
+    assert entry['files'] == ['eval.yml', os.path.join('sub', 'model.pkl')]
+    assert entry['train_seconds'] == 12.5
+    assert entry['time_limit'] is None
+
+
+def test_lookup_and_restore(s3_client, model_path):
+    entry = model_cache.create_entry('fp', MODEL_URI, model_path, 12.5)
+    assert model_cache.lookup(s3_client, CACHE_URI, 'fp') is None
+    put_entry(s3_client, entry)
+    # エントリがあってもモデルが消えている場合は使わない
+    assert model_cache.lookup(s3_client, CACHE_URI, 'fp') is None
+    upload_model(s3_client, model_path, MODEL_URI)
+    assert model_cache.lookup(s3_client, CACHE_URI, 'fp') == entry
+
+    model_cache.restore(s3_client, entry, f's3://{BUCKET}/prefix/train/job-2/000')
+    body = s3_client.get_object(Bucket=BUCKET, Key='prefix/train/job-2/000/sub/model.pkl')['Body']
+    assert body.read() == b'model'
+
+
+def test_lookup_requires_longer_time_limit(s3_client, model_path):
+    entry = model_cache.create_entry('fp', MODEL_URI, model_path, 12.5, 600)
+    put_entry(s3_client, entry)
+    upload_model(s3_client, model_path, MODEL_URI)
+    # 前回以下の time_limit なら再利用し、前回より長い・制限なしの場合は学習し直す
+    assert model_cache.lookup(s3_client, CACHE_URI, 'fp', 600) == entry
+    assert model_cache.lookup(s3_client, CACHE_URI, 'fp', 300) == entry
+    assert model_cache.lookup(s3_client, CACHE_URI, 'fp', 900) is None
+    assert model_cache.lookup(s3_client, CACHE_URI, 'fp') is None
+    # 経過時間による少しの差は tolerance の範囲で同じとみなす
+    assert model_cache.lookup(s3_client, CACHE_URI, 'fp', 620, 0.1) == entry
+    assert model_cache.lookup(s3_client, CACHE_URI, 'fp', 700, 0.1) is None
@@ -0,0 +1,115 @@
+from concurrent.futures import ProcessPoolExecutor
+import json
+import multiprocessing as mp
+import os
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('autogluon.tabular')
+import train  # noqa: E402
+
+CONFIG = {'ag_fit_args': {'presets': 'medium_quality_faster_train'}}
+BUDGET = {'num_of_workers': 2, 'num_cpus': 3, 'num_gpus': 0, 'memory_ratio': 0.5}
+
+
+def get_max_threads():
+    from threadpoolctl import threadpool_info
+    return max([pool['num_threads'] for pool in threadpool_info()], default=1)
+
+
+def write_train_file(path, name, num_of_rows):
+    train_file = os.path.join(path, f'{name}.csv')
+    pd.DataFrame({'x': range(num_of_rows), 'medianHouseValue': 1.0}).to_csv(
+        train_file, index=False)
+    return train_file
+
+
+def test_fit_args_use_ag_args_fit():
+    # autogluon 0.4 の fit は num_cpus / num_gpus を引数に取らない
+    ag_fit_args = train.get_fit_args(CONFIG, BUDGET)
+    assert 'num_cpus' not in ag_fit_args
+    assert 'num_gpus' not in ag_fit_args
+    assert ag_fit_args['ag_args_fit'] == {'num_cpus': 3, 'num_gpus': 0,
+                                          'max_memory_usage_ratio': 0.5}
+    assert 'time_limit' not in ag_fit_args
+    assert 'ag_args_fit' not in CONFIG['ag_fit_args']
+
+
+def test_fit_args_keep_config_values():
+    config = {'ag_fit_args': {'time_limit': 100, 'ag_args_fit': {'num_cpus': 1}}}
+    ag_fit_args = train.get_fit_args(config, BUDGET, time_limit=300)
+    assert ag_fit_args['ag_args_fit']['num_cpus'] == 1
+    assert ag_fit_args['time_limit'] == 100
+    assert train.get_fit_args(config, BUDGET, time_limit=50)['time_limit'] == 50
+
+
+def test_plan_workers(monkeypatch):
+    monkeypatch.setattr(train, 'get_cpu_count', lambda: 8)
+    monkeypatch.setattr(train, 'get_memory_limit', lambda: 32 * 1024 ** 3)
+    # CPU 8 / 2 = 4、メモリ 32 / 16 = 2 なので 2 並列
+    budget = train.plan_workers(10, 0, 2, 16 * 1024 ** 3)
+    assert budget['num_of_workers'] == 2
+    assert budget['num_cpus'] == 4
+    assert budget['memory_ratio'] == 0.5
+    # セグメント数より多くは並列にしない
+    assert train.plan_workers(1, 0, 1, 1)['num_of_workers'] == 1
+    assert train.plan_workers(3, 16, 1, 1)['num_of_workers'] == 3
+
+
+def test_plan_queues_longest_first():
+    rows = {'a': 100, 'b': 300, 'c': 200, 'd': 100}
+    # 行数の多い順に、合計の行数が少ないワーカーへ割り当てる
+    assert train.plan_queues(rows, 2) == [['b', 'd'], ['c', 'a']]
+    # セグメントより多いワーカーは使わない
+    assert train.plan_queues({'a': 100}, 3) == [['a']]
+
+
+def test_plan_time_limits(tmp_path):
+    small = write_train_file(tmp_path, 'train_00', 100)
+    large = write_train_file(tmp_path, 'train_01', 300)
+    rows = {small: 100, large: 300}
+    # 同じワーカーで順番に学習する場合は (1000 * 0.9 - 2 * 50) = 800 秒を行数の比で分ける
+    time_limits = train.plan_time_limits([[large, small]], rows, 1000, 50, 0.1, 10)
+    assert time_limits == {small: 200, large: 600}
+    # 別々のワーカーで学習する場合は、それぞれ 1000 * 0.9 - 50 秒を使える
+    time_limits = train.plan_time_limits([[large], [small]], rows, 1000, 50, 0.1, 10)
+    assert time_limits == {small: 850, large: 850}
+    # 残り時間が足りない場合は最小の time_limit にする
+    assert train.plan_time_limits([[large, small]], rows, 60, 50, 0.1, 10) == {
+        small: 10, large: 10}
+
+
+def test_plan_time_limits_fits_each_worker(tmp_path):
+    # ワーカーより多いセグメントを学習しても、各ワーカーの合計がジョブの実行時間の上限に収まる
+    train_files = [write_train_file(tmp_path, f'train_{i:02}', 100) for i in range(3)]
+    rows = {train_file: 100 for train_file in train_files}
+    queues = train.plan_queues(rows, 2)
+    assert sorted(len(queue) for queue in queues) == [1, 2]
+    time_limits = train.plan_time_limits(queues, rows, 3600, 120, 0.1, 60)
+    for queue in queues:
+        assert sum(time_limits[f] + 120 for f in queue) <= 3600
+
+
+def test_init_worker_limits_thread_pools():
+    # spawn したワーカーは読み込み済みのスレッドプールも含めて num_cpus 以下になる
+    with ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context('spawn'),
+                             initializer=train.init_worker, initargs=(1,)) as executor:
+        assert executor.submit(get_max_threads).result() == 1
+
+
+def test_save_profile_rollup(tmp_path):
+    for model_id, seconds in [('00', 1.0), ('01', 2.0)]:
+        os.makedirs(tmp_path / model_id)
+        profile = {'phases': [{'phase': 'fit', 'wall_seconds': seconds, 'cpu_seconds': seconds,
+                               'peak_rss_bytes': 100, 'bytes_read': None,
+                               'bytes_written': None, 'calls': 1}]}
+        with open(tmp_path / model_id / 'profile.json', 'w') as f:
+            json.dump(profile, f)
+    # 学習に失敗したセグメント（profile.json がない）は含めない
+    path = train.save_profile_rollup(str(tmp_path), 'algo-1', ['01', '00', '02'])
+    with open(path) as f:
+        rollup = json.load(f)
+    assert os.path.basename(path) == 'profile-algo-1.json'
+    assert rollup['segments'] == 2
+    assert rollup['phases']['fit']['wall_seconds'] == 3.0
@@ -1,23 +1,38 @@
 import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import copy
+from dataset_io import count_rows, is_dataset_file, read_dataset
 import json
+import model_artifact
+import model_cache
+import registry
+import multiprocessing as mp
 import os
-import pandas as pd
 from pprint import pprint
+from profiler import Profiler, print_rollup, rollup
+from resources import get_cpu_count, get_memory_limit, limit_threads
+from schema import LABEL, print_memory_report
 from sklearn.metrics import mean_absolute_error
 from sklearn.model_selection import train_test_split
+from threadpoolctl import threadpool_limits
 import torch
 import shutil
+import storage
+import time
 import yaml
 from autogluon.tabular import TabularDataset, TabularPredictor
 
+TMP_PATH = '/opt/ml/processing/tmp'
 
-def get_input_path(path):
-    file = os.listdir(path)[0]
-    if len(os.listdir(path)) > 1:
-        print("WARN: more than one file is found in this directory")
-    print(f"Using {file}")
-    filename = f"{path}/{file}"
-    return filename
+
+def get_input_files(path):
+    files = sorted(f for f in os.listdir(path) if is_dataset_file(f))
+    print(f"Using {len(files)} files: {files}")
+    return [f"{path}/{file}" for file in files]
+
+
+def get_model_id(filename):
+    return filename.split('_')[-1].split('.')[0]
 
 
 def get_env_if_present(name):
@@ -27,16 +42,279 @@ def get_env_if_present(name):
     return result
 
 
+def plan_workers(num_of_segments, num_of_workers, min_cpus_per_segment,
+                 min_memory_per_segment):
+    # CPU とメモリの両方が 1 セグメントあたりの最小量を下回らない範囲で並列数を決める
+    num_cpus = get_cpu_count()
+    memory_limit = get_memory_limit()
+    if num_of_workers <= 0:
+        num_of_workers = min(num_cpus // max(min_cpus_per_segment, 1),
+                             memory_limit // max(min_memory_per_segment, 1))
+    num_of_workers = max(1, min(num_of_workers, num_of_segments))
+    return {
+        'num_of_workers': num_of_workers,
+        'num_cpus': max(1, num_cpus // num_of_workers),
+        'num_gpus': torch.cuda.device_count() // num_of_workers,
+        'memory_ratio': 1.0 / num_of_workers,
+        'memory_limit': memory_limit,
+    }
+
+
+def plan_queues(rows, num_of_workers):
+    # 行数の多いセグメントから順に、割り当て済みの行数が最も少ないワーカーに割り当てる
+    queues = [[] for _ in range(max(1, num_of_workers))]
+    totals = [0] * len(queues)
+    for train_file in sorted(rows, key=lambda f: rows[f], reverse=True):
+        worker = totals.index(min(totals))
+        queues[worker].append(train_file)
+        totals[worker] += rows[train_file]
+    return [queue for queue in queues if queue]
+
+
+def plan_time_limits(queues, rows, remaining_seconds, segment_overhead,
+                     time_headroom, min_time_limit):
+    # 各ワーカーは割り当てられたセグメントを順番に学習するので、ジョブの残り時間から余裕分と
+    # 評価・保存の時間を除いた分を、ワーカーごとにそのセグメントの行数に比例して割り当てる
+    wall_seconds = remaining_seconds * (1 - time_headroom)
+    time_limits = {}
+    for queue in queues:
+        queue_rows = max(sum(rows[f] for f in queue), 1)
+        fit_seconds = wall_seconds - segment_overhead * len(queue)
+        for train_file in queue:
+            time_limit = fit_seconds * rows[train_file] / queue_rows
+            if time_limit < min_time_limit:
+                print(f'WARN: time budget for {train_file} is too small: {time_limit:.0f} sec')
+                time_limit = min_time_limit
+            time_limits[train_file] = int(time_limit)
+            print(f'[{get_model_id(train_file)}] {rows[train_file]} rows, '
+                  f'planned time_limit: {time_limits[train_file]} sec')
+    return time_limits
+
+
+def save_profile_rollup(output_data_path, host, model_ids):
+    # このインスタンスで学習（またはキャッシュから復元）した全セグメントの profile.json をフェーズごとに集計する
+    profiles = []
+    for model_id in sorted(model_ids):
+        path = os.path.join(output_data_path, model_id, 'profile.json')
+        if os.path.exists(path):
+            with open(path) as f:
+                profiles.append(json.load(f))
+    phases = rollup(profiles)
+    print_rollup(phases)
+    path = os.path.join(output_data_path, f'profile-{host}.json')
+    with open(path, 'w') as f:
+        json.dump({'host': host, 'segments': len(profiles), 'phases': phases}, f, indent=2)
+    return path
+
+
+def save_leaderboard(predictor, test_df, config, output_path):
+    # 各モデルを test データで採点すると推論のコストがかかるので、サンプリングした行だけを使う
+    # subsample_size が 0 の場合は学習時の検証スコアだけを出力する
+    subsample_size = config.get('leaderboard_args', {}).get('subsample_size', 5000)
+    data = None
+    if subsample_size:
+        data = test_df.sample(n=min(subsample_size, len(test_df)), random_state=0)
+    leaderboard = predictor.leaderboard(data, silent=True)
+    leaderboard.to_csv(os.path.join(output_path, 'leaderboard.csv'), index=False)
+
+
+def save_feature_importance(predictor, test_df, config, output_path):
+    # permutation importance は行数 x 特徴量数 x シャッフル回数だけ推論するので上限を設ける
+    feature_importance_args = {
+        'subsample_size': 1000,
+        'num_shuffle_sets': 3,
+        'time_limit': 60,
+    }
+    feature_importance_args.update(config.get('feature_importance_args', {}))
+    importance = predictor.feature_importance(test_df, silent=True,
+                                              **feature_importance_args)
+    importance.to_csv(os.path.join(output_path, 'feature_importance.csv'))
+
+
+def measure_predictor(model_path, test_df, label, sample_size=1000):
+    # 推論時と同じく保存されたモデルを読み込み、サイズ・読み込み時間・1 行あたりの推論時間を測る
+    start_time = time.time()
+    predictor = TabularPredictor.load(model_path)
+    load_seconds = time.time() - start_time
+    sample_df = test_df.drop(columns=[label]).head(sample_size)
+    start_time = time.time()
+    predictor.predict(sample_df)
+    predict_seconds = time.time() - start_time
+    result = predictor.predict(test_df.drop(columns=[label]))
+    return {
+        'bytes': model_artifact.get_dir_size(model_path),
+        'load_seconds': load_seconds,
+        'predict_ms_per_row': predict_seconds * 1000 / max(len(sample_df), 1),
+        'MAE': float(mean_absolute_error(test_df[label], result)),
+    }
+
+
+def export_slim(predictor, model_path, test_df, label):
+    # 推論に必要な最良モデルだけを残す
+    # bagging の各 fold を全データで学習し直した 1 モデルにまとめ、他のモデルと学習用のファイルを削除する
+    before = measure_predictor(model_path, test_df, label)
+    refit_models = predictor.refit_full(model='best')
+    model_best = refit_models[predictor.get_model_best()]
+    predictor.set_model_best(model_best, save_trainer=True)
+    predictor.delete_models(models_to_keep=model_best, dry_run=False)
+    predictor.save_space()
+    after = measure_predictor(model_path, test_df, label)
+    return {'model': model_best, 'before': before, 'after': after}
+
+
+def get_fit_args(config, budget, time_limit=None):
+    ag_fit_args = copy.deepcopy(config["ag_fit_args"])
+    # 同じインスタンスで並列に学習する他のセグメントと CPU・GPU・メモリを分け合う
+    # （autogluon 0.4 の fit は num_cpus などを直接受け付けないので、各モデルの ag_args_fit で指定する）
+    ag_args_fit = ag_fit_args.setdefault("ag_args_fit", {})
+    ag_args_fit.setdefault("num_cpus", budget["num_cpus"])
+    ag_args_fit.setdefault("num_gpus", budget["num_gpus"])
+    ag_args_fit.setdefault("max_memory_usage_ratio", budget["memory_ratio"])
+    # config.yml に time_limit がある場合は、計画した時間と短いほうを使う
+    if time_limit is not None:
+        ag_fit_args["time_limit"] = min(ag_fit_args.get("time_limit", time_limit),
+                                        time_limit)
+    return ag_fit_args
+
+
+def init_worker(num_cpus):
+    # spawn したプロセスは train.py の読み込み時に numpy などのスレッドプールを作っているので、
+    # 環境変数ではなく threadpoolctl で作成済みのスレッドプールのスレッド数を制限する
+    threadpool_limits(num_cpus)
+    torch.set_num_threads(num_cpus)
+
+
+def train_segment(train_file, config, output_data_path, budget, fingerprint,
+                  time_limit=None):
+    model_id = get_model_id(train_file)
+    print(f'[{model_id}] start training with {budget["num_cpus"]} cpus')
+    start_time = time.time()
+    profiler = Profiler(model_id)
+
+    with profiler.phase('read'):
+        input_df = read_dataset(train_file)
+        print_memory_report(f'training data {model_id}', input_df)
+        train_df, test_df = train_test_split(
+            input_df, test_size=0.2, random_state=0
+        )
+        train_data = TabularDataset(train_df)
+
+    model_path = os.path.join(TMP_PATH, model_id)
+    os.makedirs(model_path)
+    ag_predictor_args = copy.deepcopy(config["ag_predictor_args"])
+    ag_predictor_args["path"] = model_path
+    ag_predictor_args.setdefault("label", LABEL)
+    label = ag_predictor_args["label"]
+    ag_fit_args = get_fit_args(config, budget, time_limit)
+
+    fit_start_time = time.time()
+    with profiler.phase('fit'):
+        predictor = TabularPredictor(**ag_predictor_args).fit(train_data, **ag_fit_args)
+    fit_seconds = time.time() - fit_start_time
+
+    with profiler.phase('evaluate'):
+        result = predictor.predict(test_df.drop(columns=[label]))
+        mae = mean_absolute_error(test_df[label], result)
+
+    output_path = os.path.join(output_data_path, model_id)
+    os.makedirs(output_path)
+    eval_dict = {
+        'MAE': float(mae),
+        'fingerprint': fingerprint,
+        'time_limit': ag_fit_args.get('time_limit'),
+        'fit_seconds': fit_seconds,
+    }
+    for name, save in [('leaderboard', save_leaderboard),
+                       ('feature_importance', save_feature_importance)]:
+        if not config.get(name, False):
+            continue
+        output_start_time = time.time()
+        with profiler.phase(name):
+            save(predictor, test_df, config, output_path)
+        eval_dict[f'{name}_seconds'] = time.time() - output_start_time
+        print(f"[{model_id}] {name} saved in {eval_dict[f'{name}_seconds']:.1f} sec")
+
+    # 精度を少し犠牲にしてでも推論を速くしたい場合は、推論用の最小構成に変換してから保存する
+    if config.get('slim_export', False):
+        with profiler.phase('export'):
+            export = export_slim(predictor, model_path, test_df, label)
+        eval_dict['MAE'] = export['after']['MAE']
+        eval_dict['export'] = export
+        for name in ['before', 'after']:
+            print(f"[{model_id}] {name} export: {export[name]['bytes']} bytes, "
+                  f"load {export[name]['load_seconds']:.2f} sec, "
+                  f"predict {export[name]['predict_ms_per_row']:.3f} ms/row, "
+                  f"MAE {export[name]['MAE']}")
+
+    with open(os.path.join(output_path, 'eval.yml'), 'w') as f:
+        yaml.dump(eval_dict, f)
+
+    # config.yml の model_artifact_format で指定した形式で書き出す
+    format_name, level = model_artifact.get_artifact_config(config)
+    with profiler.phase('pack'):
+        artifact = model_artifact.pack(model_path, output_path, format_name, level,
+                                       budget['num_cpus'])
+        shutil.rmtree(model_path)
+    print(f"[{model_id}] model artifact {format_name}: "
+          f"{artifact['raw_bytes']} -> {artifact['bytes']} bytes, "
+          f"packed in {artifact['pack_seconds']:.2f} sec")
+    print(f'[{model_id}] MAE: {mae}')
+    train_seconds = time.time() - start_time
+    print(f'[{model_id}] planned time_limit: {ag_fit_args.get("time_limit")} sec, '
+          f'fit: {fit_seconds:.1f} sec, total: {train_seconds:.1f} sec')
+    profiler.save(os.path.join(output_path, 'profile.json'))
+    return model_id, train_seconds
+
+
+def train_queue(queue, config, output_data_path, budget, fingerprints, time_limits):
+    # 割り当てられたセグメントを順番に学習し、失敗したセグメントがあっても残りを続ける
+    results = []
+    for train_file in queue:
+        try:
+            model_id, train_seconds = train_segment(
+                train_file, config, output_data_path, budget,
+                fingerprints[train_file], time_limits.get(train_file))
+        except Exception as e:
+            print(f'ERROR: training with {train_file} failed: {e}')
+            results.append((train_file, None, None))
+            continue
+        results.append((train_file, model_id, train_seconds))
+    return results
+
+
 if __name__ == "__main__":
+    job_start_time = time.time()
     # Disable Autotune
     os.environ["MXNET_CUDNN_AUTOTUNE_DEFAULT"] = "0"
-    n_gpus = torch.cuda.device_count()
 
     parser = argparse.ArgumentParser()
 
     # Data and model checkpoints directories
     parser.add_argument('--num-of-dataset', type=int, default=1, metavar='N',
                         help='N of dataset')
+    parser.add_argument('--num-of-workers', type=int, default=0, metavar='N',
+                        help='number of segments trained concurrently (0: decided by CPU and memory)')
+    parser.add_argument('--min-cpus-per-segment', type=int, default=2, metavar='N',
+                        help='minimum number of CPUs given to each segment')
+    parser.add_argument('--min-memory-per-segment', type=float, default=4, metavar='GB',
+                        help='minimum memory in GB given to each segment')
+    parser.add_argument('--max-runtime', type=int, default=0, metavar='SEC',
+                        help='runtime limit of the job (0: MaxRuntimeInSeconds of the job, '
+                             'no time_limit if not found)')
+    parser.add_argument('--time-headroom', type=float, default=0.1,
+                        help='fraction of the remaining time kept unused')
+    parser.add_argument('--segment-overhead', type=int, default=120, metavar='SEC',
+                        help='time reserved per segment for evaluation and saving')
+    parser.add_argument('--min-time-limit', type=int, default=60, metavar='SEC',
+                        help='minimum time_limit given to each segment')
+    parser.add_argument('--cache-path', type=str, default=None,
+                        help='S3 path of the skip-retrain cache '
+                             '(default: <train output parent>/_cache)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='always train even if the same model exists')
+    parser.add_argument('--cache-time-tolerance', type=float, default=0.1,
+                        help='fraction by which the cached time_limit may be shorter '
+                             'than the planned one')
     args = parser.parse_args()
 
     # 複数インスタンスを使用した場合に、自分がどのインスタンス（ID）なのかを取得
@@ -50,10 +328,12 @@ if __name__ == "__main__":
         processingjobconfig = json.load(f)
         print('processingjobconfig', processingjobconfig)
         output_data_path = ''
+        output_data_uri = ''
         outputs = processingjobconfig['ProcessingOutputConfig']['Outputs']
         for o in outputs:
             if o['OutputName'] == 'result':
                 output_data_path = o['S3Output']['LocalPath']
+                output_data_uri = o['S3Output']['S3Uri']
 
         inputs = processingjobconfig['ProcessingInputs']
         code_path = ''
@@ -64,39 +344,126 @@ if __name__ == "__main__":
             elif i['InputName'] == 'data':
                 input_data_path = i['S3Input']['LocalPath']
 
+        max_runtime = args.max_runtime or processingjobconfig.get(
+            'StoppingCondition', {}).get('MaxRuntimeInSeconds', 0)
+
     config_file = os.path.join(code_path, 'config.yml')
     with open(config_file) as f:
         config = yaml.safe_load(f)  # AutoGluon-specific config
 
-    if n_gpus:
-        config["num_gpus"] = int(args.n_gpus)
-
     print("Running training job with the config:")
     pprint(config)
 
-    train_file = get_input_path(input_data_path)
-    input_df = pd.read_csv(train_file)
-    train_df, test_df = train_test_split(
-        input_df, test_size=0.2, random_state=0
-    )
-    train_data = TabularDataset(train_df)
+    # ShardedByS3Key でこのインスタンスに割り当てられたセグメントをすべて学習する
+    train_files = get_input_files(input_data_path)
+    rows = {train_file: count_rows(train_file) for train_file in train_files}
+
+    # キャッシュの判定では、全セグメントを学習する場合に割り当てられる time_limit 以上で
+    # 学習したモデルだけを再利用する（学習するセグメントが減ると time_limit は長くなる）
+    budget = plan_workers(len(train_files), args.num_of_workers,
+                          args.min_cpus_per_segment,
+                          int(args.min_memory_per_segment * 1024 ** 3))
+    time_limits = {}
+    if max_runtime:
+        time_limits = plan_time_limits(plan_queues(rows, budget['num_of_workers']), rows,
+                                       max_runtime - (time.time() - job_start_time),
+                                       args.segment_overhead, args.time_headroom,
+                                       args.min_time_limit)
 
-    model_id = train_file.split('_')[-1].split('.')[0]
+    # データ・設定・イメージ・コードが前回と同じセグメントは学習済みモデルを再利用する
+    s3_client = storage.get_client()
+    cache_uri = args.cache_path or f'{os.path.dirname(output_data_uri)}/_cache'
+    image_uri = get_env_if_present('IMAGE_URI')
+    fingerprints = {}
+    cache_hits = {}
+    saved_seconds = 0
+    for train_file in list(train_files):
+        model_id = get_model_id(train_file)
+        time_limit = get_fit_args(config, budget,
+                                  time_limits.get(train_file)).get('time_limit')
+        fingerprint = model_cache.get_fingerprint(train_file, config, image_uri,
+                                                  code_path)
+        fingerprints[train_file] = fingerprint
+        entry = None
+        if not args.no_cache:
+            entry = model_cache.lookup(s3_client, cache_uri, fingerprint, time_limit,
+                                       args.cache_time_tolerance)
+        if entry is None:
+            print(f'[{model_id}] cache miss: {fingerprint}')
+            continue
+        print(f"[{model_id}] cache hit: {fingerprint} -> {entry['uri']}")
+        # コピーされた前回の profile.json は、このジョブでの処理（コピーのみ）の記録で上書きする
+        profiler = Profiler(model_id)
+        with profiler.phase('restore'):
+            model_cache.restore(s3_client, entry, f'{output_data_uri}/{model_id}')
+        os.makedirs(os.path.join(output_data_path, model_id))
+        profiler.save(os.path.join(output_data_path, model_id, 'profile.json'))
+        cache_hits[train_file] = entry
+        train_files.remove(train_file)
+        saved_seconds += entry['train_seconds']
 
-    os.makedirs('/opt/ml/processing/tmp')
-    ag_predictor_args = config["ag_predictor_args"]
-    ag_predictor_args["path"] = '/opt/ml/processing/tmp'
-    ag_fit_args = config["ag_fit_args"]
+    # 学習するセグメントだけで CPU・メモリ・実行時間を分け合う
+    budget = plan_workers(len(train_files), args.num_of_workers,
+                          args.min_cpus_per_segment,
+                          int(args.min_memory_per_segment * 1024 ** 3))
+    print('resource budget per segment:', budget)
+    # 学習するセグメントをワーカーごとのキューに分け、キューごとにジョブの残り時間を分け合う
+    queues = plan_queues({f: rows[f] for f in train_files}, budget['num_of_workers'])
+    if max_runtime and train_files:
+        time_limits = plan_time_limits(queues, rows,
+                                       max_runtime - (time.time() - job_start_time),
+                                       args.segment_overhead, args.time_headroom,
+                                       args.min_time_limit)
 
-    predictor = TabularPredictor(**ag_predictor_args).fit(train_data, **ag_fit_args)
+    os.makedirs(TMP_PATH)
+    # ワーカープロセスは起動時にこの環境変数を引き継ぎ、ライブラリの読み込み時からスレッド数が制限される
+    limit_threads(budget['num_cpus'])
+    failed = []
+    models = {}
+    cache_entries = []
+    with ProcessPoolExecutor(max_workers=budget['num_of_workers'],
+                             mp_context=mp.get_context('spawn'),
+                             initializer=init_worker,
+                             initargs=(budget['num_cpus'],)) as executor:
+        futures = {executor.submit(train_queue, queue, config, output_data_path,
+                                   budget, fingerprints, time_limits): queue
+                   for queue in queues}
+        for future in as_completed(futures):
+            try:
+                results = future.result()
+            except Exception as e:
+                # ワーカープロセスが異常終了した場合は、そのキューのセグメントをすべて失敗とする
+                print(f'ERROR: training with {futures[future]} failed: {e}')
+                failed.extend(futures[future])
+                continue
+            for train_file, model_id, train_seconds in results:
+                if model_id is None:
+                    failed.append(train_file)
+                    continue
+                print(f'model {model_id} has been trained in {train_seconds:.1f} sec')
+                models[model_id] = registry.load_local_entry(
+                    os.path.join(output_data_path, model_id))
+                time_limit = get_fit_args(config, budget,
+                                          time_limits.get(train_file)).get('time_limit')
+                cache_entries.append(model_cache.create_entry(
+                    fingerprints[train_file], f'{output_data_uri}/{model_id}',
+                    os.path.join(output_data_path, model_id), train_seconds,
+                    time_limit))
 
-    result = predictor.predict(test_df.drop(columns=['medianHouseValue']))
-    mae = mean_absolute_error(test_df['medianHouseValue'], result)
+    # 推論時にモデルの選択を 1 回の GET で行えるよう、このインスタンスのモデル一覧を書き出す
+    for train_file, entry in cache_hits.items():
+        bucket, prefix = storage.split_s3_uri(entry['uri'])
+        models[get_model_id(train_file)] = registry.load_s3_entry(s3_client, bucket, prefix)
+    registry.write_part(output_data_path, current_host, models,
+                        {'uri': cache_uri, 'entries': cache_entries})
 
-    eval_file = os.path.join(output_data_path, model_id, 'eval.yml')
-    os.makedirs(os.path.join(output_data_path, model_id))
-    with open(eval_file, 'w') as f:
-        yaml.dump({'MAE': float(mae)}, f)
+    # 各セグメントの学習でどのフェーズに時間がかかったかを集計する（推論は post.py で集計）
+    save_profile_rollup(output_data_path, current_host,
+                        [get_model_id(f) for f in train_files + list(cache_hits)])
 
-    # あとで S3 からダウンロードしやすいよう ZIP で圧縮
-    shutil.make_archive(os.path.join(output_data_path, model_id, 'model'), format='zip', root_dir='/opt/ml/processing/tmp')
+    print(f'training finished in {time.time() - job_start_time:.1f} sec '
+          f'(runtime limit: {max_runtime or None})')
+    print(f'cache: {len(cache_hits)} hits, {len(train_files)} misses, '
+          f'{saved_seconds:.1f} sec of training saved')
+    if failed:
+        raise RuntimeError(f'training failed: {failed}')
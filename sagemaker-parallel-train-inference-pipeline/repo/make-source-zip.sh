@@ -2,8 +2,19 @@ LAMBDA_FUNC_NAME=$(python setenv.py config startsfn-lambda-name)
 rm -rf ${LAMBDA_FUNC_NAME}
 rm ${LAMBDA_FUNC_NAME}.zip
 mkdir ${LAMBDA_FUNC_NAME}
-pip install pyyaml -t ${LAMBDA_FUNC_NAME}
 cp code/lambda/start-pipeline/index.py ${LAMBDA_FUNC_NAME}
+cp code/lambda/common/*.py ${LAMBDA_FUNC_NAME}
 cd ${LAMBDA_FUNC_NAME}
 zip -r ../${LAMBDA_FUNC_NAME}.zip .
 cd ..
+
+# 学習ジョブのモデル一覧をまとめる Lambda 関数（名前は pipeline.py と合わせる）
+REGISTER_FUNC_NAME=${LAMBDA_FUNC_NAME}-register
+rm -rf ${REGISTER_FUNC_NAME}
+rm ${REGISTER_FUNC_NAME}.zip
+mkdir ${REGISTER_FUNC_NAME}
+cp code/lambda/register-models/index.py ${REGISTER_FUNC_NAME}
+cp code/lambda/common/*.py ${REGISTER_FUNC_NAME}
+cd ${REGISTER_FUNC_NAME}
+zip -r ../${REGISTER_FUNC_NAME}.zip .
+cd ..
@@ -19,6 +19,7 @@ from stepfunctions.steps import (
 
 stepfunctions.set_stream_logger(level=logging.INFO)
 config_name = 'pipeline-config.yml'
+COMMON_LOCATION = "code/sagemaker/common"
 
 REGION = os.environ['REGION']
 ACCOUNT_ID = os.environ['ACCOUNT_ID']
@@ -43,9 +44,24 @@ def get_parameters():
         params['notification-lambda-name'] = config['config']['notification-lambda-name']
         params['startsfn-lambda-name'] = config['config']['startsfn-lambda-name']
         params['startsfn-lambda-role-arn'] = config['config']['startsfn-lambda-role-arn']
+        # 学習ジョブのモデル一覧をまとめる Lambda 関数（make-source-zip.sh と同じ名前）
+        params['register-lambda-name'] = params['startsfn-lambda-name'] + '-register'
         params['sns-topic-arn'] = config['config']['sns-topic-arn']
         params['num-of-segment'] = config['config']['num-of-segment']
+        # num-of-segment はセグメント数の最小値で、実行時のセグメント数とインスタンス数は
+        # start-pipeline の Lambda 関数が入力データの大きさから決める（最大 max-instance-count 台）
+        # train/pred-instance-count は Step Functions の定義に書き込まれる既定値
+        params['max-instance-count'] = config['config'].get('max-instance-count', 10)
+        params['train-instance-count'] = config['config'].get(
+            'train-instance-count', params['num-of-segment'])
+        params['pred-instance-count'] = config['config'].get(
+            'pred-instance-count', params['num-of-segment'])
         params['metric-threshold'] = config['config']['metric-threshold']
+        # 学習ジョブの実行時間の上限（train.py はこの時間に収まるよう time_limit を決める）
+        params['train-max-runtime'] = config['config'].get(
+            'train-max-runtime', 86400)
+        # start-pipeline の Lambda 関数のメモリ（CPU もメモリに比例して割り当てられ、コールドスタートの時間に影響する）
+        params['lambda-memory-size'] = config['config'].get('lambda-memory-size', 256)
 
         print('------------------')
         print(params)
@@ -63,6 +79,22 @@ def get_latest_image_uri(repo_name):
     return latest_image_uri
 
 
+def upload_code(params, script_location):
+    # 共通モジュールと config.yml は各スクリプトと同じ場所に配置する
+    key_prefix = os.path.join(params['s3-prefix'], script_location, EXEC_ID)
+    sagemaker_session.upload_data(
+        COMMON_LOCATION,
+        bucket=params['bucket-name'],
+        key_prefix=key_prefix,
+    )
+    code_s3_path = sagemaker_session.upload_data(
+        script_location,
+        bucket=params['bucket-name'],
+        key_prefix=key_prefix,
+    )
+    return code_s3_path
+
+
 def create_prep_processing(params, sagemaker_role):
 
     prep_processor = Processor(
@@ -93,7 +125,7 @@ def function_exists(function_name):
 
 
 def create_lambda_function(function_name, file_name, role_arn, handler_name,
-                           envs={}, py_version='python3.9'):
+                           envs={}, py_version='python3.9', memory_size=128):
 
     with open(file_name+'.zip', 'rb') as f:
         zip_data = f.read()
@@ -105,7 +137,8 @@ def create_lambda_function(function_name, file_name, role_arn, handler_name,
             Environment={
                 'Variables': envs
             },
-            Handler=handler_name+'.lambda_handler'
+            Handler=handler_name+'.lambda_handler',
+            MemorySize=memory_size
         )
         time.sleep(10)
         response = lambda_client.update_function_code(
@@ -127,7 +160,7 @@ def create_lambda_function(function_name, file_name, role_arn, handler_name,
                 'Variables': envs
             },
             Timeout=60*5,  # 5 minutes
-            MemorySize=128,  # 128 MB
+            MemorySize=memory_size,  # MB
             Publish=True,
             PackageType='Zip',
         )
@@ -136,27 +169,19 @@ def create_lambda_function(function_name, file_name, role_arn, handler_name,
 
 def create_prep_step(params, prep_processor, execution_input):
     code_path = '/opt/ml/processing/input/code'
-    input_dir = '/opt/ml/processing/input/data'
     output_dir = '/opt/ml/processing/output'
 
     SCRIPT_LOCATION = "code/sagemaker/prep"
 
-    code_s3_path = sagemaker_session.upload_data(
-        SCRIPT_LOCATION,
-        bucket=params['bucket-name'],
-        key_prefix=os.path.join(params['s3-prefix'], SCRIPT_LOCATION, EXEC_ID),
-    )
+    code_s3_path = upload_code(params, SCRIPT_LOCATION)
 
+    # 生データは ProcessingInput にせず、prep.py が --raw-data-uri から必要なファイルだけを取得する
+    # （差分処理では前回から追加されたファイルだけをダウンロードする）
     prep_inputs = [
         ProcessingInput(
             input_name='code',
             source=code_s3_path,
-            destination=code_path),
-        ProcessingInput(
-            source=execution_input["PrepInput"],
-            destination=input_dir,
-            input_name="data"
-        )
+            destination=code_path)
     ]
 
     prep_outputs = [
@@ -173,8 +198,7 @@ def create_prep_step(params, prep_processor, execution_input):
         job_name=execution_input['PrepJobName'],
         inputs=prep_inputs,
         outputs=prep_outputs,
-        container_arguments=['--num-of-dataset',
-                             str(params['num-of-segment'])],
+        container_arguments=execution_input["PrepArgs"],
         container_entrypoint=["python3",
                               "/opt/ml/processing/input/code/prep.py"],
         wait_for_completion=True,
@@ -186,17 +210,19 @@ def create_prep_step(params, prep_processor, execution_input):
 
 def create_train_processing(params, sagemaker_role):
 
+    image_uri = get_latest_image_uri(params['train-image-name'])
     train_processor = Processor(
         role=sagemaker_role,
-        image_uri=get_latest_image_uri(params['train-image-name']),
-        instance_count=params['num-of-segment'],
+        image_uri=image_uri,
+        instance_count=params['train-instance-count'],
         instance_type="ml.m5.xlarge",
         volume_size_in_gb=16,
         volume_kms_key=None,
         output_kms_key=None,
-        max_runtime_in_seconds=86400,  # default is 24 hours(60*60*24)
+        max_runtime_in_seconds=params['train-max-runtime'],  # default is 24 hours(60*60*24)
         sagemaker_session=None,
-        env=None,
+        # 学習済みモデルの再利用判定にイメージを含めるため
+        env={'IMAGE_URI': image_uri},
         network_config=None
     )
 
@@ -210,11 +236,7 @@ def create_training_step(params, train_processor, execution_input):
 
     SCRIPT_LOCATION = "code/sagemaker/train"
 
-    code_s3_path = sagemaker_session.upload_data(
-        SCRIPT_LOCATION,
-        bucket=params['bucket-name'],
-        key_prefix=os.path.join(params['s3-prefix'], SCRIPT_LOCATION, EXEC_ID),
-    )
+    code_s3_path = upload_code(params, SCRIPT_LOCATION)
 
     train_inputs = [
         ProcessingInput(
@@ -243,12 +265,14 @@ def create_training_step(params, train_processor, execution_input):
         job_name=execution_input["TrainJobName"],
         inputs=train_inputs,
         outputs=train_outputs,
-        container_arguments=['--num-of-dataset',
-                             str(params['num-of-segment'])],
+        container_arguments=execution_input["TrainArgs"],
         container_entrypoint=["python3",
                               "/opt/ml/processing/input/code/train.py"],
         wait_for_completion=True,
-        tags={'EXEC_ID': EXEC_ID}
+        tags={'EXEC_ID': EXEC_ID},
+        # インスタンス数は実行ごとに start-pipeline の Lambda 関数が入力データの大きさから決める
+        parameters={'ProcessingResources': {'ClusterConfig': {
+            'InstanceCount': execution_input["TrainInstanceCount"]}}}
     )
 
     return train_step
@@ -258,7 +282,7 @@ def create_pred_processor(params, sagemaker_role):
     pred_processor = Processor(
         role=sagemaker_role,
         image_uri=get_latest_image_uri(params['train-image-name']),
-        instance_count=params['num-of-segment'],
+        instance_count=params['pred-instance-count'],
         instance_type="ml.m5.xlarge",
         volume_size_in_gb=16,
         volume_kms_key=None,
@@ -279,11 +303,7 @@ def create_pred_step(params, pred_processor, execution_input):
 
     SCRIPT_LOCATION = "code/sagemaker/pred"
 
-    code_s3_path = sagemaker_session.upload_data(
-        SCRIPT_LOCATION,
-        bucket=params['bucket-name'],
-        key_prefix=os.path.join(params['s3-prefix'], SCRIPT_LOCATION, EXEC_ID),
-    )
+    code_s3_path = upload_code(params, SCRIPT_LOCATION)
 
     pred_inputs = [
         ProcessingInput(
@@ -316,7 +336,9 @@ def create_pred_step(params, pred_processor, execution_input):
         container_entrypoint=["python3",
                               "/opt/ml/processing/input/code/pred.py"],
         wait_for_completion=True,
-        tags={'EXEC_ID': EXEC_ID}
+        tags={'EXEC_ID': EXEC_ID},
+        parameters={'ProcessingResources': {'ClusterConfig': {
+            'InstanceCount': execution_input["PredInstanceCount"]}}}
     )
 
     return pred_step
@@ -343,15 +365,12 @@ def create_post_processor(params, sagemaker_role):
 def create_post_step(params, post_processor, execution_input):
     code_path = '/opt/ml/processing/input/code'
     input_dir = '/opt/ml/processing/input/data'
+    label_dir = '/opt/ml/processing/input/labels'
     output_dir = '/opt/ml/processing/output'
 
     SCRIPT_LOCATION = "code/sagemaker/post"
 
-    code_s3_path = sagemaker_session.upload_data(
-        SCRIPT_LOCATION,
-        bucket=params['bucket-name'],
-        key_prefix=os.path.join(params['s3-prefix'], SCRIPT_LOCATION, EXEC_ID),
-    )
+    code_s3_path = upload_code(params, SCRIPT_LOCATION)
 
     post_inputs = [
         ProcessingInput(
@@ -362,6 +381,12 @@ def create_post_step(params, post_processor, execution_input):
             source=execution_input["PostInput"],
             destination=input_dir,
             input_name="data"
+        ),
+        # 推論の入力に正解ラベルがあれば、推論結果と突き合わせて誤差を集計する
+        ProcessingInput(
+            source=execution_input["PredInput"],
+            destination=label_dir,
+            input_name="labels"
         )
     ]
 
@@ -379,9 +404,7 @@ def create_post_step(params, post_processor, execution_input):
         job_name=execution_input["PostJobName"],
         inputs=post_inputs,
         outputs=post_outputs,
-        container_arguments=[
-            '--num-of-dataset', str(params['num-of-segment'])
-        ],
+        container_arguments=execution_input["PostArgs"],
         container_entrypoint=["python3",
                               "/opt/ml/processing/input/code/post.py"],
         wait_for_completion=True,
@@ -410,6 +433,26 @@ def create_notification_step(lambda_function_name, id, message):
     return lambda_step
 
 
+def create_register_step(lambda_function_name, execution_input):
+    # 学習ジョブの各インスタンスのモデル一覧（registry-<host>.json）を registry.json にまとめる
+    # result_path=None で、次の通知ステップには学習ステップの出力をそのまま渡す
+    lambda_step = stepfunctions.steps.compute.LambdaStep(
+        'Register Models',
+        parameters={
+            "FunctionName": lambda_function_name,
+            "Payload": {
+                "train_output": execution_input["TrainOutput"]
+            },
+        },
+        result_path=None,
+    )
+    lambda_step.add_retry(
+        Retry(error_equals=["States.TaskFailed"], interval_seconds=15,
+              max_attempts=2, backoff_rate=4.0)
+    )
+    return lambda_step
+
+
 def create_sfn_workflow(params):
     sfn_workflow_name = params['sfn-workflow-arn'].split(':')[-1]
     workflow_execution_role = params['sfn-role-arn']
@@ -452,6 +495,9 @@ def create_sfn_workflow(params):
     post_step = create_post_step(params, post_processor,
                                  execution_input)
 
+    register_step = create_register_step(params['register-lambda-name'],
+                                         execution_input)
+
     train_notification_step = create_notification_step(
                                     params['notification-lambda-name'],
                                     'Train Notification',
@@ -463,12 +509,14 @@ def create_sfn_workflow(params):
 
     prep_step.add_catch(catch_state)
     train_step.add_catch(catch_state)
+    register_step.add_catch(catch_state)
     pred_step.add_catch(catch_state)
     post_step.add_catch(catch_state)
 
     workflow_graph = Chain([
                         prep_step,
                         train_step,
+                        register_step,
                         train_notification_step,
                         pred_step,
                         post_step,
@@ -494,17 +542,23 @@ if __name__ == '__main__':
     execution_input = ExecutionInput(
         schema={
             "TimeStamp": str,
+            "Plan": dict,
             "PrepJobName": str,
+            "PrepArgs": str,
             "PrepInput": str,
             "PrepOutput": str,
             "TrainJobName": str,
+            "TrainArgs": str,
+            "TrainInstanceCount": int,
             "TrainInput": str,
             "TrainOutput": str,
             "PredJobName": str,
+            "PredInstanceCount": int,
             "PredArgs": str,
             "PredInput": str,
             "PredOutput": str,
             "PostJobName": str,
+            "PostArgs": str,
             "PostInput": str,
             "PostOutput": str,
         }
@@ -516,6 +570,8 @@ if __name__ == '__main__':
         'BUCKET_NAME': params['bucket-name'],
         'PREFIX': params['s3-prefix'],
         'NUM_OF_SEGMENT': str(params['num-of-segment']),
+        'MAX_INSTANCE_COUNT': str(params['max-instance-count']),
+        'TRAIN_MAX_RUNTIME': str(params['train-max-runtime']),
         'METRIC_THRESHOLD': str(params['metric-threshold'])
     }
     lambda_startsfn_function_arn = create_lambda_function(
@@ -524,7 +580,18 @@ if __name__ == '__main__':
                                     params['startsfn-lambda-role-arn'],
                                     'index',
                                     envs,
-                                    py_version='python3.8')
+                                    py_version='python3.8',
+                                    memory_size=params['lambda-memory-size'])
     print(f'{lambda_startsfn_function_arn} has been updated.')
 
+    # start-pipeline と同じロールを使う（S3 の GetObject/PutObject と ListBucket が必要）
+    lambda_register_function_arn = create_lambda_function(
+                                    params['register-lambda-name'],
+                                    params['register-lambda-name'],
+                                    params['startsfn-lambda-role-arn'],
+                                    'index',
+                                    {},
+                                    py_version='python3.8')
+    print(f'{lambda_register_function_arn} has been updated.')
+
     branching_workflow = create_sfn_workflow(params)